@@ -1,21 +1,36 @@
 import os
+import sys
 import argparse
 
 from scripts.processing.OrganiseFiles import OrganiseAllFiles
-from scripts.processing.GammatoneFiltering import FilterAllOrganisedFiles
+from scripts.processing.GammatoneFiltering import FilterAllOrganisedFiles, PackAllAudio
 from scripts.processing.EnvelopeExtraction import ExtractAllEnvelopes
 from scripts.processing.LabelDataGenerator import GenerateLabelData
 from scripts.processing.InputGenerator import GenerateInputData
+from scripts.processing.FBFileReader import PackAllFormants
+from scripts.processing.Manifest import GenerateManifest
+from scripts.processing.NoiseAugmentation import GenerateAugmentedInputData
+from scripts.processing.StreamingFilters import HILBERT_TAPS
 from scripts.plotting.PlottingProcessing import PlotEnvelopesAndFormantsFromFile
 from scripts.CNN.Evaluating import EvaluateOneWavFile, EvaluateRandom, EvaluateWithNoise
+from scripts.CNN.BatchEvaluation import EvaluateBatch, EvaluateNoiseGrid
+from scripts.CNN.Server import Serve
+from scripts.CNN.Streaming import StreamEvaluate
 from scripts.CNN.Training import TrainAndPlotLoss
+from scripts.CNN.Sweep import SweepHyperparameters
+from scripts.CNN.CrossValidation import CrossValidate
+from scripts.CNN.DataParallel import TrainDataParallel, MeasureScaling
+from scripts.CNN.Benchmark import BenchModels
+from scripts.CNN.Models import MODELS
 from configure import configure
 
-def All(LPF=False, CUTOFF=100):
+def All(LPF=False, CUTOFF=100, link='copy'):
     """
     Does all the treatments required for the training
     """
-    OrganiseAllFiles()
+    OrganiseAllFiles(link)
+    PackAllAudio()
+    PackAllFormants()
     FilterAllOrganisedFiles()
     ExtractAllEnvelopes(LPF, CUTOFF)
     GenerateLabelData()
@@ -30,14 +45,24 @@ def main():
         'filter': FilterAllOrganisedFiles,
         'envelope': ExtractAllEnvelopes,
         'label': GenerateLabelData,
-        'input': GenerateInputData
+        'input': GenerateInputData,
+        'formants': PackAllFormants,
+        'pack': PackAllAudio,
+        'manifest': GenerateManifest,
+        'augment': GenerateAugmentedInputData
     }
 
     CNN_FUNCTIONS = {
         'train': TrainAndPlotLoss,
         'eval': EvaluateOneWavFile,  # Applies the CNN to one specified file
         'evalnoise': EvaluateWithNoise,  # Applies the CNN to one specified file
-        'evalrand': EvaluateRandom
+        'evalrand': EvaluateRandom,
+        'evalbatch': EvaluateBatch,
+        'stream': StreamEvaluate,
+        'sweep': SweepHyperparameters,
+        'cv': CrossValidate,
+        'scaling': MeasureScaling,
+        'bench': BenchModels
     }
 
     PLOT_FUNCTIONS = {
@@ -51,13 +76,29 @@ filter:\t\tApplies the GammaTone FilterBank to the organized files.\n\t\t\tSaves
 envelope:\tExtracts the filtered files' envelopes.\n\t\t\tUsing --cutoff CUTOFF as low pass filter cutoff frequency.\n\t\t\tSaves them in .ENV1.npy format\n\t\
 label:\t\tGenerates Labeling data for the CNN\n\t\
 input\t\tGenerates Input data for the CNN, requires label first\n\t\
+formants:\t(Optional) Packs the formants of all the .FB files into one store, for faster lookups\n\t\
+pack:\t\t(Optional) Packs the samples of all the .WAV files into one store, for faster reading\n\t\
+manifest:\tWrites the manifest of already organized files (organize does it too)\n\t\
+augment:\tGenerates noisy versions of the input data (--snr, --copies), mixing filtered noise\n\t\t\tinto the .GFB.npy outputs, requires label and filter first\n\t\
 all:\t\tDoes all of the above, can take some time.
     """
 
     cnnHelpText = """CNN Related Commands:\n\t\
 train:\tTrains the CNN.\n\t\tUse --file command to give the path to an input data numpy matrix\n\t\tOtherwise, uses the input_data.npy file in trainingData/ directory.\n\t\
 eval:\tEvaluates a keras model using one WAV file.\n\t\t
-evalrand:\tEvaluates all the .WAV files in resources/f2cnn/* in a random order.\n\t\tMay be interrupted whenever, if needed.
+evalrand:\tEvaluates all the .WAV files in resources/f2cnn/* in a random order.\n\t\tMay be interrupted whenever, if needed.\n\t\
+evalnoise:\tEvaluates one file with noise (--file, --noise SNRdB), or with --snr, a grid of files(--file,\n\t\t\
+or --count random files) x SNRs generated in memory and evaluated in parallel, giving an accuracy-vs-SNR table.\n\t\
+evalbatch:\tEvaluates the .WAV files without plotting (unless --figures), files prepared by --workers processes\n\t\t\
+and predicted together, saving an aggregate report in trainingData/evaluation/report.json.\n\t\
+stream:\tEvaluates live 16 bits PCM(or .WAV) read from the standard input, or from a growing file given with --file,\n\t\t\
+printing a rising/falling decision every label frame period.\n\t\
+sweep:\tTrains models for each hyperparameter set of a json sweep specification given with --spec,\n\t\t\
+several at a time, and saves a leaderboard of the results.\n\t\
+cv:\tSpeaker independent k-fold cross-validation (--folds K), folds trained in parallel.\n\t\
+scaling:\tMeasures the throughput of train --data-parallel for each number of workers of --worker-counts.\n\t\
+bench:\tTrains each architecture (--arch, default: all), reporting its parameters, FLOPs,\n\t\t\
+CPU latency per 1k windows and validation accuracy.
     """
     fileHelpText = "Used to give a file path as an argument to some scripts."
     inputHelpText = "Used to give a path to an input numpy file as an argument to some scripts."
@@ -80,6 +121,19 @@ evalrand:\tEvaluates all the .WAV files in resources/f2cnn/* in a random order.\
     parser_prepare.add_argument('--file', '-f', action='store', dest='file', nargs='?', help=fileHelpText)
     parser_prepare.add_argument('--input', '-i', action='store', dest='inputFile', nargs='?', help=inputHelpText)
     parser_prepare.add_argument('--label', '-l', action='store', dest='labelFile', nargs='?', help=labelHelpText)
+    parser_prepare.add_argument('--region', action='store', dest='region',
+                                help="With filter, envelope and label: only uses the files of this region (DR1-8)")
+    parser_prepare.add_argument('--speakers', action='store', type=int, dest='speakerCount',
+                                help="With filter, envelope and label: only uses the files of this number of speakers")
+    parser_prepare.add_argument('--link', action='store', dest='link', choices=['copy', 'hard', 'sym'],
+                                help="With organize: copies the files (default), or uses hard or symbolic links")
+    parser_prepare.add_argument('--snr', action='store', dest='snrs', default='0,5,10',
+                                help="With augment: comma separated SNRs in dB, each noisy copy of a file\n\
+uses one of them at random (default: 0,5,10)")
+    parser_prepare.add_argument('--copies', action='store', type=int, dest='copies', default=1,
+                                help="With augment: number of noisy copies of the input data (default: 1)")
+    parser_prepare.add_argument('--seed', action='store', type=int, dest='seed', default=0,
+                                help="With augment: seed of the noise")
 
     # Parser for plotting purposes
     parser_plot = subparsers.add_parser('plot', help='For plotting spectrogram-like figure from .WAV file.')
@@ -101,18 +155,128 @@ evalrand:\tEvaluates all the .WAV files in resources/f2cnn/* in a random order.\
                             help="Use Low Pass Filtering on Input Data")
     parser_cnn.add_argument('--noise', '-n', action='store', type=float, dest='SNRdB',
                             help="To use with evalnoise to give a SNR in dB.")
+    parser_cnn.add_argument('--snr', action='store', dest='snrs',
+                            help="With evalnoise: comma separated SNRs in dB, evaluating the files at each of them,\n\
+like -5,0,5,10,20")
+    parser_cnn.add_argument('--region', action='store', dest='region',
+                            help="With evalrand and evalbatch: only uses the files of this region (DR1-8)")
+    parser_cnn.add_argument('--speakers', action='store', type=int, dest='speakerCount',
+                            help="With evalrand and evalbatch: only uses the files of this number of speakers")
+    parser_cnn.add_argument('--formant', action='store', type=int, dest='formant', choices=range(5),
+                            help="Formant k used by train for Fk labels (default: configuration's FORMANT).\n\
+0 trains a multi-output model, one output per formant.")
+    parser_cnn.add_argument('--stream', action='store_true', dest='stream',
+                            help="With train: streams minibatches from the memory mapped input file\n\
+instead of loading the whole dataset in memory")
+    parser_cnn.add_argument('--workers', action='store', type=int, dest='workers', default=4,
+                            help="With train --stream: number of background workers preparing minibatches.\n\
+With evalbatch and evalnoise --snr: number of processes preparing the files")
+    parser_cnn.add_argument('--shuffle-buffer', action='store', type=int, dest='shuffleBuffer', default=10000,
+                            help="With train --stream: number of consecutive entries shuffled together")
+    parser_cnn.add_argument('--prefetch', action='store', type=int, dest='prefetch', default=10,
+                            help="With train --stream: number of minibatches prepared ahead of the model")
+    parser_cnn.add_argument('--no-cache', action='store_false', dest='cache',
+                            help="With train: normalizes the input data again instead of using\n\
+the cached normalized input of trainingData/cache")
+    parser_cnn.add_argument('--augment', action='store', dest='augmentFile',
+                            help="With train: path to an augmented input file generated by 'prepare augment',\n\
+whose noisy copies of the train entries are added to the training")
+    parser_cnn.add_argument('--resume', action='store_true', dest='resume',
+                            help="With train: resumes an interrupted training from its last checkpoint")
+    parser_cnn.add_argument('--checkpoint-period', action='store', type=int, dest='checkpointPeriod', default=1,
+                            help="With train: number of epochs between two checkpoints (default: 1)")
+    parser_cnn.add_argument('--no-plot', action='store_false', dest='plot',
+                            help="With train: does not plot the validation accuracy and loss")
+    parser_cnn.add_argument('--data-parallel', action='store', type=int, dest='dataParallel',
+                            help="With train: number of worker processes training on disjoint shards of the input,\n\
+their gradients being averaged at each step")
+    parser_cnn.add_argument('--worker-counts', action='store', dest='workerCounts', default='1,2,4,8',
+                            help="With scaling: comma separated numbers of workers measured (default: 1,2,4,8)")
+    parser_cnn.add_argument('--arch', action='store', dest='architecture',
+                            help="With train: architecture of the model, one of {} (default: baseline).\n\
+With bench: comma separated architectures (default: all)".format(', '.join(sorted(MODELS.keys()))))
+    parser_cnn.add_argument('--hop', action='store', type=int, dest='hop',
+                            help="With eval, evalrand, evalbatch and evalnoise: number of samples between two\n\
+evaluated windows (default: the label sampling period)")
+    parser_cnn.add_argument('--max-batch-mb', action='store', type=float, dest='maxBatchMB', default=64,
+                            help="With eval, evalrand and evalnoise: maximum size in MB of the windows\n\
+generated, normalized and predicted at once (default: 64).\n\
+With evalbatch and evalnoise --snr: size in MB of the windows of several files predicted together")
+    parser_cnn.add_argument('--figures', action='store_true', dest='figures',
+                            help="With evalbatch: saves the figure of each file in graphs/FallingOrRising")
+    parser_cnn.add_argument('--chunk', action='store', type=int, dest='chunk',
+                            help="With stream: number of samples read at once (default: the label sampling period)")
+    parser_cnn.add_argument('--timeout', action='store', type=float, dest='timeout', default=5.,
+                            help="With stream --file: seconds without new samples before the file is considered\n\
+complete (default: 5)")
+    parser_cnn.add_argument('--taps', action='store', type=int, dest='taps', default=HILBERT_TAPS,
+                            help="With stream: odd number of taps of the causal Hilbert transformer of the envelopes,\n\
+delaying the decisions by half of them (default: {})".format(HILBERT_TAPS))
+    parser_cnn.add_argument('--spec', action='store', dest='spec',
+                            help="With sweep: path to the json sweep specification")
+    parser_cnn.add_argument('--parallel', action='store', type=int, dest='parallel', default=2,
+                            help="With sweep and cv: number of trainings running at the same time")
+    parser_cnn.add_argument('--threads', action='store', type=int, dest='threads',
+                            help="With sweep, cv, train --data-parallel and scaling: number of threads of each\n\
+training or worker (default: cpus shared)")
+    parser_cnn.add_argument('--folds', action='store', type=int, dest='folds', default=5,
+                            help="With cv: number of speaker disjoint folds")
+    parser_cnn.add_argument('--seed', action='store', type=int, dest='seed', default=0,
+                            help="With cv: seed of the distribution of the speakers into the folds.\n\
+With evalnoise --snr: seed of the choice of the files and of the noise")
+    parser_cnn.add_argument('--leaderboard', action='store', dest='leaderboardFile',
+                            help="With sweep: path to the leaderboard csv file")
+
+    # Parser for the local inference server
+    parser_serve = subparsers.add_parser('serve', help='Serves the predictions of a model on a local HTTP endpoint.',
+                                         formatter_class=argparse.RawTextHelpFormatter,
+                                         description="POST a .WAV file or raw 16 bits PCM to /predict for the\n\
+rising/falling predictions of its windows, GET /stats for the request latency percentiles.")
+    parser_serve.add_argument('--host', action='store', dest='host', default='127.0.0.1',
+                              help="Address the server listens on (default: 127.0.0.1, local only)")
+    parser_serve.add_argument('--port', '-p', action='store', type=int, dest='port', default=8000,
+                              help="TCP port of the server (default: 8000)")
+    parser_serve.add_argument('--socket', action='store', dest='socketPath',
+                              help="Path of a Unix socket to listen on instead of the TCP port")
+    parser_serve.add_argument('--model', '-m', action='store', dest='model', nargs='?', help=modelHelpText)
+    parser_serve.add_argument('--lpf', action='store', type=int, dest='CUTOFF',
+                              help="Low pass filters the envelopes at the given cutoff frequency")
+    parser_serve.add_argument('--hop', action='store', type=int, dest='hop',
+                              help="Number of samples between two predicted windows\n\
+(default: the label sampling period)")
+    parser_serve.add_argument('--max-delay-ms', action='store', type=float, dest='maxDelayMs', default=10,
+                              help="Time in ms a request waits for others to be predicted in the same\n\
+micro-batch (default: 10)")
+    parser_serve.add_argument('--max-batch-mb', action='store', type=float, dest='maxBatchMB', default=16,
+                              help="Maximum size in MB of the windows of a micro-batch (default: 16)")
     # Processes the input arguments
-    args = parser.parse_args()
+    # Lists of SNRs may start with a minus sign, which argparse takes for an option: '--snr -5,0' -> '--snr=-5,0'
+    argv = []
+    for arg in sys.argv[1:]:
+        if argv and argv[-1] == '--snr':
+            argv[-1] = '--snr=' + arg
+        else:
+            argv.append(arg)
+    args = parser.parse_args(argv)
     # print("Arguments:")
     # for arg in args.__dict__.keys():
     #     print("\t{}: {}".format(arg,args.__dict__[arg]))
     # Calls to functions according to arguments
     if 'prepare_command' in args:
         prepare_args={}
-        if args.prepare_command in ['envelope', 'input', 'all']:  # In case we need to use a low pass filter
+        if args.prepare_command in ['envelope', 'input', 'augment', 'all']:  # In case we need to use a low pass filter
             prepare_args['LPF']=False if args.CUTOFF is None else True
             prepare_args['CUTOFF']=args.CUTOFF
-        if args.prepare_command == 'input':
+        if args.prepare_command in ['organize', 'all'] and args.link is not None:
+            prepare_args['link'] = args.link
+        if args.prepare_command in ['filter', 'envelope', 'label']:  # Stages working on a subset of the corpus
+            prepare_args['region'] = args.region
+            prepare_args['speakerCount'] = args.speakerCount
+        if args.prepare_command == 'augment':
+            prepare_args['snrs'] = [float(snr) for snr in args.snrs.split(',')]
+            prepare_args['copies'] = args.copies
+            prepare_args['seed'] = args.seed
+        if args.prepare_command in ['input', 'augment']:
             if args.labelFile is not None:
                 prepare_args['labelFile']=args.labelFile
             if args.inputFile is not None:
@@ -142,10 +306,80 @@ evalrand:\tEvaluates all the .WAV files in resources/f2cnn/* in a random order.\
                 print(
                     "Reminder: label data files generated with 'prepare label' are stored in \n\
                     trainingData/ as 'label_data.csv'.")
-            CNN_FUNCTIONS[args.cnn_command](labelFile=labelFile, inputFile=inputFile)
+            architecture = args.architecture or 'baseline'
+            if architecture not in MODELS:
+                print("Unknown architecture '{}', available: {}".format(architecture,
+                                                                        ', '.join(sorted(MODELS.keys()))))
+                return
+            if args.dataParallel:
+                TrainDataParallel(labelFile=labelFile, inputFile=inputFile, formant=args.formant,
+                                  workers=args.dataParallel, threads=args.threads, architecture=architecture)
+                return
+            CNN_FUNCTIONS[args.cnn_command](labelFile=labelFile, inputFile=inputFile, formant=args.formant,
+                                            stream=args.stream, workers=args.workers,
+                                            shuffleBuffer=args.shuffleBuffer, prefetch=args.prefetch,
+                                            cache=args.cache, augmentFile=args.augmentFile, resume=args.resume,
+                                            checkpointPeriod=args.checkpointPeriod, plot=args.plot,
+                                            architecture=architecture)
             return
+        elif args.cnn_command == 'sweep':
+            if args.spec is None:
+                print("Please use --spec to give the path to a json sweep specification")
+                return
+            CNN_FUNCTIONS[args.cnn_command](args.spec, labelFile=args.labelFile, inputFile=args.inputFile,
+                                            formant=args.formant, parallel=args.parallel, threads=args.threads,
+                                            leaderboardFile=args.leaderboardFile)
+        elif args.cnn_command == 'scaling':
+            CNN_FUNCTIONS[args.cnn_command](labelFile=args.labelFile, inputFile=args.inputFile, formant=args.formant,
+                                            workerCounts=[int(count) for count in args.workerCounts.split(',')],
+                                            threads=args.threads)
+        elif args.cnn_command == 'bench':
+            CNN_FUNCTIONS[args.cnn_command](labelFile=args.labelFile, inputFile=args.inputFile, formant=args.formant,
+                                            architectures=args.architecture and args.architecture.split(','))
+        elif args.cnn_command == 'cv':
+            CNN_FUNCTIONS[args.cnn_command](labelFile=args.labelFile, inputFile=args.inputFile, formant=args.formant,
+                                            folds=args.folds, parallel=args.parallel, threads=args.threads,
+                                            seed=args.seed)
+        elif args.cnn_command == 'evalbatch':
+            evalArgs = {'count': args.count, 'region': args.region, 'speakerCount': args.speakerCount, 'hop': args.hop,
+                        'maxBatchMB': args.maxBatchMB, 'workers': args.workers, 'plot': args.figures}
+            if args.model is not None:
+                evalArgs['model'] = args.model
+            if args.CUTOFF is not None:
+                evalArgs['LPF'] = True
+                evalArgs['CUTOFF'] = args.CUTOFF
+            CNN_FUNCTIONS[args.cnn_command](**evalArgs)
+        elif args.cnn_command == 'stream':
+            streamArgs = {'file': args.file, 'chunk': args.chunk, 'timeout': args.timeout, 'taps': args.taps}
+            if args.model is not None:
+                streamArgs['model'] = args.model
+            if args.CUTOFF is not None:
+                streamArgs['LPF'] = True
+                streamArgs['CUTOFF'] = args.CUTOFF
+            CNN_FUNCTIONS[args.cnn_command](**streamArgs)
+        elif args.cnn_command == 'evalnoise' and args.snrs is not None:
+            noiseArgs = {'snrs': [float(snr) for snr in args.snrs.split(',')], 'count': args.count,
+                         'region': args.region, 'speakerCount': args.speakerCount, 'hop': args.hop,
+                         'maxBatchMB': args.maxBatchMB, 'workers': args.workers, 'seed': args.seed}
+            if args.file is not None:
+                noiseArgs['files'] = [args.file]
+            if args.model is not None:
+                noiseArgs['model'] = args.model
+            if args.CUTOFF is not None:
+                noiseArgs['LPF'] = True
+                noiseArgs['CUTOFF'] = args.CUTOFF
+            EvaluateNoiseGrid(**noiseArgs)
+        elif args.cnn_command == 'evalrand':
+            evalArgs = {'count': args.count, 'region': args.region, 'speakerCount': args.speakerCount, 'hop': args.hop,
+                        'maxBatchMB': args.maxBatchMB}
+            if args.model is not None:
+                evalArgs['model'] = args.model
+            if args.CUTOFF is not None:
+                evalArgs['LPF'] = True
+                evalArgs['CUTOFF'] = args.CUTOFF
+            CNN_FUNCTIONS[args.cnn_command](**evalArgs)
         elif 'file' in args and args.file is not None:
-            evalArgs = {'file': args.file}
+            evalArgs = {'file': args.file, 'hop': args.hop, 'maxBatchMB': args.maxBatchMB}
             if 'CUTOFF' in args and args.CUTOFF is not None:
                 evalArgs['LPF'] = True
                 evalArgs['CUTOFF'] = args.CUTOFF
@@ -153,9 +387,16 @@ evalrand:\tEvaluates all the .WAV files in resources/f2cnn/* in a random order.\
                 evalArgs['model'] = args.model
             if args.cnn_command == 'evalnoise' and 'SNRdB' in args and args.SNRdB is not None:
                 evalArgs['SNRdB'] = args.SNRdB
-            if args.cnn_command == 'evalrand' and 'count' in args and args.count is not None:
-                evalArgs['COUNT'] = args.count
             CNN_FUNCTIONS[args.cnn_command](**evalArgs)
+    elif 'maxDelayMs' in args:
+        serveArgs = {'host': args.host, 'port': args.port, 'socketPath': args.socketPath, 'hop': args.hop,
+                     'maxDelayMs': args.maxDelayMs, 'maxBatchMB': args.maxBatchMB}
+        if args.model is not None:
+            serveArgs['model'] = args.model
+        if args.CUTOFF is not None:
+            serveArgs['LPF'] = True
+            serveArgs['CUTOFF'] = args.CUTOFF
+        Serve(**serveArgs)
     elif args.configure:
         configure()
     else:
@@ -0,0 +1,384 @@
+"""
+This file includes the headless batch evaluation of many .WAV files: a pool of processes prepares the files
+(filterbank, envelopes, windows, normalization and labels), while the main process predicts the windows of
+several files at once with a single model, in batches of up to --max-batch-mb MB.
+The results are aggregated into one report: accuracy overall, per phoneme, per speaker and per region,
+and the throughput of the evaluation. No figure is drawn unless requested.
+The same pipeline evaluates files with noise at several SNRs, the noisy samples being generated in memory.
+"""
+import csv
+import json
+import os
+import queue
+import time
+from configparser import ConfigParser
+from functools import partial
+from multiprocessing import cpu_count
+from multiprocessing.pool import Pool
+
+import numpy
+
+from gammatone import filters
+from scripts.plotting.PlottingCNN import PlotEnvelopesAndCNNResultsWithPhonemes
+from scripts.processing.EnvelopeExtraction import ExtractEnvelopeFromMatrix
+from scripts.processing.FBFileReader import ExtractFBFile
+from scripts.processing.GammatoneFiltering import GetArrayFromWAV, GetFilteredOutputFromArray
+from scripts.processing.InputGenerator import GetStridedWindows
+from scripts.processing.Manifest import GetOrganisedFiles
+from scripts.processing.NoiseAugmentation import SNRdbToSNRlinear, RMS
+from scripts.processing.PHNFileReader import ExtractPhonemes
+from .Evaluating import Predictor, GetFileLabels, ScorePredictions
+from .Training import normalizeInputBatch
+
+REPORT_PATH = os.path.join('trainingData', 'evaluation', 'report.json')
+NOISE_PATH = os.path.join('trainingData', 'evaluation', 'noise.csv')
+# Number of prepared files waiting for the prediction or being prepared, per process preparing them
+PREPARED_PER_WORKER = 2
+
+
+def InitProcesses(FBCOEFS):
+    global FILTERBANK_COEFFICIENTS
+    FILTERBANK_COEFFICIENTS = FBCOEFS
+
+
+def PrepareFile(file, LPF, CUTOFF, hop, formant, plot, SNRdB=None, seed=0):
+    """
+    Prepares the evaluation of one file, in a worker process
+    :param file: path to the .WAV file
+    :param LPF: boolean for whether or not using low pass filtering
+    :param CUTOFF: cutoff frequency of the LPF
+    :param hop: number of samples between two evaluated entries, by default the label frame period
+    :param formant: index of the formant(1-4) of the labels
+    :param plot: if True, the envelopes, phonemes and formants are also given, for plotting
+    :param SNRdB: if given, gaussian noise is added to the samples for this SNR, like EvaluateWithNoise does
+    :param seed: seed of the noise
+    :return: dict of the normalized N x 11 x 128 float32 entries, their frames, the labels of the file
+             and the counts of constant and non positive entries
+    """
+    config = ConfigParser()
+    config.read('configF2CNN.conf')
+    RADIUS = config.getint('CNN', 'RADIUS')
+    SAMPPERIOD = config.getint('CNN', 'SAMPLING_PERIOD')
+
+    framerate, wavArray = GetArrayFromWAV(file)
+    if SNRdB is not None:
+        wavArray = wavArray + numpy.random.RandomState(seed).normal(scale=RMS(wavArray) / SNRdbToSNRlinear(SNRdB),
+                                                                    size=len(wavArray))
+    envelopes = ExtractEnvelopeFromMatrix(GetFilteredOutputFromArray(wavArray, FILTERBANK_COEFFICIENTS), LPF, CUTOFF)
+    del wavArray
+    STEP = int(framerate * SAMPPERIOD / 1000000)
+    centers, windows = GetStridedWindows(envelopes, RADIUS, STEP, hop or STEP)
+    windows = numpy.ascontiguousarray(windows, dtype=numpy.float32)
+    constant, nonPositive = normalizeInputBatch(windows)
+
+    prepared = {'file': file, 'SNRdB': SNRdB, 'centers': centers, 'windows': windows, 'step': STEP,
+                'labels': GetFileLabels(file, config, formant), 'constant': constant, 'nonPositive': nonPositive}
+    if plot:
+        prepared['envelopes'] = envelopes
+        prepared['phonemes'] = ExtractPhonemes(os.path.splitext(file)[0] + '.PHN')
+        prepared['formants'] = ExtractFBFile(os.path.splitext(file)[0] + '.FB', period=SAMPPERIOD)[0]
+    return prepared
+
+
+def PrepareNoisyFile(task, **parameters):
+    """
+    :param task: path to the .WAV file, SNR in dB and seed of the noise
+    :param parameters: the other parameters of PrepareFile
+    :return: see PrepareFile
+    """
+    file, SNRdB, seed = task
+    return PrepareFile(file, SNRdB=SNRdB, seed=seed, **parameters)
+
+
+def PrepareBounded(pool, function, tasks, inFlight):
+    """
+    Prepares files in a pool of processes, like imap_unordered, but with at most inFlight files being prepared
+    or prepared and not used yet: a new file is only submitted once a prepared one has been taken,
+    so that the prepared files do not pile up in memory when the predictions are slower than the preparation
+    :param pool: the pool of processes
+    :param function: function preparing a file, called with a task
+    :param tasks: list of the tasks, like paths to the .WAV files
+    :param inFlight: maximum number of files submitted and not taken yet
+    :return: generator of the prepared files, in the order they are prepared
+    """
+    prepared = queue.Queue()
+    pending = iter(tasks)
+
+    def submit():
+        for task in pending:
+            pool.apply_async(function, (task,), callback=prepared.put, error_callback=prepared.put)
+            return
+
+    for _ in range(inFlight):
+        submit()
+    for _ in range(len(tasks)):
+        result = prepared.get()
+        if isinstance(result, BaseException):
+            raise result
+        submit()
+        yield result
+
+
+def PredictInBatches(preparedFiles, count, predictor, maxBatchMB, stats):
+    """
+    Predicts the windows of prepared files, several files at once
+    :param preparedFiles: iterator of prepared files, see PrepareFile
+    :param count: number of prepared files
+    :param predictor: the Evaluating.Predictor
+    :param maxBatchMB: size in MB of the windows predicted together
+    :param stats: dict whose 'batches' and 'predict_time' are updated
+    :return: generator of the prepared files with their N x 2 predictions, files without any window being given
+             with no prediction
+    """
+    batchSize = maxBatchMB * 1024 * 1024
+    batch = []
+    for done, prepared in enumerate(preparedFiles, 1):
+        if len(prepared['windows']) == 0:
+            # File shorter than an input entry, given without prediction
+            yield prepared, numpy.empty((0, 2), numpy.float32)
+        else:
+            batch.append(prepared)
+        # The windows of the files are predicted together once there are enough of them, or after the last file
+        if not batch or (sum(item['windows'].nbytes for item in batch) < batchSize and done < count):
+            continue
+        predictStart = time.time()
+        scores, _, _ = predictor.predict(numpy.concatenate([item['windows'] for item in batch]), maxBatchMB,
+                                         normalized=True)
+        stats['predict_time'] = stats.get('predict_time', 0.) + time.time() - predictStart
+        stats['batches'] = stats.get('batches', 0) + 1
+
+        bounds = numpy.cumsum([0] + [len(item['windows']) for item in batch])
+        for item, start, end in zip(batch, bounds[:-1], bounds[1:]):
+            yield item, scores[start:end]
+        batch = []
+
+
+def GetFiles(count=None, region=None, speakerCount=None, seed=None):
+    """
+    :param count: number of random files, all the files by default
+    :param region: if given, only the files of this dialect region(DR1-8) are given
+    :param speakerCount: if given, only the files of this number of speakers are given
+    :param seed: seed of the random choice of the files
+    :return: list of paths to organised .WAV files
+    """
+    wavFiles = GetOrganisedFiles('WAV', region, speakerCount)
+    if not wavFiles:
+        print("NO WAV FILES FOUND")
+        exit(-1)
+    if count is not None and count < len(wavFiles):
+        wavFiles = sorted(numpy.random.RandomState(seed).choice(wavFiles, count, replace=False))
+    return wavFiles
+
+
+def AddCounts(totals, key, confusion):
+    """
+    Adds the correct and total predictions of confusion tables to the counts of a key
+    :param totals: dict of {key: [correct, total]}
+    :param key: the key, like a phoneme, a speaker or a region
+    :param confusion: 2x2 confusion table, or several of them, see Evaluating.ScorePredictions
+    """
+    counts = totals.setdefault(key, [0, 0])
+    confusion = numpy.asarray(confusion).reshape(-1, 2, 2)
+    counts[0] += int(numpy.trace(confusion, axis1=1, axis2=2).sum())
+    counts[1] += int(confusion.sum())
+
+
+def GetAccuracies(totals):
+    """
+    :param totals: dict of {key: [correct, total]}, see AddCounts
+    :return: dict of {key: {'accuracy': , 'predictions': }}, sorted by key
+    """
+    return {key: {'accuracy': correct / total if total else None, 'predictions': total}
+            for key, (correct, total) in sorted(totals.items())}
+
+
+def EvaluateBatch(count=None, LPF=False, CUTOFF=50, region=None, speakerCount=None, hop=None, maxBatchMB=64,
+                  model='last_trained_model', workers=None, plot=False, reportFile=None):
+    """
+    Evaluates many .WAV files with one model, the files being prepared in parallel processes
+    and their windows predicted together in large batches
+    :param count: number of random files evaluated, all the files by default
+    :param LPF: boolean for whether or not using low pass filtering
+    :param CUTOFF: cutoff frequency of the LPF
+    :param region: if given, only the files of this dialect region(DR1-8) are evaluated
+    :param speakerCount: if given, only the files of this number of speakers are evaluated
+    :param hop: number of samples between two evaluated entries, by default the label frame period
+    :param maxBatchMB: size in MB of the windows predicted together, from one or several files
+    :param model: path to the keras model file
+    :param workers: number of processes preparing the files, by default the number of cpus
+    :param plot: if True, saves the figure of each file in graphs/FallingOrRising, without showing it
+    :param reportFile: path to the json report, by default trainingData/evaluation/report.json
+    :return: dict of the report
+    """
+    os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'  # Silence tensorflow logs
+    TotalTime = time.time()
+
+    wavFiles = GetFiles(count, region, speakerCount)
+    workers = workers or cpu_count()
+    reportPath = reportFile or REPORT_PATH
+    print("\n###############################\nBatch evaluation of {} WAV files, prepared by {} processes, "
+          "predicted in batches of {}MB.".format(len(wavFiles), workers, maxBatchMB))
+
+    config = ConfigParser()
+    config.read('configF2CNN.conf')
+    framerate = config.getint('FILTERBANK', 'FRAMERATE')
+    nchannels = config.getint('FILTERBANK', 'NCHANNELS')
+    lowcutoff = config.getint('FILTERBANK', 'LOW_FREQ')
+    FORMANT = config.getint('CNN', 'FORMANT')
+    CENTER_FREQUENCIES = filters.centre_freqs(framerate, nchannels, lowcutoff)
+    FILTERBANK_COEFFICIENTS = filters.make_erb_filters(framerate, CENTER_FREQUENCIES)
+
+    # The processes are started before the model is loaded, so that they do not hold a copy of it
+    pool = Pool(processes=workers, initializer=InitProcesses, initargs=(FILTERBANK_COEFFICIENTS,))
+    preparedFiles = PrepareBounded(pool, partial(PrepareFile, LPF=LPF, CUTOFF=CUTOFF, hop=hop, formant=FORMANT,
+                                                 plot=plot), wavFiles, workers * PREPARED_PER_WORKER)
+    predictor = model if isinstance(model, Predictor) else Predictor(model, FORMANT)
+
+    phonemes, speakers, regions, overall = dict(), dict(), dict(), dict()
+    evaluated, skipped, windowCount, constant, nonPositive = 0, 0, 0, 0, 0
+    stats = {'batches': 0, 'predict_time': 0.}
+    startTime = time.time()
+    for item, fileScores in PredictInBatches(preparedFiles, len(wavFiles), predictor, maxBatchMB, stats):
+        evaluated, windowCount = evaluated + 1, windowCount + len(fileScores)
+        if len(fileScores) == 0:
+            skipped += 1
+            print("\t\t{:<50} skipped, no window ! {}/{} Files.".format(item['file'], evaluated, len(wavFiles)))
+            continue
+        constant, nonPositive = constant + item['constant'], nonPositive + item['nonPositive']
+        accuracy, confusion = ScorePredictions(item['centers'], numpy.argmax(fileScores, axis=1),
+                                               item['labels'], item['step']) \
+            if item['labels'] is not None else (None, dict())
+        # Organised files are named like DR1.FELC0.SX216.WAV
+        fileRegion, fileSpeaker = os.path.basename(item['file']).split('.')[:2]
+        for phoneme, table in confusion.items():
+            AddCounts(phonemes, phoneme, table)
+        AddCounts(speakers, '{}.{}'.format(fileRegion, fileSpeaker), list(confusion.values()))
+        AddCounts(regions, fileRegion, list(confusion.values()))
+        AddCounts(overall, 'all', list(confusion.values()))
+        print("\t\t{:<50} done ! {}/{} Files. Accuracy: {}".format(
+            item['file'], evaluated, len(wavFiles), 'none' if accuracy is None else '{:.4f}'.format(accuracy)))
+
+        if plot:
+            frames = numpy.arange(len(item['envelopes'][0]))
+            fileScores = numpy.stack([numpy.interp(frames, item['centers'], fileScores[:, k])
+                                      for k in range(fileScores.shape[1])], axis=1)
+            PlotEnvelopesAndCNNResultsWithPhonemes(item['envelopes'], fileScores, accuracy, CENTER_FREQUENCIES,
+                                                   item['phonemes'], item['formants'], item['file'], show=False)
+    pool.close()
+    pool.join()
+    evaluationTime = time.time() - startTime
+
+    correct, total = overall.get('all', [0, 0])
+    report = {'model': predictor.path, 'formant': predictor.formant, 'files': len(wavFiles), 'skipped_files': skipped,
+              'windows': windowCount,
+              'predictions': total, 'accuracy': correct / total if total else None,
+              'per_phoneme': GetAccuracies(phonemes), 'per_speaker': GetAccuracies(speakers),
+              'per_region': GetAccuracies(regions),
+              'throughput': {'time': evaluationTime, 'files_per_sec': len(wavFiles) / evaluationTime,
+                             'windows_per_sec': windowCount / evaluationTime, 'predict_time': stats['predict_time'],
+                             'batches': stats['batches'], 'workers': workers},
+              'constant_windows': constant, 'non_positive_windows': nonPositive}
+    os.makedirs(os.path.split(reportPath)[0] or '.', exist_ok=True)
+    with open(reportPath, 'w') as reportJSON:
+        json.dump(report, reportJSON, indent=2)
+
+    for name, accuracies in (('Region', report['per_region']), ('Phoneme', report['per_phoneme'])):
+        print("{}\tAccuracy\tPredictions".format(name))
+        for key, result in accuracies.items():
+            print("{}\t{}\t\t{}".format(key, 'none' if result['accuracy'] is None else
+                                         '{:.4f}'.format(result['accuracy']), result['predictions']))
+    if constant or nonPositive:
+        print("{} constant windows, {} windows with non positive values (filled with 0).".format(constant,
+                                                                                              nonPositive))
+    if skipped:
+        print("{} files without any window (shorter than an input entry) skipped.".format(skipped))
+    print("Accuracy: {} on {} predictions, {} speakers.".format(
+        'none' if report['accuracy'] is None else '{:.4f}'.format(report['accuracy']), total, len(speakers)))
+    print("Evaluated {} files, {} windows in {:.1f}s: {:.1f} files/s, {:.0f} windows/s ({:.1f}s predicting, "
+          "{} batches).".format(len(wavFiles), windowCount, evaluationTime, report['throughput']['files_per_sec'],
+                                report['throughput']['windows_per_sec'], stats['predict_time'], stats['batches']))
+    print("Report saved as '{}'.".format(reportPath))
+    print('              Total time:', time.time() - TotalTime)
+    print('')
+    return report
+
+
+def EvaluateNoiseGrid(snrs, files=None, count=None, LPF=False, CUTOFF=50, region=None, speakerCount=None, hop=None,
+                      maxBatchMB=64, model='last_trained_model', workers=None, seed=0, noiseFile=None):
+    """
+    Evaluates files with gaussian noise at several SNRs, the noisy samples being generated in memory by the
+    processes preparing the files: each file gets the same noise at every SNR, scaled like EvaluateWithNoise does
+    :param snrs: SNRs in dB
+    :param files: paths to the evaluated .WAV files, by default random organised files
+    :param count: number of random files evaluated, all the files by default
+    :param LPF: boolean for whether or not using low pass filtering
+    :param CUTOFF: cutoff frequency of the LPF
+    :param region: if given, only the files of this dialect region(DR1-8) are evaluated
+    :param speakerCount: if given, only the files of this number of speakers are evaluated
+    :param hop: number of samples between two evaluated entries, by default the label frame period
+    :param maxBatchMB: size in MB of the windows predicted together, from one or several files and SNRs
+    :param model: path to the keras model file
+    :param workers: number of processes preparing the files, by default the number of cpus
+    :param seed: seed of the choice of the files and of the noise, the noise of the k-th file using seed + k
+    :param noiseFile: path to the results csv file, by default trainingData/evaluation/noise.csv
+    :return: dict of {SNR: {'accuracy': , 'predictions': }}
+    """
+    os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'  # Silence tensorflow logs
+    TotalTime = time.time()
+
+    wavFiles = files or GetFiles(count, region, speakerCount, seed)
+    workers = workers or cpu_count()
+    noisePath = noiseFile or NOISE_PATH
+    tasks = [(file, SNRdB, seed + k) for k, file in enumerate(wavFiles) for SNRdB in snrs]
+    print("\n###############################\nEvaluating {} WAV files at SNRs of {}dB, {} noisy files prepared by {} "
+          "processes.".format(len(wavFiles), ', '.join(str(SNRdB) for SNRdB in snrs), len(tasks), workers))
+
+    config = ConfigParser()
+    config.read('configF2CNN.conf')
+    framerate = config.getint('FILTERBANK', 'FRAMERATE')
+    nchannels = config.getint('FILTERBANK', 'NCHANNELS')
+    lowcutoff = config.getint('FILTERBANK', 'LOW_FREQ')
+    FORMANT = config.getint('CNN', 'FORMANT')
+    FILTERBANK_COEFFICIENTS = filters.make_erb_filters(framerate, filters.centre_freqs(framerate, nchannels,
+                                                                                       lowcutoff))
+
+    # The processes are started before the model is loaded, so that they do not hold a copy of it
+    pool = Pool(processes=workers, initializer=InitProcesses, initargs=(FILTERBANK_COEFFICIENTS,))
+    preparedFiles = PrepareBounded(pool, partial(PrepareNoisyFile, LPF=LPF, CUTOFF=CUTOFF, hop=hop, formant=FORMANT,
+                                                 plot=False), tasks, workers * PREPARED_PER_WORKER)
+    predictor = model if isinstance(model, Predictor) else Predictor(model, FORMANT)
+
+    totals = dict()
+    stats = {'batches': 0, 'predict_time': 0.}
+    startTime = time.time()
+    for evaluated, (item, fileScores) in enumerate(PredictInBatches(preparedFiles, len(tasks), predictor,
+                                                                    maxBatchMB, stats), 1):
+        # Files without any window(shorter than an input entry) have no prediction to score
+        _, confusion = ScorePredictions(item['centers'], numpy.argmax(fileScores, axis=1), item['labels'],
+                                        item['step']) if item['labels'] is not None and len(fileScores) \
+            else (None, dict())
+        AddCounts(totals, item['SNRdB'], list(confusion.values()))
+        if evaluated % max(1, len(tasks) // 10) == 0:
+            print("\t\t{}/{} noisy files done.".format(evaluated, len(tasks)))
+    pool.close()
+    pool.join()
+    evaluationTime = time.time() - startTime
+
+    results = GetAccuracies(totals)
+    os.makedirs(os.path.split(noisePath)[0] or '.', exist_ok=True)
+    with open(noisePath, 'w') as noiseCSV:
+        writer = csv.writer(noiseCSV, lineterminator='\n')
+        writer.writerow(['snr_db', 'accuracy', 'predictions', 'files'])
+        for SNRdB, result in results.items():
+            writer.writerow([SNRdB, result['accuracy'], result['predictions'], len(wavFiles)])
+
+    print("SNR(dB)\tAccuracy\tPredictions")
+    for SNRdB, result in results.items():
+        print("{}\t{}\t\t{}".format(SNRdB, 'none' if result['accuracy'] is None else
+                                    '{:.4f}'.format(result['accuracy']), result['predictions']))
+    print("Evaluated {} noisy files in {:.1f}s: {:.1f} files/s ({:.1f}s predicting, {} batches).".format(
+        len(tasks), evaluationTime, len(tasks) / evaluationTime, stats['predict_time'], stats['batches']))
+    print("Results saved as '{}'.".format(noisePath))
+    print('              Total time:', time.time() - TotalTime)
+    print('')
+    return results
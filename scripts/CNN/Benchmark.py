@@ -0,0 +1,104 @@
+"""
+This file includes the benchmark of the architectures of Models.py: for each one, a model is trained,
+then its number of parameters, its operations per input entry, its CPU inference latency
+and its validation accuracy are reported.
+"""
+import csv
+import os
+import time
+from configparser import ConfigParser
+
+import numpy
+
+from scripts.processing.LabelDataGenerator import NFORMANTS
+from .Models import MODELS, CountFLOPs
+from .Training import GetNormalizedInput, GetTestTrainIndexes, TrainOnIndexes
+
+BENCH_PATH = os.path.join('trainingData', 'bench.csv')
+
+
+def MeasureLatency(model, windows=1000, repeats=5, batchSize=256):
+    """
+    Measures the CPU inference time of a model, after a first warm-up prediction, even on a host with a GPU
+    :param model: the keras model
+    :param windows: number of input entries predicted at each measure
+    :param repeats: number of measures
+    :param batchSize: number of entries predicted at once
+    :return: the median time of the predictions of 'windows' entries, in ms
+    """
+    import tensorflow
+
+    x = numpy.random.RandomState(0).rand(*((windows,) + tuple(model.input_shape[1:]))).astype(numpy.float32)
+    # The prediction function is built again inside the CPU scope, so that its operations are placed on the CPU
+    if getattr(model, 'predict_function', None) is not None:
+        model.predict_function = None
+    times = []
+    with tensorflow.device('/CPU:0'):
+        model.predict(x, batch_size=batchSize)
+        for _ in range(repeats):
+            startTime = time.time()
+            model.predict(x, batch_size=batchSize)
+            times.append(time.time() - startTime)
+    return float(numpy.median(times)) * 1000
+
+
+def BenchModels(labelFile=None, inputFile=None, formant=None, architectures=None, epochs=None, benchFile=None):
+    """
+    Trains and benchmarks architectures on the same train and test entries
+    :param labelFile: path to a .csv label file generated by LabelDataGenerator.py
+    :param inputFile: path to a .npy file tensor of Nx11x128 values
+    :param formant: index of the formant(1-4) to train on, by default the FORMANT of the configuration file.
+                    If 0, benchmarks multi-output models.
+    :param architectures: names of the benchmarked architectures, by default all the ones of Models.MODELS
+    :param epochs: maximum number of epochs of each training, by default the EPOCHS of the configuration file
+    :param benchFile: path to the results csv file, by default trainingData/bench.csv
+    """
+    import keras
+
+    TotalTime = time.time()
+    config = ConfigParser()
+    config.read('configF2CNN.conf')
+    formant = config.getint('CNN', 'FORMANT') if formant is None else formant
+    inputPath = inputFile or os.path.join('trainingData', 'last_input_data.npy')
+    labelPath = labelFile or os.path.join('trainingData', 'label_data.csv')
+    benchPath = benchFile or BENCH_PATH
+    architectures = architectures or sorted(MODELS.keys())
+    unknown = set(architectures) - set(MODELS.keys())
+    if unknown:
+        print("Unknown architectures: {}, available: {}".format(', '.join(sorted(unknown)),
+                                                                ', '.join(sorted(MODELS.keys()))))
+        exit(-1)
+    heads = None if formant != 0 else ['F{}'.format(k + 1) for k in range(NFORMANTS)]
+    parameters = {'batch_size': config.getint('CNN', 'BATCH_SIZE'), 'epochs': epochs or config.getint('CNN', 'EPOCHS')}
+    print("\n###############################\nBenchmarking architectures: {}".format(', '.join(architectures)))
+
+    inputPath = GetNormalizedInput(inputPath)
+    testIndexes, y_test, trainIndexes, y_train = GetTestTrainIndexes(labelPath, formant)
+
+    results = []
+    for architecture in architectures:
+        startTime = time.time()
+        model, history, score = TrainOnIndexes(inputPath, trainIndexes, y_train, testIndexes, y_test, heads,
+                                               architecture=architecture, **parameters)
+        score = dict(zip(model.metrics_names, score))
+        accuracies = [value for name, value in score.items() if name.endswith('acc')]
+        result = {'architecture': architecture, 'params': model.count_params(), 'flops': CountFLOPs(model),
+                  'ms_per_1k': MeasureLatency(model), 'val_acc': float(numpy.mean(accuracies)),
+                  'epochs_run': len(history.history['loss']), 'time': time.time() - startTime}
+        print("{architecture}: {params} parameters, {flops} FLOPs, {ms_per_1k:.1f}ms per 1k windows, "
+              "accuracy {val_acc:.4f}".format(**result))
+        results.append(result)
+        keras.backend.clear_session()
+
+    os.makedirs(os.path.split(benchPath)[0] or '.', exist_ok=True)
+    with open(benchPath, 'w') as benchCSV:
+        writer = csv.DictWriter(benchCSV, ['architecture', 'params', 'flops', 'ms_per_1k', 'val_acc', 'epochs_run',
+                                           'time'], lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(results)
+    print("Architecture\tParameters\tFLOPs\t\tms/1k windows\tAccuracy")
+    for result in results:
+        print("{architecture:<12}\t{params:<10}\t{flops:<10}\t{ms_per_1k:<8.1f}\t{val_acc:.4f}".format(**result))
+    print("Results saved as '{}'.".format(benchPath))
+    print('              Total time:', time.time() - TotalTime)
+    print('')
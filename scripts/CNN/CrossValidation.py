@@ -0,0 +1,143 @@
+"""
+This file includes the speaker independent k-fold cross-validation runner:
+the speakers are split into k disjoint folds, and each fold is used once as test set for a training
+on all the other folds. Each training is early stopped on some of its own training speakers, held out for validation,
+its test fold being only evaluated once at the end. The trainings run in parallel processes, all memory mapping the same normalized input file.
+"""
+import csv
+import os
+import time
+from configparser import ConfigParser
+from multiprocessing import cpu_count, get_context
+
+import numpy
+
+from scripts.processing.LabelDataGenerator import LoadLabelIndex, NFORMANTS
+from .Sweep import LimitThreads
+from .Training import GetNormalizedInput, GetFormantSigns, TrainOnIndexes, SplitValidationSpeakers, \
+    GetValidationScores
+
+CV_DIR = os.path.join('trainingData', 'cv')
+
+
+def BuildSpeakerFolds(index, k=5, seed=None, valid=None):
+    """
+    Splits the entries of a label index into k folds, all the entries of a speaker being in the same fold.
+    The speakers are taken in a random order, each one going to the fold with the fewest entries so far.
+    :param index: label index, see LabelDataGenerator.LoadLabelIndex
+    :param k: number of folds
+    :param seed: seed of the random order of the speakers
+    :param valid: mask of the entries to use, all of them by default
+    :return: list of k arrays of increasing entry indexes
+    """
+    valid = numpy.ones(len(index), dtype=bool) if valid is None else valid
+    # Speakers are identified by their region and their ID
+    speakers = numpy.char.add(numpy.char.add(index['region'][valid], b'.'), index['speaker'][valid])
+    names, speakerOfEntry, counts = numpy.unique(speakers, return_inverse=True, return_counts=True)
+    if len(names) < k:
+        raise ValueError("Only {} speakers for {} folds".format(len(names), k))
+
+    foldOfSpeaker = numpy.zeros(len(names), dtype=int)
+    sizes = numpy.zeros(k, dtype=int)
+    for speaker in numpy.random.RandomState(seed).permutation(len(names)):
+        fold = numpy.argmin(sizes)
+        foldOfSpeaker[speaker] = fold
+        sizes[fold] += counts[speaker]
+
+    entries = numpy.flatnonzero(valid)
+    foldOfEntry = foldOfSpeaker[speakerOfEntry.ravel()]
+    return [entries[foldOfEntry == fold] for fold in range(k)]
+
+
+def RunFold(fold, trainIndexes, y_train, validation, testIndexes, y_test, inputPath, heads, parameters):
+    """
+    Trains and evaluates the model of one fold, in a worker process
+    :param fold: number of the fold
+    :param trainIndexes: indexes of the training entries, with y_train their labels
+    :param validation: mask of the training entries held out for the early stopping, see SplitValidationSpeakers
+    :param testIndexes: indexes of the entries of the fold, with y_test their labels
+    :param inputPath: path to the normalized input file, memory mapped
+    :param heads: names of the outputs of a multi-output model, None for a single output
+    :param parameters: dict of hyperparameters, see Training.TrainOnIndexes
+    :return: dict of the results of the fold
+    """
+    startTime = time.time()
+    model, history, score = TrainOnIndexes(inputPath, trainIndexes[~validation], y_train[~validation], testIndexes,
+                                           y_test, heads, normalized=True, validationIndexes=trainIndexes[validation],
+                                           y_validation=y_train[validation], **parameters)
+    valLoss, valAcc = GetValidationScores(history)
+    score = dict(zip(model.metrics_names, score))
+    accuracies = [value for name, value in score.items() if name.endswith('acc')]
+    result = {'fold': fold, 'test_acc': float(numpy.mean(accuracies)), 'test_loss': score['loss'], 'val_acc': valAcc,
+              'val_loss': valLoss, 'train_entries': int((~validation).sum()), 'val_entries': int(validation.sum()),
+              'test_entries': len(testIndexes),
+              'epochs_run': len(history.history['loss']), 'time': time.time() - startTime}
+    print("Fold {} done: accuracy {:.4f} in {:.1f}s".format(fold, result['test_acc'], result['time']))
+    return result
+
+
+def CrossValidate(labelFile=None, inputFile=None, formant=None, folds=5, parallel=2, threads=None, seed=0):
+    """
+    Runs a speaker independent k-fold cross-validation, on all the entries whatever their TIMIT TEST/TRAIN split
+    :param labelFile: path to a .csv label file generated by LabelDataGenerator.py
+    :param inputFile: path to a .npy file tensor of Nx11x128 values
+    :param formant: index of the formant(1-4) to train on, by default the FORMANT of the configuration file.
+                    If 0, trains multi-output models.
+    :param folds: number of folds
+    :param parallel: number of folds trained at the same time
+    :param threads: number of threads of each training, by default the cpus are shared between the trainings
+    :param seed: seed of the distribution of the speakers into the folds
+    """
+    TotalTime = time.time()
+    config = ConfigParser()
+    config.read('configF2CNN.conf')
+    formant = config.getint('CNN', 'FORMANT') if formant is None else formant
+    inputPath = inputFile or os.path.join('trainingData', 'last_input_data.npy')
+    labelPath = labelFile or os.path.join('trainingData', 'label_data.csv')
+    threads = threads or max(1, cpu_count() // parallel)
+    heads = None if formant != 0 else ['F{}'.format(k + 1) for k in range(NFORMANTS)]
+    parameters = {'batch_size': config.getint('CNN', 'BATCH_SIZE'), 'epochs': config.getint('CNN', 'EPOCHS')}
+
+    index = LoadLabelIndex(labelPath)
+    signs, valid = GetFormantSigns(index, formant)
+    foldIndexes = BuildSpeakerFolds(index, folds, seed, valid)
+    print("\n###############################\nCross-validating on {} folds of {} entries, {} at a time with {} "
+          "threads each.".format(folds, ', '.join(str(len(indexes)) for indexes in foldIndexes), parallel, threads))
+
+    # Normalized once, then memory mapped by all the trainings
+    inputPath = GetNormalizedInput(inputPath)
+
+    arguments = []
+    for fold, testIndexes in enumerate(foldIndexes):
+        trainIndexes = numpy.sort(numpy.concatenate([indexes for other, indexes in enumerate(foldIndexes)
+                                                     if other != fold]))
+        # Validation speakers are taken among the training speakers, never from the test fold
+        validation = SplitValidationSpeakers(index, trainIndexes, seed=seed)
+        arguments.append((fold, trainIndexes, signs[trainIndexes], validation, testIndexes, signs[testIndexes],
+                          inputPath, heads, parameters))
+
+    # Separate processes, started without tensorflow, each one used for a single fold
+    pool = get_context('spawn').Pool(processes=parallel, initializer=LimitThreads, initargs=(threads,),
+                                     maxtasksperchild=1)
+    results = pool.starmap(RunFold, arguments, chunksize=1)
+    pool.close()
+    pool.join()
+
+    os.makedirs(CV_DIR, exist_ok=True)
+    resultsPath = os.path.join(CV_DIR, 'folds.csv')
+    with open(resultsPath, 'w') as resultsFile:
+        writer = csv.DictWriter(resultsFile, ['fold', 'test_acc', 'test_loss', 'val_acc', 'val_loss', 'train_entries',
+                                              'val_entries', 'test_entries', 'epochs_run', 'time'],
+                                lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(results)
+
+    accuracies = [result['test_acc'] for result in results]
+    for result in results:
+        print("Fold {}:\taccuracy {:.4f}\t{} test entries\t{:.1f}s".format(result['fold'], result['test_acc'],
+                                                                          result['test_entries'], result['time']))
+    print("Accuracy: {:.4f} +- {:.4f} (mean +- std over {} folds)".format(numpy.mean(accuracies),
+                                                                         numpy.std(accuracies), folds))
+    print("Results saved as '{}'.".format(resultsPath))
+    print('              Total time:', time.time() - TotalTime)
+    print('')
@@ -0,0 +1,246 @@
+"""
+This file includes the data parallel training on one host: N worker processes each train a replica of the model
+on a disjoint shard of the memory mapped input file, their gradients being averaged at each step by the
+collective operations of tensorflow's multi-worker strategy, over the loopback interface.
+It also includes the measurement of the scaling of this training with the number of workers.
+"""
+import csv
+import json
+import os
+import shutil
+import socket
+import tempfile
+import time
+from configparser import ConfigParser
+from multiprocessing import cpu_count, get_context
+
+import numpy
+
+from .Sweep import LimitThreads
+from .Training import GetNormalizedInput, GetTestTrainIndexes, BuildModel, CompileModel, InputBatchReader
+
+SCALING_PATH = os.path.join('trainingData', 'scaling.csv')
+
+
+def GetFreePorts(count):
+    """
+    :param count: number of ports
+    :return: list of free TCP ports of the loopback interface
+    """
+    sockets = [socket.socket(socket.AF_INET, socket.SOCK_STREAM) for _ in range(count)]
+    for sock in sockets:
+        sock.bind(('localhost', 0))
+    ports = [sock.getsockname()[1] for sock in sockets]
+    for sock in sockets:
+        sock.close()
+    return ports
+
+
+def GetShard(indexes, signs, worker, workers):
+    """
+    Gives the shard of a worker: contiguous entries, for local reads in the memory mapped input file
+    :param indexes: increasing indexes of the entries, with signs their labels
+    :param worker: index of the worker
+    :param workers: number of workers
+    :return: the indexes and labels of the worker's entries
+    """
+    bounds = numpy.linspace(0, len(indexes), workers + 1).astype(int)
+    return indexes[bounds[worker]:bounds[worker + 1]], signs[bounds[worker]:bounds[worker + 1]]
+
+
+def GetStepsPerWorker(entries, workers, batch_size, name='training'):
+    """
+    Gives the number of minibatches per epoch of each worker, the same for all the workers
+    :param entries: number of entries shared by the workers
+    :param workers: number of workers
+    :param batch_size: number of entries in the minibatches of each worker
+    :param name: name of the entries, for the error message
+    :return: the number of minibatches, the few entries left by the shortest shard not being used
+    """
+    steps = entries // workers // batch_size
+    if steps == 0:
+        raise ValueError("{} {} entries are not enough for {} workers with minibatches of {} entries, at least {} are "
+                         "needed: use fewer workers or a smaller BATCH_SIZE".format(entries, name, workers, batch_size,
+                                                                                   workers * batch_size))
+    return steps
+
+
+def ShardDataset(tensorflow, sequence, steps):
+    """
+    Gives a tensorflow dataset repeating the first 'steps' minibatches of a sequence, reshuffled at each epoch
+    :param tensorflow: the tensorflow module
+    :param sequence: the Training.InputBatchReader of the shard
+    :param steps: number of minibatches per epoch, the same for all the workers
+    :return: the dataset, not sharded again by tensorflow
+    """
+    def batches():
+        while True:
+            for batch in range(steps):
+                yield sequence[batch]
+            sequence.on_epoch_end()
+
+    x, y = sequence[0]
+    dataset = tensorflow.data.Dataset.from_generator(
+        batches, (tensorflow.float32, tensorflow.float32),
+        (tensorflow.TensorShape((None,) + x.shape[1:]), tensorflow.TensorShape((None,) + y.shape[1:])))
+    options = tensorflow.data.Options()
+    options.experimental_distribute.auto_shard_policy = tensorflow.data.experimental.AutoShardPolicy.OFF
+    return dataset.with_options(options)
+
+
+def RunWorker(worker, ports, inputPath, labelPath, formant, batch_size, epochs, threads, modelPath,
+              architecture='baseline'):
+    """
+    Trains the model replica of one worker, in a separate process
+    :param worker: index of the worker, the worker 0 being the chief saving the model
+    :param ports: loopback ports of all the workers
+    :param inputPath: path to the normalized input file, memory mapped
+    :param labelPath: path to the label data
+    :param formant: index of the formant(1-4) to train on
+    :param batch_size: number of entries in the minibatches of each worker
+    :param epochs: number of epochs
+    :param threads: number of threads of the worker
+    :param modelPath: path of the trained model, saved by the chief
+    :param architecture: name of the architecture of the model, see Models.MODELS
+    :return: dict of the results of the worker
+    """
+    workers = len(ports)
+    os.environ['TF_CONFIG'] = json.dumps({'cluster': {'worker': ['localhost:{}'.format(port) for port in ports]},
+                                          'task': {'type': 'worker', 'index': worker}})
+    LimitThreads(threads)
+    import tensorflow
+
+    strategy = getattr(tensorflow.distribute, 'MultiWorkerMirroredStrategy', None) or \
+        tensorflow.distribute.experimental.MultiWorkerMirroredStrategy
+    strategy = strategy()
+
+    testIndexes, y_test, trainIndexes, y_train = GetTestTrainIndexes(labelPath, formant)
+    # All the workers run the same number of steps
+    trainSteps = GetStepsPerWorker(len(trainIndexes), workers, batch_size)
+    testSteps = GetStepsPerWorker(len(testIndexes), workers, batch_size, 'test')
+    # Read through tensorflow datasets only, the workers do not depend on the standalone keras package
+    trainSequence = InputBatchReader(inputPath, *GetShard(trainIndexes, y_train, worker, workers), batch_size,
+                                     shuffleBuffer=10000, normalized=True, seed=worker)
+    testSequence = InputBatchReader(inputPath, *GetShard(testIndexes, y_test, worker, workers), batch_size,
+                                    normalized=True)
+
+    with strategy.scope():
+        input_shape = numpy.load(inputPath, mmap_mode='r').shape[1:] + (1,)
+        model = CompileModel(BuildModel(input_shape, 2, backend=tensorflow.keras, architecture=architecture),
+                             backend=tensorflow.keras)
+
+    startTime = time.time()
+    history = model.fit(ShardDataset(tensorflow, trainSequence, trainSteps), epochs=epochs,
+                        steps_per_epoch=trainSteps, verbose=2 if worker == 0 else 0)
+    trainTime = time.time() - startTime
+    score = model.evaluate(ShardDataset(tensorflow, testSequence, testSteps), steps=testSteps, verbose=0)
+
+    # All the workers take part in the saving, only the chief's copy is kept
+    if worker == 0:
+        model.save(modelPath)
+    else:
+        temporaryDir = tempfile.mkdtemp()
+        model.save(os.path.join(temporaryDir, 'model'))
+        shutil.rmtree(temporaryDir, ignore_errors=True)
+
+    score = dict(zip(model.metrics_names, score))
+    accuracies = [value for name, value in score.items() if name.endswith('acc') or name.endswith('accuracy')]
+    return {'worker': worker, 'train_time': trainTime, 'samples': trainSteps * batch_size * epochs,
+            'test_acc': float(numpy.mean(accuracies)), 'test_loss': score['loss'],
+            'epochs_run': len(history.history['loss'])}
+
+
+def TrainDataParallel(labelFile=None, inputFile=None, formant=None, workers=2, threads=None, epochs=None,
+                      modelPath='last_trained_model', architecture='baseline'):
+    """
+    Trains the CNN with several worker processes on this host, each one on a shard of the entries,
+    the minibatch of a step being made of the minibatches of all the workers
+    :param labelFile: path to a .csv label file generated by LabelDataGenerator.py
+    :param inputFile: path to a .npy file tensor of Nx11x128 values
+    :param formant: index of the formant(1-4) to train on, by default the FORMANT of the configuration file
+    :param workers: number of worker processes
+    :param threads: number of threads of each worker, by default the cpus are shared between the workers
+    :param epochs: number of epochs, by default the EPOCHS of the configuration file
+    :param modelPath: path of the trained model
+    :param architecture: name of the architecture of the model, see Models.MODELS
+    :return: dict of the results of the training
+    """
+    TotalTime = time.time()
+    config = ConfigParser()
+    config.read('configF2CNN.conf')
+    formant = config.getint('CNN', 'FORMANT') if formant is None else formant
+    if formant == 0:
+        print("Data parallel training is only available for single formant models.")
+        exit(-1)
+    batch_size = config.getint('CNN', 'BATCH_SIZE')
+    epochs = epochs or config.getint('CNN', 'EPOCHS')
+    inputPath = inputFile or os.path.join('trainingData', 'last_input_data.npy')
+    labelPath = labelFile or os.path.join('trainingData', 'label_data.csv')
+    threads = threads or max(1, cpu_count() // workers)
+    print("\n###############################\nData parallel training on {} workers with {} threads each, "
+          "global minibatches of {} entries.".format(workers, threads, workers * batch_size))
+
+    # Checked before starting the workers
+    testIndexes, _, trainIndexes, _ = GetTestTrainIndexes(labelPath, formant)
+    GetStepsPerWorker(len(trainIndexes), workers, batch_size)
+    GetStepsPerWorker(len(testIndexes), workers, batch_size, 'test')
+
+    # Normalized once, then memory mapped by all the workers
+    inputPath = GetNormalizedInput(inputPath)
+    ports = GetFreePorts(workers)
+
+    # Separate processes, started without tensorflow, running all at the same time
+    pool = get_context('spawn').Pool(processes=workers, maxtasksperchild=1)
+    arguments = [(worker, ports, inputPath, labelPath, formant, batch_size, epochs, threads, modelPath,
+                  architecture) for worker in range(workers)]
+    results = pool.starmap(RunWorker, arguments, chunksize=1)
+    pool.close()
+    pool.join()
+
+    trainTime = max(result['train_time'] for result in results)
+    samples = sum(result['samples'] for result in results)
+    result = {'workers': workers, 'threads': threads, 'train_time': trainTime, 'samples_per_sec': samples / trainTime,
+              'test_acc': results[0]['test_acc'], 'test_loss': results[0]['test_loss'],
+              'epochs_run': results[0]['epochs_run']}
+    print("Trained {} samples in {:.1f}s: {:.0f} samples/s, test accuracy {:.4f}.".format(
+        samples, trainTime, result['samples_per_sec'], result['test_acc']))
+    print("Model saved as a keras file '{}'.".format(modelPath))
+    print('              Total time:', time.time() - TotalTime)
+    print('')
+    return result
+
+
+def MeasureScaling(labelFile=None, inputFile=None, formant=None, workerCounts=(1, 2, 4, 8), threads=None, epochs=1,
+                   scalingFile=None):
+    """
+    Measures the throughput of the data parallel training for several numbers of workers,
+    each worker having the same number of threads whatever the number of workers
+    :param labelFile: path to a .csv label file generated by LabelDataGenerator.py
+    :param inputFile: path to a .npy file tensor of Nx11x128 values
+    :param formant: index of the formant(1-4) to train on, by default the FORMANT of the configuration file
+    :param workerCounts: numbers of workers measured
+    :param threads: number of threads of each worker, by default the cpus divided by the largest number of workers
+    :param epochs: number of epochs of each measured training
+    :param scalingFile: path to the results csv file, by default trainingData/scaling.csv
+    """
+    threads = threads or max(1, cpu_count() // max(workerCounts))
+    scalingPath = scalingFile or SCALING_PATH
+    results = []
+    for workers in workerCounts:
+        result = TrainDataParallel(labelFile, inputFile, formant, workers, threads, epochs,
+                                   modelPath=os.path.join('trainingData', 'scaling_model'))
+        result['speedup'] = result['samples_per_sec'] / results[0]['samples_per_sec'] if results else 1.
+        result['efficiency'] = result['speedup'] * workerCounts[0] / workers
+        results.append(result)
+
+    os.makedirs(os.path.split(scalingPath)[0] or '.', exist_ok=True)
+    with open(scalingPath, 'w') as scalingCSV:
+        writer = csv.DictWriter(scalingCSV, ['workers', 'threads', 'samples_per_sec', 'speedup', 'efficiency',
+                                             'train_time', 'epochs_run', 'test_acc', 'test_loss'],
+                                lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(results)
+    print("Workers\tThreads\tSamples/s\tSpeedup\tEfficiency")
+    for result in results:
+        print("{workers}\t{threads}\t{samples_per_sec:.0f}\t\t{speedup:.2f}\t{efficiency:.2f}".format(**result))
+    print("Scaling measurements saved as '{}'.".format(scalingPath))
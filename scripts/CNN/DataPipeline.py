@@ -0,0 +1,85 @@
+"""
+This file includes the streaming input pipeline used for training on datasets bigger than the memory:
+minibatches are read from the memory mapped input tensor, normalized by background workers,
+and prefetched ahead of the model by keras.
+It also includes the callbacks reporting the throughput of the training and saving its checkpoints.
+"""
+import json
+import os
+import resource
+import sys
+import time
+
+import keras
+import numpy
+
+from .Training import InputBatchReader
+
+
+class InputSequence(InputBatchReader, keras.utils.Sequence):
+    """
+    Keras sequence of minibatches read from a memory mapped Nx11x128 input tensor,
+    or from several ones seen as a single tensor, one after the other, see Training.InputBatchReader
+    """
+
+
+class ThroughputCallback(keras.callbacks.Callback):
+    """
+    Reports, at each epoch, the number of training samples processed per second, the wall time of the epoch
+    and the peak resident memory of the process, adding them to the logs of the epoch
+    """
+
+    def __init__(self, samplesPerEpoch):
+        super(ThroughputCallback, self).__init__()
+        self.samplesPerEpoch = samplesPerEpoch
+        self.epochStart = None
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epochStart = time.time()
+
+    def on_epoch_end(self, epoch, logs=None):
+        epochTime = time.time() - self.epochStart
+        samplesPerSecond = self.samplesPerEpoch / epochTime
+        peakRSS = GetPeakRSS()
+        print("Epoch {}: {:.0f} samples/s, {:.1f}s, peak RSS {:.0f}MB".format(epoch + 1, samplesPerSecond, epochTime,
+                                                                             peakRSS))
+        if logs is not None:
+            logs['samples_per_sec'] = samplesPerSecond
+            logs['epoch_time'] = epochTime
+            logs['peak_rss_mb'] = peakRSS
+
+
+class CheckpointCallback(keras.callbacks.Callback):
+    """
+    Saves the model, along with its optimizer state, every 'period' epochs, so that the training can be resumed
+    """
+
+    def __init__(self, checkpointPath, period=1, info=None):
+        """
+        :param checkpointPath: path of the saved model, the number of epochs done being saved in checkpointPath.json
+        :param period: number of epochs between two checkpoints
+        :param info: dict of additional information saved with the number of epochs
+        """
+        super(CheckpointCallback, self).__init__()
+        self.checkpointPath = checkpointPath
+        self.period = period
+        self.info = info or dict()
+
+    def on_epoch_end(self, epoch, logs=None):
+        if (epoch + 1) % self.period:
+            return
+        # Written aside then moved, an interrupted save keeps the previous checkpoint
+        self.model.save(self.checkpointPath + '.tmp')
+        os.replace(self.checkpointPath + '.tmp', self.checkpointPath)
+        with open(self.checkpointPath + '.json', 'w') as infoFile:
+            json.dump(dict(self.info, epoch=epoch + 1), infoFile)
+        print("Epoch {}: checkpoint saved as '{}'.".format(epoch + 1, self.checkpointPath))
+
+
+def GetPeakRSS():
+    """
+    :return: the peak resident memory of the process, in MB
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # In kilobytes on Linux, in bytes on macOS
+    return peak / (1024. * 1024.) if sys.platform == 'darwin' else peak / 1024.
@@ -4,7 +4,6 @@ This file includes functions allowing to evaluate the neural network on files, g
 
 """
 
-import glob
 import os
 import time
 from configparser import ConfigParser
@@ -19,13 +18,137 @@ from scripts.plotting.PlottingCNN import PlotEnvelopesAndCNNResultsWithPhonemes
 from scripts.processing.EnvelopeExtraction import ExtractEnvelopeFromMatrix
 from scripts.processing.FBFileReader import ExtractFBFile
 from scripts.processing.GammatoneFiltering import GetArrayFromWAV, GetFilteredOutputFromArray
-from scripts.processing.LabelDataGenerator import ExtractLabel
+from scripts.processing.InputGenerator import GetStridedWindows
+from scripts.processing.Manifest import GetOrganisedFiles
+from scripts.processing.NoiseAugmentation import SNRdbToSNRlinear, RMS
+from scripts.processing.LabelDataGenerator import ExtractLabel, GetFormantColumns, UNKNOWN_SIGN
 from scripts.processing.PHNFileReader import ExtractPhonemes
-from .Training import normalizeInput
+from .Training import normalizeInputBatch
+
+
+def PredictWindows(model, windows, maxBatchMB=64, formant=2, normalized=False):
+    """
+    Predicts input entries chunk by chunk: each chunk is converted to float32, normalized and predicted
+    before the next one, so that the memory used does not depend on the number of entries
+    :param model: the keras model
+    :param windows: the N x 11 x 128 entries, like the strided view given by InputGenerator.GetStridedWindows
+    :param maxBatchMB: maximum size of a chunk of float32 entries, in MB
+    :param formant: index of the formant(1-4) whose output is used, for multi-output models
+    :param normalized: True if the entries are already normalized, see Training.normalizeInputBatch
+    :return: the N x 2 predictions, number of constant entries, and number of entries with non positive values
+    """
+    if len(windows) == 0:  # No prediction, like for a file shorter than an input entry
+        return numpy.empty((0, 2), numpy.float32), 0, 0
+    chunkSize = max(1, int(maxBatchMB * 1024 * 1024 // (numpy.prod(windows.shape[1:]) * 4)))
+    scores = None
+    constant, nonPositive = 0, 0
+    for start in range(0, len(windows), chunkSize):
+        chunk = windows[start:start + chunkSize]
+        x = numpy.empty(chunk.shape + (1,), dtype=numpy.float32)
+        x[..., 0] = chunk
+        if not normalized:
+            counts = normalizeInputBatch(x)
+            constant, nonPositive = constant + counts[0], nonPositive + counts[1]
+        chunkScores = model.predict(x)
+        if isinstance(chunkScores, list):  # Multi-output model, with one output per formant
+            chunkScores = chunkScores[formant - 1]
+        if scores is None:
+            scores = numpy.empty((len(windows), chunkScores.shape[1]), dtype=numpy.float32)
+        scores[start:start + len(x)] = chunkScores
+    return scores, constant, nonPositive
+
+
+class Predictor:
+    """
+    Keras model loaded once, and reused for the evaluation of many files
+    """
+
+    def __init__(self, model='last_trained_model', formant=None):
+        """
+        :param model: path to the keras model file
+        :param formant: index of the formant(1-4) whose output is used for multi-output models,
+                        by default the FORMANT of the configuration file
+        """
+        import keras
+
+        config = ConfigParser()
+        config.read('configF2CNN.conf')
+        self.path = model
+        self.formant = config.getint('CNN', 'FORMANT') if formant is None else formant
+        print("Loading model '{}'...".format(model))
+        self.model = keras.models.load_model(model)
+        self.warmUp()
+
+    def warmUp(self):
+        """
+        Runs a first prediction, so that keras builds its prediction function before the evaluations
+        """
+        self.model.predict(numpy.zeros((1,) + tuple(self.model.input_shape[1:]), dtype=numpy.float32))
+
+    def predict(self, windows, maxBatchMB=64, normalized=False):
+        """
+        :param windows: the N x 11 x 128 entries, see PredictWindows
+        :param maxBatchMB: maximum size of the entries predicted at once, in MB
+        :param normalized: True if the entries are already normalized
+        :return: the N x 2 predictions, number of constant entries, and number of entries with non positive values
+        """
+        return PredictWindows(self.model, windows, maxBatchMB, self.formant, normalized)
+
+
+def GetFileLabels(wavFileName, config, formant):
+    """
+    Gives the labels of a file with a clear slope for a formant, for accuracy computation
+    :param wavFileName: path to the .WAV file, with its .FB and .PHN files next to it
+    :param config: the loaded configuration
+    :param formant: index of the formant(1-4)
+    :return: arrays of the frames, signs and phonemes of the labels, or None if the file cannot be labelled
+    """
+    labels = ExtractLabel(wavFileName, config)
+    if labels is None:
+        return None
+    signColumn = GetFormantColumns(formant)[2]
+    labels = [entry for entry in labels if entry[signColumn] != UNKNOWN_SIGN]
+    return (numpy.array([entry[5] for entry in labels], dtype=int),
+            numpy.array([entry[signColumn] for entry in labels], dtype=int),
+            numpy.array([entry[4] for entry in labels], dtype=str))
+
+
+def ScorePredictions(centers, predictions, labels, maxDistance):
+    """
+    Scores the predictions of a file: each prediction is matched to the nearest label, found by a binary search
+    in the label frames, and counted if they are less than maxDistance frames apart
+    :param centers: frames of the predicted entries
+    :param predictions: predicted classes of the entries, 0 for falling and 1 for rising
+    :param labels: frames, signs and phonemes of the labels, see GetFileLabels
+    :param maxDistance: maximum number of frames between a prediction and its label
+    :return: the accuracy(None if no prediction is matched), and the confusion table of each phoneme as a dict of
+             {phoneme: 2x2 array of counts indexed by [label sign, predicted class]}
+    """
+    timepoints, signs, phonemes = labels
+    if len(timepoints) == 0 or len(centers) == 0:
+        return None, dict()
+    order = numpy.argsort(timepoints, kind='mergesort')
+    timepoints, signs, phonemes = timepoints[order], signs[order], phonemes[order]
+    centers, predictions = numpy.asarray(centers), numpy.asarray(predictions, dtype=int)
+
+    # Labels right after and right before each prediction, the one before being kept when equally close
+    after = numpy.searchsorted(timepoints, centers).clip(0, len(timepoints) - 1)
+    before = (after - 1).clip(0)
+    nearest = numpy.where(numpy.abs(centers - timepoints[before]) <= numpy.abs(timepoints[after] - centers),
+                          before, after)
+    matched = numpy.abs(timepoints[nearest] - centers) < maxDistance
+    if not matched.any():
+        return None, dict()
+    truth, predictions, nearest = signs[nearest[matched]], predictions[matched], nearest[matched]
+
+    names, phonemeIndexes = numpy.unique(phonemes[nearest], return_inverse=True)
+    counts = numpy.zeros((len(names), 2, 2), dtype=int)
+    numpy.add.at(counts, (phonemeIndexes.ravel(), truth, predictions), 1)
+    return float(numpy.mean(truth == predictions)), dict(zip(names.tolist(), counts))
 
 
 def EvaluateOneWavArray(wavArray, framerate, wavFileName, model='last_trained_model', LPF=False, CUTOFF=100,CENTER_FREQUENCIES=None,
-                        FILTERBANK_COEFFICIENTS=None):
+                        FILTERBANK_COEFFICIENTS=None, hop=None, maxBatchMB=64):
     # #### READING CONFIG FILE
     config = ConfigParser()
     config.read('configF2CNN.conf')
@@ -35,9 +158,10 @@ def EvaluateOneWavArray(wavArray, framerate, wavFileName, model='last_trained_mo
     DOTSPERINPUT = RADIUS * 2 + 1
     USTOS = 1 / 1000000.
 
+    FORMANT = config.getint('CNN', 'FORMANT')
+
     # Extracting labels, for accuracy computation
-    labels = ExtractLabel(wavFileName, config)
-    labels = [(entry[-4], entry[-1]) for entry in labels] if labels is not None else None
+    labels = GetFileLabels(wavFileName, config, FORMANT)
 
     if CENTER_FREQUENCIES is None:
         NCHANNELS = config.getint('FILTERBANK', 'NCHANNELS')
@@ -61,7 +185,8 @@ def EvaluateOneWavArray(wavArray, framerate, wavFileName, model='last_trained_mo
 
     print("Extracting Formants...")
     fbPath = os.path.splitext(wavFileName)[0] + '.FB'
-    formants, sampPeriod = ExtractFBFile(fbPath)
+    # One frame per label period, like the formants plotted with the results
+    formants, _ = ExtractFBFile(fbPath, period=SAMPPERIOD)
 
     print("Extracting Phonemes...")
     phnPath = os.path.splitext(wavFileName)[0] + '.PHN'
@@ -69,52 +194,41 @@ def EvaluateOneWavArray(wavArray, framerate, wavFileName, model='last_trained_mo
 
     print("Generating input data for CNN...")
     STEP = int(framerate * SAMPPERIOD * USTOS)
-    START = int(STEP * RADIUS)
-    nb = int(len(envelopes[0]) - DOTSPERINPUT*STEP)
-    input_data = numpy.zeros([nb, DOTSPERINPUT, NCHANNELS])
-    print("INPUT SHAPE:", input_data.shape)
-    for i in range(0, nb):
-        input_data[i] = [[channel[START + i + (k - RADIUS) * STEP] for channel in envelopes] for k in
-                         range(DOTSPERINPUT)]
-    for i, matrix in enumerate(input_data):
-        input_data[i] = normalizeInput(matrix)
-    input_data.astype('float32')
+    # One entry every label frame period by default
+    hop = hop or STEP
+    centers, windows = GetStridedWindows(envelopes, RADIUS, STEP, hop)
+    print("INPUT SHAPE:", windows.shape)
+    if len(centers) == 0:
+        print("No window: '{}' is shorter than an input entry ({} samples), nothing to evaluate.".format(
+            wavFileName, 2 * RADIUS * STEP + 1))
+        return None, dict()
 
     print("Evaluating the data with the pretrained model...")
-    import keras
-    model = keras.models.load_model(model)
-    scores = model.predict(input_data.reshape(nb, DOTSPERINPUT, NCHANNELS, 1), verbose=1)
-    simplified_scores = [1 if score[1] > score[0] else 0 for score in scores]
-    # Attempt to compute an accuracy for the file. TODO: Doesn't take into account phonemes we use, step values
-    keras.backend.clear_session()
-    del model
-    del input_data
-    accuracy = None
-    if labels is not None:
-        accuracy = 0
-        total_valid = 0
-        for timepoint, score in enumerate(simplified_scores):
-            for index in range(len(labels) - 1):
-                before = labels[index][0]
-                after = labels[index + 1][0]
-                if before < timepoint < after and (abs(timepoint - before) < STEP or abs(timepoint - after) < STEP):
-                    if abs(before - timepoint) <= abs(after - timepoint):
-                        if score == labels[index][1]:
-                            accuracy += 1
-                    else:
-                        if score == labels[index + 1][1]:
-                            accuracy += 1
-                    total_valid += 1
-        accuracy /= total_valid
+    predictor = model if isinstance(model, Predictor) else Predictor(model, FORMANT)
+    scores, constant, nonPositive = predictor.predict(windows, maxBatchMB)
+    if constant or nonPositive:
+        print("{} constant inputs, {} inputs with non positive values (filled with 0).".format(constant, nonPositive))
+    del windows
+    simplified_scores = numpy.argmax(scores, axis=1)
+    # Predictions of every frame, for plotting
+    frames = numpy.arange(len(envelopes[0]))
+    scores = numpy.stack([numpy.interp(frames, centers, scores[:, k]) for k in range(scores.shape[1])], axis=1)
+    # Accuracy of the predictions close to a label, and per phoneme confusion table
+    accuracy, confusion = ScorePredictions(centers, simplified_scores, labels, STEP) if labels is not None \
+        else (None, dict())
+    if accuracy is not None:
+        print("Accuracy: {:.4f} on {} predictions".format(accuracy, sum(int(table.sum()) for table in
+                                                                        confusion.values())))
     print("Plotting...")
     PlotEnvelopesAndCNNResultsWithPhonemes(envelopes, scores, accuracy, CENTER_FREQUENCIES, phonemes, formants,
                                            wavFileName)
     del envelopes
     del phonemes
+    return accuracy, confusion
 
 
 def EvaluateOneWavFile(file, LPF=False, CUTOFF=50, model='last_trained_model', CENTER_FREQUENCIES=None,
-                       FILTERBANK_COEFFICIENTS=None):
+                       FILTERBANK_COEFFICIENTS=None, hop=None, maxBatchMB=64):
     """
     Evaluates one .WAV file with the keras model 'last_trained_model'.
     The model should take an input of Nx11x128x1, N being the number of frames in the file, minus the first and last 0.055ms.
@@ -123,19 +237,23 @@ def EvaluateOneWavFile(file, LPF=False, CUTOFF=50, model='last_trained_model', C
     :param file: Path to the evaluated file
     :param LPF: Boolean specifying if using low pass filtering for envelope extraction
     :param CUTOFF: Low Pass Filter cutoff frequency
-    :param model: the keras model file to use
+    :param model: the keras model file to use, or a Predictor already loaded
     :param CENTER_FREQUENCIES: (OPTIONAL) Center frequencies of the gammatone filterbank, used for filtering, and also for plotting a spectrogram like figure.
     :param FILTERBANK_COEFFICIENTS: (OPTIONAL) Coefficients of the gammatone filterbank. Should be constructed with the gammatone library's 'gammatone.filters.make_erb.filters' function.
+    :param hop: number of frames between the centers of two evaluated entries, by default the label sampling period
+    :param maxBatchMB: maximum size of the entries predicted at once, in MB, see PredictWindows
     """
-    print('Using model', model)
+    print('Using model', model.path if isinstance(model, Predictor) else model)
     print("File:\t\t{}".format(file))
     framerate, wavArray = GetArrayFromWAV(file)
     EvaluateOneWavArray(wavArray=wavArray, framerate=framerate, LPF=LPF, CUTOFF=CUTOFF,wavFileName=file, model=model,
-                        CENTER_FREQUENCIES=CENTER_FREQUENCIES, FILTERBANK_COEFFICIENTS=FILTERBANK_COEFFICIENTS)
+                        CENTER_FREQUENCIES=CENTER_FREQUENCIES, FILTERBANK_COEFFICIENTS=FILTERBANK_COEFFICIENTS, hop=hop,
+                        maxBatchMB=maxBatchMB)
     print("\t\t{}\tdone !".format(file))
 
 
-def EvaluateRandom(count=None, LPF=False, CUTOFF=50):
+def EvaluateRandom(count=None, LPF=False, CUTOFF=50, region=None, speakerCount=None, hop=None, maxBatchMB=64,
+                   model='last_trained_model'):
     os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'  # Silence tensorflow logs
 
     TotalTime = time.time()
@@ -145,13 +263,13 @@ def EvaluateRandom(count=None, LPF=False, CUTOFF=50):
         os.mkdir(os.path.join('graphs', 'FallingOrRising'))
 
     # Get all the WAV files under resources/fcnn
-    wavFiles = glob.glob(os.path.join('resources', 'f2cnn', '*', '*.WAV'))
-    print("\n###############################\nEvaluating network on {} WAV files in '{}'.".format(len(wavFiles),
-                                                                                                  os.path.split(
-                                                                                                      wavFiles[0])[0]))
+    wavFiles = GetOrganisedFiles('WAV', region, speakerCount)
     if not wavFiles:
         print("NO WAV FILES FOUND")
         exit(-1)
+    print("\n###############################\nEvaluating network on {} WAV files in '{}'.".format(len(wavFiles),
+                                                                                                  os.path.split(
+                                                                                                      wavFiles[0])[0]))
 
     # Reading the config file
     config = ConfigParser()
@@ -169,29 +287,19 @@ def EvaluateRandom(count=None, LPF=False, CUTOFF=50):
     elif count > 1:
         wavFiles = numpy.random.choice(wavFiles, count)
 
+    # The model is loaded once for all the files
+    predictor = model if isinstance(model, Predictor) else Predictor(model)
     for file in wavFiles:
-        EvaluateOneWavFile(file, LPF=LPF, CUTOFF=CUTOFF, CENTER_FREQUENCIES=CENTER_FREQUENCIES, FILTERBANK_COEFFICIENTS=FILTERBANK_COEFFICIENTS)
+        EvaluateOneWavFile(file, LPF=LPF, CUTOFF=CUTOFF, model=predictor, CENTER_FREQUENCIES=CENTER_FREQUENCIES, FILTERBANK_COEFFICIENTS=FILTERBANK_COEFFICIENTS,
+                           hop=hop, maxBatchMB=maxBatchMB)
 
     print("Evaluating network on all files.")
     print('              Total time:', time.time() - TotalTime)
     print('')
 
 
-def SNRdbToSNRlinear(SNRdb):
-    return 10 ** (SNRdb / 10.0)
-
-
-def RMS(signal):
-    """
-    Computes the Root Mean Square Error of a signal
-    :param signal:
-    :return:
-    """
-    return numpy.sqrt(numpy.mean(numpy.square(signal)))
-
-
 def EvaluateWithNoise(file, LPF=False, CUTOFF=100, model='last_trained_model', CENTER_FREQUENCIES=None,
-                      FILTERBANK_COEFFICIENTS=None, SNRdB=-3):
+                      FILTERBANK_COEFFICIENTS=None, SNRdB=-3, hop=None, maxBatchMB=64):
     print("File:\t\t{}".format(file))
     print("Appyling gaussian noise, new SNR is {SNR}dB".format(SNR=SNRdB))
     framerate, wavList = GetArrayFromWAV(file)
@@ -216,6 +324,7 @@ def EvaluateWithNoise(file, LPF=False, CUTOFF=100, model='last_trained_model', C
         print("No .FB or .PHN or .WRD files.")
 
     print('New noisy WAVE file saved as', newPath)
-    EvaluateOneWavArray(output, framerate, newPath, model=model, LPF=LPF, CUTOFF=CUTOFF, CENTER_FREQUENCIES=CENTER_FREQUENCIES, FILTERBANK_COEFFICIENTS=FILTERBANK_COEFFICIENTS)
+    EvaluateOneWavArray(output, framerate, newPath, model=model, LPF=LPF, CUTOFF=CUTOFF, CENTER_FREQUENCIES=CENTER_FREQUENCIES, FILTERBANK_COEFFICIENTS=FILTERBANK_COEFFICIENTS,
+                        hop=hop, maxBatchMB=maxBatchMB)
 
     print("\t\t{}\tdone !".format(file))
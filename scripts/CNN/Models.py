@@ -0,0 +1,115 @@
+"""
+This file includes the architectures of the CNN, for the 11x128x1 input entries, selectable by name.
+Each one builds the layers shared by the outputs of the model, see Training.BuildModel.
+"""
+
+import numpy
+
+
+def BaselineLayers(keras, inputs):
+    """
+    The original architecture: two blocks of two 32 and 64 filters convolutions, then a 516 units dense layer
+    :param keras: keras module used
+    :param inputs: the input tensor
+    :return: the output tensor of the shared layers
+    """
+    x = keras.layers.Conv2D(32, (3, 3), padding='same')(inputs)
+    x = keras.layers.Activation('relu')(x)
+    x = keras.layers.Conv2D(32, (3, 3))(x)
+    x = keras.layers.Activation('relu')(x)
+    x = keras.layers.MaxPooling2D(pool_size=(2, 2))(x)
+    x = keras.layers.Dropout(0.25)(x)
+
+    x = keras.layers.Conv2D(64, (3, 3), padding='same')(x)
+    x = keras.layers.Activation('relu')(x)
+    x = keras.layers.Conv2D(64, (3, 3))(x)
+    x = keras.layers.Activation('relu')(x)
+    x = keras.layers.MaxPooling2D(pool_size=(2, 2))(x)
+    x = keras.layers.Dropout(0.25)(x)
+
+    x = keras.layers.Flatten()(x)
+    x = keras.layers.Dense(516)(x)
+    x = keras.layers.Activation('relu')(x)
+    x = keras.layers.Dropout(0.5)(x)
+    return x
+
+
+def SeparableLayers(keras, inputs):
+    """
+    The baseline blocks with depthwise separable convolutions(except the first one, the input having one channel),
+    then a 128 units dense layer
+    :param keras: keras module used
+    :param inputs: the input tensor
+    :return: the output tensor of the shared layers
+    """
+    x = keras.layers.Conv2D(32, (3, 3), padding='same', activation='relu')(inputs)
+    x = keras.layers.SeparableConv2D(32, (3, 3), activation='relu')(x)
+    x = keras.layers.MaxPooling2D(pool_size=(2, 2))(x)
+    x = keras.layers.Dropout(0.25)(x)
+
+    x = keras.layers.SeparableConv2D(64, (3, 3), padding='same', activation='relu')(x)
+    x = keras.layers.SeparableConv2D(64, (3, 3), activation='relu')(x)
+    x = keras.layers.MaxPooling2D(pool_size=(2, 2))(x)
+    x = keras.layers.Dropout(0.25)(x)
+
+    x = keras.layers.Flatten()(x)
+    x = keras.layers.Dense(128, activation='relu')(x)
+    x = keras.layers.Dropout(0.5)(x)
+    return x
+
+
+def SmallLayers(keras, inputs):
+    """
+    The baseline blocks with 8 and 16 filters convolutions, then a 64 units dense layer
+    :param keras: keras module used
+    :param inputs: the input tensor
+    :return: the output tensor of the shared layers
+    """
+    x = keras.layers.Conv2D(8, (3, 3), padding='same', activation='relu')(inputs)
+    x = keras.layers.Conv2D(8, (3, 3), activation='relu')(x)
+    x = keras.layers.MaxPooling2D(pool_size=(2, 2))(x)
+    x = keras.layers.Dropout(0.25)(x)
+
+    x = keras.layers.Conv2D(16, (3, 3), padding='same', activation='relu')(x)
+    x = keras.layers.Conv2D(16, (3, 3), activation='relu')(x)
+    x = keras.layers.MaxPooling2D(pool_size=(2, 2))(x)
+    x = keras.layers.Dropout(0.25)(x)
+
+    x = keras.layers.Flatten()(x)
+    x = keras.layers.Dense(64, activation='relu')(x)
+    x = keras.layers.Dropout(0.5)(x)
+    return x
+
+
+# Architectures by name
+MODELS = {
+    'baseline': BaselineLayers,
+    'separable': SeparableLayers,
+    'small': SmallLayers
+}
+
+
+def CountFLOPs(model):
+    """
+    Counts the floating point operations of the convolution and dense layers of a model for one input entry,
+    a multiply-add being 2 operations
+    :param model: the keras model
+    :return: the number of operations
+    """
+    flops = 0
+    for layer in model.layers:
+        kind = layer.__class__.__name__
+        if kind in ('Conv2D', 'SeparableConv2D', 'DepthwiseConv2D'):
+            _, height, width, channels = layer.output_shape
+            inChannels = layer.input_shape[-1]
+            kernel = int(numpy.prod(layer.kernel_size))
+            if kind == 'Conv2D':
+                flops += 2 * height * width * kernel * inChannels * channels
+            elif kind == 'DepthwiseConv2D':
+                flops += 2 * height * width * kernel * inChannels * layer.depth_multiplier
+            else:
+                depthwise = inChannels * layer.depth_multiplier
+                flops += 2 * height * width * (kernel * depthwise + depthwise * channels)
+        elif kind == 'Dense':
+            flops += 2 * layer.input_shape[-1] * layer.units
+    return int(flops)
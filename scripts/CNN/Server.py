@@ -0,0 +1,329 @@
+"""
+This file includes the local inference server: the model and the filterbank are loaded once, then other local tools
+post audio to a HTTP endpoint, on a TCP port or a Unix socket, and get the rising/falling predictions of its windows.
+Each request is filtered and windowed in its own thread, while a single thread runs the model: the windows of the
+requests arriving within a short delay are predicted together, in one micro-batch.
+
+Endpoints:
+    POST /predict   body: a RIFF or NIST SPHERE .WAV file, or raw 16 bits little endian mono PCM
+                    sampled at the FRAMERATE of the configuration file(or at ?rate=N, which must be the same)
+                    returns {"centers": frames of the windows, "times": in seconds, "scores": [falling, rising],
+                             "decisions": 0 for falling and 1 for rising, "latency_ms": }
+    GET /stats      returns the number of requests, windows and micro-batches, and the request latency percentiles
+    GET /health     returns {"status": "ok"} once the model is loaded
+"""
+import io
+import json
+import os
+import queue
+import socketserver
+import stat
+import threading
+import time
+from collections import deque
+from configparser import ConfigParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import numpy
+from scipy.io import wavfile
+
+from gammatone import filters
+from scripts.processing.EnvelopeExtraction import ExtractEnvelopeFromMatrix
+from scripts.processing.GammatoneFiltering import GetFilteredOutputFromArray, ReadSPHHeader
+from scripts.processing.InputGenerator import GetStridedWindows
+from .Evaluating import Predictor
+from .Training import normalizeInputBatch
+
+# Number of latencies kept for the percentiles
+LATENCY_HISTORY = 10000
+
+
+def GetArrayFromBytes(data, framerate):
+    """
+    Reads the samples of audio received as bytes
+    :param data: a RIFF or NIST SPHERE .WAV file, or raw 16 bits little endian PCM
+    :param framerate: framerate of raw PCM
+    :return: framerate and int16 samples
+    """
+    if data[:4] == b'RIFF':
+        framerate, wavArray = wavfile.read(io.BytesIO(data))
+    elif data[:7] == b'NIST_1A':
+        headerSize, fields = ReadSPHHeader(io.BytesIO(data))
+        if fields.get('sample_coding', 'pcm') != 'pcm' or fields.get('sample_n_bytes', 2) != 2 \
+                or fields.get('channel_count', 1) != 1:
+            raise ValueError("Only uncompressed 16 bits mono SPHERE files are supported")
+        byteOrder = {'01': '<', '10': '>'}.get(fields.get('sample_byte_format', '01'), '<')
+        framerate, wavArray = fields['sample_rate'], numpy.frombuffer(data, byteOrder + 'i2', offset=headerSize)
+    else:
+        wavArray = numpy.frombuffer(data[:len(data) // 2 * 2], '<i2')
+    if wavArray.ndim != 1:
+        raise ValueError("Only mono audio is supported")
+    return framerate, wavArray
+
+
+class MicroBatcher:
+    """
+    Thread running the model on micro-batches: the windows of all the requests received until maxDelayMs
+    after the first one, or until maxBatchMB MB of windows, are predicted together
+    """
+
+    def __init__(self, model, formant=None, maxDelayMs=10, maxBatchMB=16):
+        """
+        :param model: path to the keras model file
+        :param formant: index of the formant(1-4) whose output is used for multi-output models
+        :param maxDelayMs: time the first request of a micro-batch waits for others, in ms
+        :param maxBatchMB: maximum size of the windows of a micro-batch, in MB
+        """
+        self.model, self.formant = model, formant
+        self.maxDelay, self.maxBatchMB = maxDelayMs / 1000., maxBatchMB
+        self.requests = queue.Queue()
+        self.batches, self.windows = 0, 0
+        self.error = None
+        self.ready = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def predict(self, windows):
+        """
+        Predicts the windows of a request, waiting for the end of its micro-batch
+        :param windows: the normalized N x 11 x 128 float32 windows
+        :return: the N x 2 predictions
+        """
+        request = {'windows': windows, 'done': threading.Event()}
+        self.requests.put(request)
+        request['done'].wait()
+        if 'error' in request:
+            raise request['error']
+        return request['scores']
+
+    def run(self):
+        # The model is loaded and only used by this thread
+        try:
+            predictor = Predictor(self.model, self.formant)
+        except Exception as error:
+            self.error = error
+            self.ready.set()
+            return
+        self.ready.set()
+        maxBytes = self.maxBatchMB * 1024 * 1024
+        while True:
+            batch = [self.requests.get()]
+            size = batch[0]['windows'].nbytes
+            deadline = time.time() + self.maxDelay
+            while size < maxBytes:
+                try:
+                    request = self.requests.get(timeout=max(0., deadline - time.time()))
+                except queue.Empty:
+                    break
+                batch.append(request)
+                size += request['windows'].nbytes
+
+            try:
+                scores, _, _ = predictor.predict(numpy.concatenate([request['windows'] for request in batch]),
+                                                 self.maxBatchMB, normalized=True)
+                bounds = numpy.cumsum([0] + [len(request['windows']) for request in batch])
+                for request, start, end in zip(batch, bounds[:-1], bounds[1:]):
+                    request['scores'] = scores[start:end]
+            except Exception as error:
+                for request in batch:
+                    request['error'] = error
+            self.batches += 1
+            self.windows += sum(len(request['windows']) for request in batch)
+            for request in batch:
+                request['done'].set()
+
+
+class F2CNNService:
+    """
+    State shared by the request threads: the filterbank, the micro-batcher and the latencies
+    """
+
+    def __init__(self, model='last_trained_model', LPF=False, CUTOFF=50, hop=None, maxDelayMs=10, maxBatchMB=16):
+        """
+        :param model: path to the keras model file
+        :param LPF: boolean for whether or not using low pass filtering
+        :param CUTOFF: cutoff frequency of the LPF
+        :param hop: number of samples between two predicted windows, by default the label frame period
+        :param maxDelayMs: time the first request of a micro-batch waits for others, in ms
+        :param maxBatchMB: maximum size of the windows of a micro-batch, in MB
+        """
+        config = ConfigParser()
+        config.read('configF2CNN.conf')
+        self.framerate = config.getint('FILTERBANK', 'FRAMERATE')
+        nchannels = config.getint('FILTERBANK', 'NCHANNELS')
+        lowcutoff = config.getint('FILTERBANK', 'LOW_FREQ')
+        self.RADIUS = config.getint('CNN', 'RADIUS')
+        self.STEP = int(self.framerate * config.getint('CNN', 'SAMPLING_PERIOD') / 1000000)
+        self.FILTERBANK_COEFFICIENTS = filters.make_erb_filters(self.framerate,
+                                                                filters.centre_freqs(self.framerate, nchannels,
+                                                                                     lowcutoff))
+        self.LPF, self.CUTOFF, self.hop = LPF, CUTOFF, hop or self.STEP
+        self.batcher = MicroBatcher(model, config.getint('CNN', 'FORMANT'), maxDelayMs, maxBatchMB)
+        self.latencies = deque(maxlen=LATENCY_HISTORY)
+        self.requestCount = 0
+        self.lock = threading.Lock()
+
+    def predict(self, data, framerate=None, record=True):
+        """
+        :param data: audio bytes, see GetArrayFromBytes
+        :param framerate: framerate of raw PCM, by default the one of the configuration file
+        :param record: if False, the request is not counted in the stats
+        :return: dict of the predictions of the windows of the audio
+        """
+        startTime = time.time()
+        framerate, wavArray = GetArrayFromBytes(data, framerate or self.framerate)
+        if framerate != self.framerate:
+            raise ValueError("Audio sampled at {}Hz, the filterbank expects {}Hz".format(framerate, self.framerate))
+        envelopes = ExtractEnvelopeFromMatrix(GetFilteredOutputFromArray(wavArray, self.FILTERBANK_COEFFICIENTS),
+                                              self.LPF, self.CUTOFF)
+        centers, windows = GetStridedWindows(envelopes, self.RADIUS, self.STEP, self.hop)
+        windows = numpy.ascontiguousarray(windows, dtype=numpy.float32)
+        # Audio shorter than an input entry has no window, and an empty result
+        if len(windows):
+            normalizeInputBatch(windows)
+            scores = self.batcher.predict(windows)
+        else:
+            scores = numpy.zeros((0, 2), dtype=numpy.float32)
+
+        latency = time.time() - startTime
+        if record:
+            with self.lock:
+                self.latencies.append(latency)
+                self.requestCount += 1
+        return {'centers': centers.tolist(), 'times': (centers / framerate).tolist(), 'scores': scores.tolist(),
+                'decisions': numpy.argmax(scores, axis=1).tolist(), 'latency_ms': latency * 1000}
+
+    def selfCheck(self):
+        """
+        Runs a request of silence and a request shorter than an input entry through the whole service,
+        before serving, without counting them in the stats
+        :return: None, or the error of a failed request
+        """
+        entry = 2 * self.RADIUS * self.STEP + 1
+        try:
+            for samples, windows in ((entry + self.hop, 2), (entry - 1, 0)):
+                result = self.predict(numpy.zeros(samples, dtype='<i2').tobytes(), record=False)
+                if len(result['scores']) != windows:
+                    return "{} windows instead of {} for {} samples".format(len(result['scores']), windows,
+                                                                            samples)
+        except Exception as error:
+            return error
+        return None
+
+    def stats(self):
+        """
+        :return: dict of the numbers of requests, windows and micro-batches, and of the latency percentiles in ms
+        """
+        with self.lock:
+            latencies = numpy.array(self.latencies) * 1000
+            requests = self.requestCount
+        stats = {'requests': requests, 'windows': self.batcher.windows, 'batches': self.batcher.batches,
+                 'windows_per_batch': self.batcher.windows / self.batcher.batches if self.batcher.batches else 0}
+        for percentile in (50, 90, 99):
+            stats['latency_p{}_ms'.format(percentile)] = float(numpy.percentile(latencies, percentile)) \
+                if len(latencies) else None
+        stats['latency_max_ms'] = float(latencies.max()) if len(latencies) else None
+        return stats
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """
+    Handles the requests of a server whose 'service' attribute is a F2CNNService
+    """
+
+    def sendJSON(self, status, content):
+        body = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == '/stats':
+            self.sendJSON(200, self.server.service.stats())
+        elif path == '/health':
+            self.sendJSON(200, {'status': 'ok'})
+        else:
+            self.sendJSON(404, {'error': 'Unknown path {}'.format(path)})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/predict':
+            self.sendJSON(404, {'error': 'Unknown path {}'.format(url.path)})
+            return
+        data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            rate = parse_qs(url.query).get('rate')
+            result = self.server.service.predict(data, int(rate[0]) if rate else None)
+        except ValueError as error:
+            self.sendJSON(400, {'error': str(error)})
+            return
+        except Exception as error:
+            self.sendJSON(500, {'error': repr(error)})
+            return
+        self.sendJSON(200, result)
+
+    def address_string(self):
+        # The client address of a Unix socket is an empty string
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        pass  # Requests are not logged, the latencies are given by /stats
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def Serve(host='127.0.0.1', port=8000, socketPath=None, model='last_trained_model', LPF=False, CUTOFF=50, hop=None,
+          maxDelayMs=10, maxBatchMB=16):
+    """
+    Serves the predictions of a model until interrupted
+    :param host: address the server listens on, local only by default
+    :param port: TCP port of the server
+    :param socketPath: if given, path of a Unix socket used instead of the TCP port
+    :param model: path to the keras model file
+    :param LPF: boolean for whether or not using low pass filtering
+    :param CUTOFF: cutoff frequency of the LPF
+    :param hop: number of samples between two predicted windows, by default the label frame period
+    :param maxDelayMs: time the first request of a micro-batch waits for others, in ms
+    :param maxBatchMB: maximum size of the windows of a micro-batch, in MB
+    """
+    os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'  # Silence tensorflow logs
+    service = F2CNNService(model, LPF, CUTOFF, hop, maxDelayMs, maxBatchMB)
+    service.batcher.ready.wait()
+    if service.batcher.error is not None:
+        print("Could not load the model '{}': {}".format(model, service.batcher.error))
+        exit(-1)
+    error = service.selfCheck()
+    if error is not None:
+        print("Self check of the service failed: {}".format(error))
+        exit(-1)
+
+    if socketPath is not None:
+        # Only a socket left by a previous server is removed, never another file
+        if os.path.exists(socketPath):
+            if not stat.S_ISSOCK(os.stat(socketPath).st_mode):
+                print("'{}' already exists and is not a socket, not replacing it.".format(socketPath))
+                exit(-1)
+            os.remove(socketPath)
+        server = ThreadingUnixHTTPServer(socketPath, RequestHandler)
+        address = "unix socket '{}'".format(socketPath)
+    else:
+        server = ThreadingHTTPServer((host, port), RequestHandler)
+        address = "http://{}:{}".format(host, server.server_address[1])
+    server.service = service
+    print("\n###############################\nServing '{}' on {}, micro-batches of up to {}ms and {}MB.".format(
+        model, address, maxDelayMs, maxBatchMB))
+    print("POST audio to /predict, GET /stats for the latencies. Ctrl+C to stop.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    if socketPath is not None and os.path.exists(socketPath):
+        os.remove(socketPath)
+    print("Stopped. {}".format(json.dumps(service.stats())))
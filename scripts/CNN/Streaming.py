@@ -0,0 +1,176 @@
+"""
+This file includes the real-time evaluation of live audio: 16 bits mono PCM is read chunk by chunk from the standard
+input or from a growing file, filtered and enveloped with persistent states(see StreamingFilters.py), and a
+rising/falling decision is given every label frame period, as soon as the envelopes of its whole input entry
+are known.
+The decision of a frame comes RADIUS label periods(the end of its input entry) plus the delay of the Hilbert
+transformer after the frame itself, and once the chunk completing it has been processed: the processing time of each
+decision, from the reading of that chunk, is measured.
+"""
+import io
+import os
+import sys
+import time
+from configparser import ConfigParser
+
+import numpy
+
+from gammatone import filters
+from scripts.processing.GammatoneFiltering import ReadSPHHeader
+from scripts.processing.StreamingFilters import StreamingFilterbank, StreamingEnvelope, HILBERT_TAPS
+from .Evaluating import Predictor
+from .Training import normalizeInputBatch
+
+# Time between two reads of a growing file without new samples, in seconds
+POLL_PERIOD = 0.01
+
+
+def ReadBytes(stream, size, follow=False, timeout=5.):
+    """
+    Reads bytes from a stream, waiting for a growing file to grow
+    :param stream: the stream, opened in binary mode
+    :param size: number of bytes
+    :param follow: if True, the end of the stream is waited for new bytes, instead of ending the reading
+    :param timeout: time without new bytes after which a followed stream is considered ended, in seconds
+    :return: the bytes, less than size only at the end of the stream
+    """
+    data = b''
+    lastRead = time.time()
+    while len(data) < size:
+        read = stream.read(size - len(data))
+        if read:
+            data += read
+            lastRead = time.time()
+        elif not follow or time.time() - lastRead > timeout:
+            break
+        else:
+            time.sleep(POLL_PERIOD)
+    return data
+
+
+def SkipHeader(stream, follow=False, timeout=5.):
+    """
+    Skips the header of a RIFF or NIST SPHERE .WAV stream, raw PCM having none
+    :param stream: the stream, opened in binary mode at its beginning
+    :param follow: see ReadBytes
+    :param timeout: see ReadBytes
+    :return: framerate given by the header(None for raw PCM), and the first bytes of samples already read
+    """
+    start = ReadBytes(stream, 12, follow, timeout)
+    if start[:4] == b'RIFF':
+        framerate = None
+        while True:
+            chunkHeader = ReadBytes(stream, 8, follow, timeout)
+            if len(chunkHeader) < 8:
+                return framerate, b''
+            chunkSize = int.from_bytes(chunkHeader[4:], 'little')
+            if chunkHeader[:4] == b'data':
+                return framerate, b''
+            chunk = ReadBytes(stream, chunkSize + chunkSize % 2, follow, timeout)
+            if chunkHeader[:4] == b'fmt ':
+                if int.from_bytes(chunk[:2], 'little') != 1 or int.from_bytes(chunk[2:4], 'little') != 1 \
+                        or int.from_bytes(chunk[14:16], 'little') != 16:
+                    raise ValueError("Only 16 bits mono PCM .WAV files are supported")
+                framerate = int.from_bytes(chunk[4:8], 'little')
+    if start[:7] == b'NIST_1A':
+        # The size of the header is on its second line, like '   1024'
+        header = start + ReadBytes(stream, 4, follow, timeout)
+        header += ReadBytes(stream, int(header.split(b'\n')[1]) - len(header), follow, timeout)
+        _, fields = ReadSPHHeader(io.BytesIO(header))
+        if fields.get('sample_coding', 'pcm') != 'pcm' or fields.get('sample_n_bytes', 2) != 2 \
+                or fields.get('channel_count', 1) != 1 or fields.get('sample_byte_format', '01') != '01':
+            raise ValueError("Only uncompressed 16 bits little endian mono SPHERE files are supported")
+        return fields['sample_rate'], b''
+    return None, start
+
+
+def StreamEvaluate(file=None, model='last_trained_model', LPF=False, CUTOFF=50, chunk=None, timeout=5.,
+                   taps=HILBERT_TAPS):
+    """
+    Evaluates live audio chunk by chunk, printing a rising/falling decision every label frame period
+    :param file: path to a growing .WAV or raw PCM file, followed until it stops growing, by default the standard input
+    :param model: path to the keras model file
+    :param LPF: boolean for whether or not using low pass filtering
+    :param CUTOFF: cutoff frequency of the LPF
+    :param chunk: number of samples read at once, by default the label frame period
+    :param timeout: time without new samples after which a growing file is considered ended, in seconds
+    :param taps: odd number of taps of the Hilbert transformer, see StreamingFilters.py
+    :return: list of the decisions, as (frame, rising score, processing time in seconds)
+    """
+    os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'  # Silence tensorflow logs
+
+    # #### READING CONFIG FILE
+    config = ConfigParser()
+    config.read('configF2CNN.conf')
+    framerate = config.getint('FILTERBANK', 'FRAMERATE')
+    nchannels = config.getint('FILTERBANK', 'NCHANNELS')
+    lowcutoff = config.getint('FILTERBANK', 'LOW_FREQ')
+    RADIUS = config.getint('CNN', 'RADIUS')
+    STEP = int(framerate * config.getint('CNN', 'SAMPLING_PERIOD') / 1000000)
+    FILTERBANK_COEFFICIENTS = filters.make_erb_filters(framerate, filters.centre_freqs(framerate, nchannels,
+                                                                                       lowcutoff))
+    chunk = chunk or STEP
+
+    stream = open(file, 'rb') if file is not None else sys.stdin.buffer
+    follow = file is not None
+    headerRate, pending = SkipHeader(stream, follow, timeout)
+    if headerRate is not None and headerRate != framerate:
+        print("Audio sampled at {}Hz, the filterbank expects {}Hz".format(headerRate, framerate))
+        exit(-1)
+
+    predictor = Predictor(model)
+    filterbank = StreamingFilterbank(FILTERBANK_COEFFICIENTS, chunk)
+    envelope = StreamingEnvelope(nchannels, LPF, CUTOFF, framerate, taps)
+    # Last envelope samples, enough for the input entry of the next decision
+    span = 2 * RADIUS * STEP
+    buffer = numpy.zeros((nchannels, 0))
+    bufferStart = 0  # Frame of the first sample of the buffer
+    nextCenter = RADIUS * STEP  # Frame of the next decision, like the first entry of InputGenerator.GetStridedWindows
+    decisions = []
+    print("\n###############################\nStreaming from {}, chunks of {} samples, {} taps Hilbert transformer."
+          .format(file or 'the standard input', chunk, taps))
+    print("Decisions come {:.1f}ms after their frame, plus their processing time.".format(
+        (RADIUS * STEP + envelope.delay) * 1000 / framerate))
+    print("Time(s)\tDecision\tRising score\tProcessing(ms)")
+
+    ended = False
+    while not ended:
+        data = pending + ReadBytes(stream, 2 * chunk - len(pending), follow, timeout)
+        readTime = time.time()
+        pending = b''
+        ended = len(data) < 2 * chunk
+        samples = numpy.frombuffer(data[:len(data) // 2 * 2], '<i2')
+        envelopes = envelope.process(filterbank.process(samples)) if len(samples) else numpy.zeros((nchannels, 0))
+        if ended:
+            envelopes = numpy.concatenate((envelopes, envelope.flush()), axis=1)
+        buffer = numpy.concatenate((buffer, envelopes), axis=1)
+
+        # Decisions whose input entries are now complete
+        centers = numpy.arange(nextCenter, bufferStart + buffer.shape[1] - RADIUS * STEP, STEP)
+        if len(centers):
+            offsets = centers[:, None] - bufferStart + numpy.arange(-RADIUS, RADIUS + 1) * STEP
+            windows = numpy.ascontiguousarray(buffer[:, offsets].transpose(1, 2, 0), dtype=numpy.float32)
+            normalizeInputBatch(windows)
+            scores, _, _ = predictor.predict(windows, normalized=True)
+            processing = time.time() - readTime
+            for center, score in zip(centers, scores):
+                decisions.append((int(center), float(score[1]), processing))
+                print("{:.3f}\t{}\t\t{:.3f}\t\t{:.1f}".format(center / framerate,
+                                                               'rising' if score[1] > score[0] else 'falling',
+                                                               score[1], processing * 1000))
+            nextCenter = centers[-1] + STEP
+        # Only the samples needed by the next decisions are kept
+        drop = max(0, min(buffer.shape[1], nextCenter - RADIUS * STEP - bufferStart))
+        buffer, bufferStart = buffer[:, drop:], bufferStart + drop
+        sys.stdout.flush()
+
+    if file is not None:
+        stream.close()
+    if decisions:
+        processing = numpy.array([decision[2] for decision in decisions]) * 1000
+        print("{} decisions over {:.2f}s of audio. Processing time: median {:.1f}ms, 99th percentile {:.1f}ms, "
+              "max {:.1f}ms.".format(len(decisions), (bufferStart + buffer.shape[1]) / framerate,
+                                     numpy.median(processing), numpy.percentile(processing, 99), processing.max()))
+    else:
+        print("No decision, the audio is shorter than an input entry ({} samples).".format(span + 1))
+    return decisions
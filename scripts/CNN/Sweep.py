@@ -0,0 +1,186 @@
+"""
+This file includes the hyperparameter sweep runner: several trainings run concurrently in separate processes,
+each with a bounded number of threads, all memory mapping the same normalized input file.
+The trainings are early stopped and ranked on a validation set of training speakers, held out from their training
+entries, the TEST split only being evaluated once at the end of each training.
+The results are saved in a leaderboard csv file.
+"""
+import csv
+import itertools
+import json
+import os
+import time
+from configparser import ConfigParser
+from multiprocessing import cpu_count, get_context
+
+import numpy
+
+from scripts.processing.LabelDataGenerator import LoadLabelIndex, NFORMANTS
+from .Models import MODELS
+from .Training import GetNormalizedInput, GetTestTrainIndexes, TrainOnIndexes, SplitValidationSpeakers, \
+    GetValidationScores
+
+SWEEP_DIR = os.path.join('trainingData', 'sweep')
+# Hyperparameters of a training, with their default values(batch_size and epochs are read from the configuration)
+PARAMETERS = {'learningRate': 0.0001, 'decay': 1e-6, 'batch_size': None, 'epochs': None, 'architecture': 'baseline'}
+
+
+def LimitThreads(threads):
+    """
+    Limits the number of threads used by the numerical libraries and tensorflow in the current process.
+    Should be called before any training in the process.
+    :param threads: maximum number of threads
+    """
+    for variable in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS'):
+        os.environ[variable] = str(threads)
+    os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'  # Silence tensorflow logs
+    import tensorflow
+    if hasattr(tensorflow, 'ConfigProto'):
+        import keras
+        keras.backend.set_session(tensorflow.Session(config=tensorflow.ConfigProto(
+            intra_op_parallelism_threads=threads, inter_op_parallelism_threads=1)))
+    else:
+        tensorflow.config.threading.set_intra_op_parallelism_threads(threads)
+        tensorflow.config.threading.set_inter_op_parallelism_threads(1)
+
+
+def ExpandSweepSpec(spec):
+    """
+    Gives the hyperparameters of all the trainings of a sweep specification, like:
+    {"search": "grid", "parameters": {"learningRate": [0.001, 0.0001], "batch_size": [32, 64]}}
+    or {"search": "random", "count": 10, "seed": 0,
+        "parameters": {"learningRate": {"min": 1e-5, "max": 1e-2, "log": true}, "batch_size": [32, 64, 128]}}
+    Random searches draw each value from its list, or uniformly (log-uniformly if "log") between "min" and "max".
+    :param spec: the specification, as a dict
+    :return: list of dicts of hyperparameters, one per training
+    """
+    parameters = spec.get('parameters', dict())
+    unknown = set(parameters.keys()) - set(PARAMETERS.keys())
+    if unknown:
+        raise ValueError("Unknown hyperparameters: {}".format(', '.join(sorted(unknown))))
+
+    # Architectures are checked before any training, not in the worker processes
+    architectures = parameters.get('architecture', [])
+    unknown = [value for value in (architectures if isinstance(architectures, list) else [architectures])
+               if not isinstance(value, str) or value not in MODELS]
+    if unknown:
+        raise ValueError("Unknown architectures: {}, available: {}".format(', '.join(map(str, unknown)),
+                                                                           ', '.join(sorted(MODELS.keys()))))
+
+    if spec.get('search', 'grid') == 'grid':
+        names = sorted(parameters.keys())
+        values = [parameters[name] if isinstance(parameters[name], list) else [parameters[name]] for name in names]
+        return [dict(zip(names, combination)) for combination in itertools.product(*values)]
+
+    random = numpy.random.RandomState(spec.get('seed'))
+    trials = []
+    for _ in range(spec.get('count', 10)):
+        trial = dict()
+        for name, values in sorted(parameters.items()):
+            if isinstance(values, list):
+                trial[name] = values[random.randint(len(values))]
+            elif isinstance(values, dict) and values.get('log'):
+                trial[name] = float(numpy.exp(random.uniform(numpy.log(values['min']), numpy.log(values['max']))))
+            elif isinstance(values, dict):
+                if isinstance(values['min'], int) and isinstance(values['max'], int):
+                    trial[name] = int(random.randint(values['min'], values['max'] + 1))
+                else:
+                    trial[name] = float(random.uniform(values['min'], values['max']))
+            else:
+                trial[name] = values
+        trials.append(trial)
+    return trials
+
+
+def RunSweepTrial(trial, parameters, inputPath, labelPath, formant):
+    """
+    Trains one model of a sweep, in a worker process
+    :param trial: number of the training in the sweep
+    :param parameters: dict of hyperparameters of the training
+    :param inputPath: path to the normalized input file, memory mapped
+    :param labelPath: path to the label data
+    :param formant: index of the formant(1-4) to train on, 0 for a multi-output model
+    :return: dict of the hyperparameters and results of the training
+    """
+    startTime = time.time()
+    testIndexes, y_test, trainIndexes, y_train = GetTestTrainIndexes(labelPath, formant)
+    # The same speakers are held out for all the trials, so that they are ranked on the same entries
+    validation = SplitValidationSpeakers(LoadLabelIndex(labelPath), trainIndexes)
+    heads = None if formant != 0 else ['F{}'.format(k + 1) for k in range(NFORMANTS)]
+    model, history, score = TrainOnIndexes(inputPath, trainIndexes[~validation], y_train[~validation], testIndexes,
+                                           y_test, heads, normalized=True, validationIndexes=trainIndexes[validation],
+                                           y_validation=y_train[validation], **parameters)
+    modelPath = os.path.join(SWEEP_DIR, 'trial_{}'.format(trial))
+    model.save(modelPath)
+    valLoss, valAcc = GetValidationScores(history)
+    score = dict(zip(model.metrics_names, score))
+    accuracies = [value for name, value in score.items() if name.endswith('acc')]
+    result = {'trial': trial, 'val_loss': valLoss, 'val_acc': valAcc, 'test_loss': score['loss'],
+              'test_acc': float(numpy.mean(accuracies)), 'epochs_run': len(history.history['loss']),
+              'time': time.time() - startTime, 'model': modelPath}
+    result.update(parameters)
+    print("Trial {} done: {}".format(trial, json.dumps(result)))
+    return result
+
+
+def SaveLeaderboard(results, leaderboardPath):
+    """
+    Saves the results of a sweep as a csv file, best validation accuracy first
+    :param results: list of dicts given by RunSweepTrial
+    :param leaderboardPath: path to the csv file
+    """
+    columns = ['trial', 'val_acc', 'val_loss', 'test_acc', 'test_loss', 'epochs_run', 'time'] + sorted(PARAMETERS.keys()) + ['model']
+    with open(leaderboardPath, 'w') as leaderboardFile:
+        writer = csv.DictWriter(leaderboardFile, columns, lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(sorted(results, key=lambda result: -result['val_acc']))
+
+
+def SweepHyperparameters(specFile, labelFile=None, inputFile=None, formant=None, parallel=2, threads=None,
+                         leaderboardFile=None):
+    """
+    Runs the trainings of a sweep specification, several at a time in separate processes
+    :param specFile: path to a json sweep specification, see ExpandSweepSpec
+    :param labelFile: path to a .csv label file generated by LabelDataGenerator.py
+    :param inputFile: path to a .npy file tensor of Nx11x128 values
+    :param formant: index of the formant(1-4) to train on, by default the FORMANT of the configuration file.
+                    If 0, trains multi-output models.
+    :param parallel: number of trainings running at the same time
+    :param threads: number of threads of each training, by default the cpus are shared between the trainings
+    :param leaderboardFile: path to the leaderboard csv file, by default trainingData/sweep/leaderboard.csv
+    """
+    TotalTime = time.time()
+    config = ConfigParser()
+    config.read('configF2CNN.conf')
+    formant = config.getint('CNN', 'FORMANT') if formant is None else formant
+    inputPath = inputFile or os.path.join('trainingData', 'last_input_data.npy')
+    labelPath = labelFile or os.path.join('trainingData', 'label_data.csv')
+    leaderboardPath = leaderboardFile or os.path.join(SWEEP_DIR, 'leaderboard.csv')
+    threads = threads or max(1, cpu_count() // parallel)
+
+    with open(specFile, 'r') as spec:
+        trials = ExpandSweepSpec(json.load(spec))
+    defaults = dict(PARAMETERS, batch_size=config.getint('CNN', 'BATCH_SIZE'), epochs=config.getint('CNN', 'EPOCHS'))
+    trials = [dict(defaults, **trial) for trial in trials]
+    print("\n###############################\nSweeping {} trainings, {} at a time with {} threads each.".format(
+        len(trials), parallel, threads))
+
+    # Normalized once, then memory mapped by all the trainings
+    inputPath = GetNormalizedInput(inputPath)
+    os.makedirs(SWEEP_DIR, exist_ok=True)
+
+    # Separate processes, started without tensorflow, each one used for a single training
+    pool = get_context('spawn').Pool(processes=parallel, initializer=LimitThreads, initargs=(threads,),
+                                     maxtasksperchild=1)
+    arguments = [(trial, parameters, inputPath, labelPath, formant) for trial, parameters in enumerate(trials)]
+    results = pool.starmap(RunSweepTrial, arguments, chunksize=1)
+    pool.close()
+    pool.join()
+
+    SaveLeaderboard(results, leaderboardPath)
+    best = max(results, key=lambda result: result['val_acc'])
+    print("Leaderboard saved as '{}'.".format(leaderboardPath))
+    print("Best trial: {} with a validation accuracy of {} (test accuracy {})".format(best['trial'], best['val_acc'],
+                                                                                     best['test_acc']))
+    print('              Total time:', time.time() - TotalTime)
+    print('')
@@ -2,13 +2,27 @@
 This file includes code allowing the training of the neural networks,
 and every helper function needed to pack/unpack input and label data.
 """
+import glob
+import hashlib
+import json
 import os
-import csv
+import tempfile
 from configparser import ConfigParser
 
 import numpy
 from matplotlib import pyplot
 
+from scripts.processing.LabelDataGenerator import LoadLabelIndex, NFORMANTS, UNKNOWN_SIGN
+from .Models import MODELS
+
+# Normalization applied to the input data, part of the key of the cached normalized inputs
+NORMALIZATION = {'method': 'log-min-max', 'dtype': 'float32', 'nonPositive': 'zero', 'version': 1}
+NORMALIZED_CACHE_DIR = os.path.join('trainingData', 'cache')
+HASHED_BYTES = 1 << 20
+VALIDATION_FRACTION = 0.1  # Part of the training entries held out for early stopping and model selection
+CHECKPOINT_PATH = os.path.join('trainingData', 'checkpoints', 'last_checkpoint')
+TRAINING_LOG = 'last_trained_model_log.csv'
+
 
 def normalizeInput(matrix: numpy.ndarray):
     minvalue, maxvalue = matrix.min(), matrix.max()
@@ -28,29 +42,526 @@ def normalizeInput(matrix: numpy.ndarray):
     return logMatrix
 
 
-def SeparateTestTrain(pathToInput, pathToLabel):
-    x = [[], []]
-    y = [[], []]
-    input_data = numpy.load(pathToInput)
-    with open(pathToLabel, 'r') as labels:
-        reader = csv.reader(labels)
-        for i, (test, region, speaker, sentence, phoneme, timepoint, slope, pvalue, sign) in enumerate(reader):
-            if test == 'TEST':
-                x[0].append(input_data[i])
-                y[0].append(int(sign))
-            else:
-                x[1].append(input_data[i])
-                y[1].append(int(sign))
-    return numpy.array(x[0]), numpy.array(y[0]), numpy.array(x[1]), numpy.array(y[1])
+def normalizeInputBatch(data: numpy.ndarray, chunkSize=4096):
+    """
+    Normalizes in place a batch of input matrices, like normalizeInput does for each one:
+    logarithm of the values, scaled between 0 and 1 by the minimum and maximum of each matrix.
+    Instead of raising an error, matrices with non positive values are filled with 0, like constant matrices.
+    :param data: C contiguous float32 array of N matrices, like Nx11x128 or Nx11x128x1
+    :param chunkSize: number of matrices processed at once, bounding the temporary memory used
+    :return: number of constant matrices, and number of matrices with non positive values
+    """
+    if data.dtype != numpy.float32 or not data.flags['C_CONTIGUOUS'] or not data.flags['WRITEABLE']:
+        raise ValueError("data must be a writeable C contiguous float32 array")
+    constant, nonPositive = 0, 0
+    # One line per matrix, view of data(the size of a matrix is given, as -1 cannot be inferred for 0 matrices)
+    matrices = data.reshape(len(data), int(numpy.prod(data.shape[1:])))
+    for start in range(0, len(matrices), chunkSize):
+        chunk = matrices[start:start + chunkSize]
+        minvalues, maxvalues = chunk.min(axis=1), chunk.max(axis=1)
+        invalid = minvalues <= 0
+        flat = (minvalues == maxvalues) & ~invalid
+        nonPositive += int(invalid.sum())
+        constant += int(flat.sum())
+        zeroed = invalid | flat
+        # log(1) = 0, those matrices get filled with 0 and do not produce log errors or divisions by 0
+        chunk[zeroed] = 1
+        minvalues[zeroed], maxvalues[zeroed] = 1, numpy.e
+
+        numpy.log(chunk, out=chunk)
+        minvalues, maxvalues = numpy.log(minvalues), numpy.log(maxvalues)
+        chunk -= minvalues[:, None]
+        chunk /= (maxvalues - minvalues)[:, None]
+    return constant, nonPositive
+
+
+def GetNormalizedInputKey(pathToInput):
+    """
+    Computes the key of the normalized version of an input file, changing with the file and the normalization
+    :param pathToInput: path to a .npy file tensor of Nx11x128 values
+    :return: hexadecimal key
+    """
+    stat = os.stat(pathToInput)
+    key = hashlib.sha1(json.dumps({'path': os.path.abspath(pathToInput), 'size': stat.st_size,
+                                   'mtime': stat.st_mtime_ns, 'normalization': NORMALIZATION}).encode())
+    # The beginning and the end of the file are also hashed, in case of a modification keeping the same mtime
+    with open(pathToInput, 'rb') as inputFile:
+        key.update(inputFile.read(HASHED_BYTES))
+        inputFile.seek(max(0, stat.st_size - HASHED_BYTES))
+        key.update(inputFile.read(HASHED_BYTES))
+    return key.hexdigest()
+
+
+def GetNormalizedInput(pathToInput, cacheDir=NORMALIZED_CACHE_DIR, chunkSize=4096):
+    """
+    Gives the normalized float32 version of an input file, from the cache if it has already been computed.
+    Otherwise it is computed chunk by chunk with normalizeInputBatch and cached, replacing the previous
+    normalized versions of the file.
+    :param pathToInput: path to a .npy file tensor of Nx11x128 values
+    :param cacheDir: directory of the cached normalized files
+    :param chunkSize: number of entries normalized at once
+    :return: path to the normalized .npy file, which can be memory mapped
+    """
+    key = GetNormalizedInputKey(pathToInput)
+    cachePath = os.path.join(cacheDir, 'normalized_{}.npy'.format(key))
+    if os.path.isfile(cachePath):
+        print("Using cached normalized input '{}'.".format(cachePath))
+        return cachePath
+
+    print("Normalizing '{}' into '{}'...".format(pathToInput, cachePath))
+    os.makedirs(cacheDir, exist_ok=True)
+    input_data = numpy.load(pathToInput, mmap_mode='r')
+    # Unique temporary file, so that concurrent runs normalizing the same input do not write into the same file
+    descriptor, temporaryPath = tempfile.mkstemp(dir=cacheDir, prefix='normalizing_', suffix='.npy')
+    os.close(descriptor)
+    try:
+        normalized = numpy.lib.format.open_memmap(temporaryPath, mode='w+', dtype=numpy.float32,
+                                                  shape=input_data.shape)
+        constant, nonPositive = 0, 0
+        for start in range(0, len(input_data), chunkSize):
+            normalized[start:start + chunkSize] = input_data[start:start + chunkSize]
+            counts = normalizeInputBatch(normalized[start:start + chunkSize])
+            constant, nonPositive = constant + counts[0], nonPositive + counts[1]
+        normalized.flush()
+        del normalized
+        # Atomic, a concurrent run having written the same key only gets its file replaced by an identical one
+        os.replace(temporaryPath, cachePath)
+    except BaseException:
+        os.remove(temporaryPath)
+        raise
+    print("Normalized {} samples: {} constant, {} with non positive values (filled with 0).".format(
+        len(input_data), constant, nonPositive))
+
+    sourcePath = os.path.abspath(pathToInput)
+    infoPath = os.path.splitext(cachePath)[0] + '.json'
+    descriptor, temporaryInfoPath = tempfile.mkstemp(dir=cacheDir, prefix='normalizing_', suffix='.json.tmp')
+    with os.fdopen(descriptor, 'w') as infoFile:
+        json.dump({'source': sourcePath, 'normalization': NORMALIZATION}, infoFile)
+    os.replace(temporaryInfoPath, infoPath)
+
+    # Previous normalized versions of the same file are removed, never the one just written
+    for otherInfoPath in glob.glob(os.path.join(cacheDir, 'normalized_*.json')):
+        if otherInfoPath == infoPath:
+            continue
+        try:
+            with open(otherInfoPath, 'r') as infoFile:
+                if json.load(infoFile).get('source') != sourcePath:
+                    continue
+            os.remove(otherInfoPath)
+            os.remove(os.path.splitext(otherInfoPath)[0] + '.npy')
+        except FileNotFoundError:  # Already removed by a concurrent run
+            continue
+    return cachePath
+
+
+def GetFormantSigns(index, formant=2):
+    """
+    Gives the labels of the entries of a label index for a formant
+    :param index: label index, see LabelDataGenerator.LoadLabelIndex
+    :param formant: index of the formant(1-4), or 0 for the labels of all the formants
+    :return: the labels of all the entries, and a mask of the entries having a clear slope for the formant
+    """
+    signs = numpy.array(index['sign'], dtype=int)
+    if formant == 0:
+        return signs, numpy.ones(len(index), dtype=bool)
+    signs = signs[:, formant - 1]
+    return signs, signs != UNKNOWN_SIGN
+
+
+def GetTestTrainIndexes(pathToLabel, formant=2):
+    """
+    Computes which input entries are used for test and for train, from the label data
+    :param pathToLabel: path to a .csv label file generated by LabelDataGenerator.py
+    :param formant: index of the formant(1-4) used as label, entries without a clear slope for it are ignored.
+                    If 0, the labels of all the formants are given, with -1 for unknown signs.
+    :return: test entries indexes, test labels, train entries indexes, train labels
+    """
+    index = LoadLabelIndex(pathToLabel)
+    signs, valid = GetFormantSigns(index, formant)
+    test = index['split'] == b'TEST'
+    return numpy.flatnonzero(test & valid), signs[test & valid], numpy.flatnonzero(~test & valid), signs[~test & valid]
+
+
+def SplitValidationSpeakers(index, indexes, fraction=VALIDATION_FRACTION, seed=0):
+    """
+    Holds out some speakers of a set of entries for validation, all the entries of a speaker being on the same side
+    :param index: label index, see LabelDataGenerator.LoadLabelIndex
+    :param indexes: indexes of the entries to split, like the training entries
+    :param fraction: part of the entries held out, reached by whole speakers taken in a random order
+    :param seed: seed of the random order of the speakers
+    :return: mask of the held out entries, aligned with indexes
+    """
+    # Speakers are identified by their region and their ID
+    speakers = numpy.char.add(numpy.char.add(index['region'][indexes], b'.'), index['speaker'][indexes])
+    names, speakerOfEntry, counts = numpy.unique(speakers, return_inverse=True, return_counts=True)
+    if len(names) < 2:
+        raise ValueError("Only {} speakers, none can be held out for validation".format(len(names)))
+    order = numpy.random.RandomState(seed).permutation(len(names))
+    # Speakers are held out until the fraction is reached, always keeping at least one for training
+    heldOut = order[:min(len(names) - 1, numpy.searchsorted(numpy.cumsum(counts[order]), fraction * len(indexes)) + 1)]
+    return numpy.isin(speakerOfEntry.ravel(), heldOut)
+
+
+def GetValidationScores(history):
+    """
+    Gives the scores of a model on its validation entries after its last training epoch
+    :param history: keras training history
+    :return: validation loss, and validation accuracy(averaged over the outputs of a multi-output model)
+    """
+    accuracies = [values[-1] for name, values in history.history.items()
+                  if name.startswith('val_') and name.endswith('acc')]
+    return float(history.history['val_loss'][-1]), float(numpy.mean(accuracies))
+
+
+def GatherInputs(input_data, indexes, chunkSize=4096):
+    """
+    Gathers some entries of a (memory mapped) input tensor into a new float32 array, with a last dimension of 1 for keras
+    :param input_data: the Nx11x128 input tensor
+    :param indexes: indexes of the entries to gather, in increasing order for faster disk reads
+    :param chunkSize: number of entries read at once
+    :return: the len(indexes)x11x128x1 float32 array
+    """
+    output = numpy.empty((len(indexes),) + input_data.shape[1:] + (1,), dtype=numpy.float32)
+    for start in range(0, len(indexes), chunkSize):
+        output[start:start + chunkSize, ..., 0] = input_data[indexes[start:start + chunkSize]]
+    return output
+
+
+class InputBatchReader:
+    """
+    Minibatches read from a memory mapped Nx11x128 input tensor, or from several ones seen as a single tensor,
+    one after the other. Does not depend on keras: DataPipeline.InputSequence makes it a keras sequence,
+    and the data parallel training reads it through a tensorflow dataset.
+    """
+
+    def __init__(self, inputPath, indexes, signs, batchSize, num_classes=2, heads=None, shuffleBuffer=None,
+                 normalized=False, seed=None):
+        """
+        :param inputPath: path to the .npy input tensor, or list of paths to tensors seen as a single one
+        :param indexes: increasing indexes of the used entries of the input tensor
+        :param signs: labels of the used entries, see Training.GetTestTrainIndexes
+        :param batchSize: number of entries in a minibatch
+        :param num_classes: number of output categories
+        :param heads: names of the outputs of a multi-output model, None for a single output
+        :param shuffleBuffer: number of consecutive entries shuffled together at each epoch, None for no shuffling.
+                              Small buffers keep the disk reads of the memory mapped tensor local.
+        :param normalized: True if the input tensor is already normalized
+        :param seed: seed of the shuffling
+        """
+        self.inputPaths = [inputPath] if isinstance(inputPath, str) else list(inputPath)
+        # Index of the first entry of each tensor, and total number of entries
+        lengths = [len(numpy.load(path, mmap_mode='r')) for path in self.inputPaths]
+        self.offsets = numpy.concatenate(([0], numpy.cumsum(lengths)))
+        self.indexes = numpy.asarray(indexes)
+        self.signs = numpy.asarray(signs)
+        self.batchSize = batchSize
+        self.num_classes = num_classes
+        self.heads = heads
+        self.shuffleBuffer = shuffleBuffer
+        self.normalized = normalized
+        self.random = numpy.random.RandomState(seed)
+        self.order = numpy.arange(len(self.indexes))
+        self.input_data = None  # Opened by each worker when needed
+        self.on_epoch_end()
+
+    def __len__(self):
+        return int(numpy.ceil(len(self.indexes) / self.batchSize))
+
+    def __getitem__(self, batch):
+        if self.input_data is None:
+            self.input_data = [numpy.load(path, mmap_mode='r') for path in self.inputPaths]
+        # Sorted positions, for increasing reads in the memory mapped tensors
+        positions = numpy.sort(self.order[batch * self.batchSize:(batch + 1) * self.batchSize])
+        entries = self.indexes[positions]
+        x = numpy.empty((len(positions),) + self.input_data[0].shape[1:] + (1,), dtype=numpy.float32)
+        if len(self.input_data) == 1:
+            x[..., 0] = self.input_data[0][entries]
+        else:
+            tensors = numpy.searchsorted(self.offsets, entries, side='right') - 1
+            for tensor, data in enumerate(self.input_data):
+                inTensor = tensors == tensor
+                if inTensor.any():
+                    x[inTensor, ..., 0] = data[entries[inTensor] - self.offsets[tensor]]
+        if not self.normalized:
+            normalizeInputBatch(x)
+        y, weights = LabelsToTargets(self.signs[positions], self.num_classes, self.heads)
+        return (x, y) if weights is None else (x, y, weights)
+
+    def on_epoch_end(self):
+        if not self.shuffleBuffer:
+            return
+        # Blocks of shuffleBuffer consecutive entries are shuffled, then the entries inside of each block
+        blocks = [self.order[start:start + self.shuffleBuffer]
+                  for start in range(0, len(self.order), self.shuffleBuffer)]
+        self.random.shuffle(blocks)
+        for block in blocks:
+            self.random.shuffle(block)
+        self.order = numpy.concatenate(blocks) if blocks else self.order
+
+
+def SeparateTestTrain(pathToInput, pathToLabel, formant=2):
+    """
+    Separates the input and label data between test and train entries
+    :param pathToInput: path to a .npy file tensor of Nx11x128 values, memory mapped
+    :param pathToLabel: path to a .csv label file generated by LabelDataGenerator.py
+    :param formant: index of the formant(1-4) used as label, see GetTestTrainIndexes
+    :return: test inputs, test labels, train inputs, train labels, the inputs being float32 arrays of Nx11x128x1
+    """
+    input_data = numpy.load(pathToInput, mmap_mode='r')
+    testIndexes, testSigns, trainIndexes, trainSigns = GetTestTrainIndexes(pathToLabel, formant)
+    return GatherInputs(input_data, testIndexes), testSigns, GatherInputs(input_data, trainIndexes), trainSigns
+
+
+def GetAugmentedIndexes(augmentPath, inputLength, trainIndexes, y_train):
+    """
+    Gives the entries of an augmented input file(see NoiseAugmentation.py) which are noisy versions of training entries
+    :param augmentPath: path to the augmented input file, holding noisy copies of all the entries of the input file
+    :param inputLength: number of entries of the input file
+    :param trainIndexes: indexes of the training entries in the input file, with y_train their labels
+    :return: indexes of the noisy entries, the input file and the augmented file being seen as a single tensor,
+             and their labels
+    """
+    augmentedLength = len(numpy.load(augmentPath, mmap_mode='r'))
+    if augmentedLength % inputLength:
+        raise ValueError("'{}' has {} entries, not a multiple of the {} input entries".format(
+            augmentPath, augmentedLength, inputLength))
+    copies = augmentedLength // inputLength
+    indexes = numpy.concatenate([inputLength * (copy + 1) + trainIndexes for copy in range(copies)])
+    return indexes, numpy.concatenate([y_train] * copies)
+
+
+def LabelsToTargets(signs, num_classes=2, heads=None):
+    """
+    Converts labels into keras targets(binary class matrices)
+    :param signs: labels, see GetTestTrainIndexes
+    :param num_classes: number of output categories
+    :param heads: names of the outputs of a multi-output model, None for a single output
+    :return: the targets, and the sample weights of a multi-output model(None for a single output)
+    """
+    categories = numpy.eye(num_classes, dtype=numpy.float32)
+    if heads is None:
+        return categories[signs], None
+    # Unknown signs are given a null weight, so that they do not count for their output
+    weights = {name: (signs[:, k] != UNKNOWN_SIGN).astype('float32') for k, name in enumerate(heads)}
+    targets = {name: categories[numpy.maximum(signs[:, k], 0)] for k, name in enumerate(heads)}
+    return targets, weights
+
+
+def BuildModel(inputShape, num_classes, heads=None, backend=None, architecture='baseline'):
+    """
+    Builds the keras CNN model
+    :param inputShape: shape of one input entry, like (11, 128, 1)
+    :param num_classes: number of output categories
+    :param heads: if given, list of the names of the outputs of a multi-output model sharing the same layers
+    :param backend: keras module used, by default the keras package(tensorflow.keras for distributed trainings)
+    :param architecture: name of the architecture of the shared layers, one of the keys of Models.MODELS
+    :return: the (uncompiled) keras model
+    """
+    if backend is None:
+        import keras
+    else:
+        keras = backend
+
+    inputs = keras.layers.Input(shape=inputShape)
+    x = MODELS[architecture](keras, inputs)
+    if heads is None:
+        x = keras.layers.Dense(num_classes)(x)
+        outputs = keras.layers.Activation('softmax')(x)
+    else:
+        # One softmax output per head, all sharing the previous layers
+        outputs = [keras.layers.Dense(num_classes, activation='softmax', name=name)(x) for name in heads]
+    return keras.models.Model(inputs=inputs, outputs=outputs)
+
+
+def CompileModel(model, learningRate=0.0001, decay=1e-6, backend=None):
+    """
+    Compiles a model for training, with a RMSprop optimizer and a categorical crossentropy loss
+    :param model: the keras model, see BuildModel
+    :param learningRate: learning rate of the optimizer
+    :param decay: learning rate decay of the optimizer
+    :param backend: keras module of the model, see BuildModel
+    :return: the compiled model
+    """
+    if backend is None:
+        import keras
+    else:
+        keras = backend
+
+    # initiate RMSprop optimizer
+    if hasattr(keras.optimizers, 'schedules'):
+        # tensorflow.keras no longer takes lr and decay: the same time based decay, lr / (1 + decay * iterations),
+        # is given as a learning rate schedule
+        schedule = keras.optimizers.schedules.InverseTimeDecay(learningRate, decay_steps=1, decay_rate=decay)
+        opt = keras.optimizers.RMSprop(learning_rate=schedule)
+    else:
+        opt = keras.optimizers.RMSprop(lr=learningRate, decay=decay)
+
+    model.compile(loss=keras.losses.categorical_crossentropy,
+                  optimizer=opt,
+                  metrics=['accuracy'])
+    return model
+
+
+def GetStopCallback(heads=None):
+    """
+    STOP callback, used to stop training before the maximum number of epochs,
+    if the network stops getting better for the value 'monitor',
+    with less than 'min_delta' variation over 'patience' epochs
+    :param heads: names of the outputs of a multi-output model, None for a single output
+    """
+    import keras
+    return keras.callbacks.EarlyStopping(monitor='val_acc' if heads is None else 'val_loss', min_delta=0.01,
+                                         patience=5, verbose=1, mode='auto', baseline=None)
+
+
+def FitOnSequences(model, trainSequence, testSequence, epochs, callbacks, workers=0, prefetch=10, verbose=1,
+                   initialEpoch=0, validationSequence=None):
+    """
+    Trains a compiled model on sequences of minibatches, and evaluates it
+    :param model: the compiled keras model
+    :param trainSequence: the DataPipeline.InputSequence of training entries
+    :param testSequence: the DataPipeline.InputSequence of test entries
+    :param epochs: maximum number of epochs
+    :param callbacks: keras callbacks
+    :param workers: number of background worker processes, 0 to prepare the minibatches in the calling thread
+    :param prefetch: number of minibatches prepared ahead of the model
+    :param verbose: keras verbosity
+    :param initialEpoch: number of epochs already done, when resuming a training
+    :param validationSequence: the DataPipeline.InputSequence of the entries monitored after each epoch(like for the
+                               early stopping), the test entries by default. If given, the test entries are only
+                               evaluated once, after the training.
+    :return: the keras training history, and the test scores
+    """
+    history = model.fit_generator(trainSequence,
+                                  epochs=epochs,
+                                  initial_epoch=initialEpoch,
+                                  callbacks=callbacks,
+                                  verbose=verbose,
+                                  validation_data=testSequence if validationSequence is None else validationSequence,
+                                  max_queue_size=prefetch,
+                                  workers=workers,
+                                  use_multiprocessing=workers > 1)
+    score = model.evaluate_generator(testSequence, max_queue_size=prefetch, workers=workers,
+                                     use_multiprocessing=workers > 1)
+    return history, score
+
+
+def LoadCheckpoint(checkpointPath=CHECKPOINT_PATH, formant=None):
+    """
+    Loads the last checkpoint of an interrupted training, see DataPipeline.CheckpointCallback
+    :param checkpointPath: path of the checkpoint model
+    :param formant: formant of the resumed training, checked against the one of the checkpoint
+    :return: the compiled model with its optimizer state, and the number of epochs already done
+    """
+    import keras
+
+    if not os.path.isfile(checkpointPath) or not os.path.isfile(checkpointPath + '.json'):
+        print("No checkpoint found as '{}', cannot resume.".format(checkpointPath))
+        exit(-1)
+    with open(checkpointPath + '.json', 'r') as infoFile:
+        info = json.load(infoFile)
+    if formant is not None and info.get('formant') != formant:
+        print("The checkpoint was trained on formant {}, not {}.".format(info.get('formant'), formant))
+        exit(-1)
+    print("Resuming from '{}' after {} epochs.".format(checkpointPath, info['epoch']))
+    return keras.models.load_model(checkpointPath), info['epoch']
+
+
+def PlotTrainingLog(logPath=TRAINING_LOG, figurePath='last_trained_model_results.png', show=False):
+    """
+    Plots the validation accuracy and the validation loss accross the epochs of a training, from its csv log
+    :param logPath: path to the csv training log
+    :param figurePath: path of the saved figure
+    :param show: if True, also shows the figure, without blocking
+    """
+    log = numpy.genfromtxt(logPath, delimiter=',', names=True)
+    epochs = numpy.atleast_1d(log['epoch']) + 1
+    fig = pyplot.figure(figsize=(32, 16))
+    val_acc = fig.add_subplot(121)
+    val_loss = fig.add_subplot(122)
+    accuracies = [name for name in log.dtype.names if name.startswith('val_') and name.endswith('acc')]
+    for name in accuracies:
+        val_acc.plot(epochs, numpy.atleast_1d(log[name]),
+                     label='Validation Accuracy' + (' ' + name[4:-4] if len(accuracies) > 1 else ''))
+    val_loss.plot(epochs, numpy.atleast_1d(log['val_loss']), label='Validation Loss')
+    val_acc.set_xlabel("Epoch")
+    val_acc.set_ylabel("Validation Accuracy")
+    val_loss.set_ylabel("Validation Loss")
+    val_acc.legend()
+    val_loss.legend()
+    fig.savefig(figurePath)
+    print("Figure saved as '{}'".format(figurePath))
+    if show:
+        pyplot.show(block=False)
+    else:
+        pyplot.close(fig)
+
+
+def TrainOnIndexes(inputPath, trainIndexes, y_train, testIndexes, y_test, heads=None, batch_size=32, epochs=20,
+                   learningRate=0.0001, decay=1e-6, normalized=True, shuffleBuffer=10000, verbose=2,
+                   architecture='baseline', validationIndexes=None, y_validation=None):
+    """
+    Trains a new model on some entries of a memory mapped input file, without copying them.
+    The minibatches are prepared in the calling thread, for trainings running in parallel processes.
+    :param inputPath: path to a .npy file tensor of Nx11x128 values
+    :param trainIndexes: indexes of the training entries, with y_train their labels
+    :param testIndexes: indexes of the test entries, with y_test their labels
+    :param heads: names of the outputs of a multi-output model, None for a single output
+    :param batch_size: number of entries in a minibatch
+    :param epochs: maximum number of epochs
+    :param learningRate: learning rate of the optimizer
+    :param decay: learning rate decay of the optimizer
+    :param normalized: True if the input file is already normalized, see GetNormalizedInput
+    :param shuffleBuffer: number of consecutive entries shuffled together
+    :param verbose: keras verbosity
+    :param architecture: name of the architecture of the model, see Models.MODELS
+    :param validationIndexes: if given, indexes of the entries monitored by the early stopping instead of the test
+                              entries(see SplitValidationSpeakers), with y_validation their labels
+    :return: the trained model, its training history(with the validation scores) and its test scores
+    """
+    from .DataPipeline import InputSequence, ThroughputCallback
 
+    num_classes = 2
+    trainSequence = InputSequence(inputPath, trainIndexes, y_train, batch_size, num_classes, heads, shuffleBuffer,
+                                  normalized)
+    testSequence = InputSequence(inputPath, testIndexes, y_test, batch_size, num_classes, heads,
+                                 normalized=normalized)
+    validationSequence = None
+    if validationIndexes is not None:
+        validationSequence = InputSequence(inputPath, validationIndexes, y_validation, batch_size, num_classes, heads,
+                                           normalized=normalized)
+    input_shape = numpy.load(inputPath, mmap_mode='r').shape[1:] + (1,)
+    model = CompileModel(BuildModel(input_shape, num_classes, heads, architecture=architecture), learningRate, decay)
+    callbacks = [ThroughputCallback(len(trainIndexes)), GetStopCallback(heads)]
+    history, score = FitOnSequences(model, trainSequence, testSequence, epochs, callbacks, workers=0, verbose=verbose,
+                                    validationSequence=validationSequence)
+    return model, history, score
 
-def TrainAndPlotLoss(labelFile=None, inputFile=None):
+
+def TrainAndPlotLoss(labelFile=None, inputFile=None, formant=None, stream=False, workers=4, shuffleBuffer=10000,
+                     prefetch=10, cache=True, augmentFile=None, resume=False, checkpointPeriod=1, plot=True,
+                     architecture='baseline'):
     """
     Trains the CNN suing the given input FIle
     :param labelFile: path to a .csv label file generated by LabelDataGenerator.py
     :param inputFile: path to a .npy file tensor of Nx11x128 values
+    :param formant: index of the formant(1-4) to train on, by default the FORMANT of the configuration file.
+                    If 0, trains a multi-output model with one output per formant.
+    :param stream: if True, minibatches are read from the memory mapped input file and normalized by background
+                   workers during the training, instead of loading the whole dataset in memory
+    :param workers: number of background workers of the streaming pipeline
+    :param shuffleBuffer: number of consecutive entries shuffled together by the streaming pipeline
+    :param prefetch: number of minibatches prepared ahead of the model by the streaming pipeline
+    :param cache: if True, the normalized input data is cached in trainingData/cache, and reused by the next trainings
+    :param augmentFile: path to an augmented input file generated by NoiseAugmentation.py, whose noisy versions
+                        of the training entries are added to the training entries. The test entries stay clean.
+    :param resume: if True, resumes the training from its last checkpoint
+    :param checkpointPeriod: number of epochs between two checkpoints of the model and its optimizer state
+    :param plot: if True, the validation accuracy and loss are plotted in last_trained_model_results.png
+    :param architecture: name of the architecture of the model, see Models.MODELS
     """
     import keras
+    from .DataPipeline import InputSequence, ThroughputCallback, CheckpointCallback
 
     # ### CONFIGURATION
     config = ConfigParser()
@@ -58,99 +569,103 @@ def TrainAndPlotLoss(labelFile=None, inputFile=None):
     batch_size = config.getint('CNN', 'BATCH_SIZE')
     num_classes = 2
     epochs = config.getint('CNN', 'EPOCHS')
+    formant = config.getint('CNN', 'FORMANT') if formant is None else formant
     # input image dimensions
 
     inputPath = inputFile or os.path.join('trainingData', 'last_input_data.npy')  # default file if none provided
     labelPath = labelFile or os.path.join('trainingData', 'label_data.csv')
+    heads = None if formant != 0 else ['F{}'.format(k + 1) for k in range(NFORMANTS)]
+    normalized = cache
+    if cache:
+        inputPath = GetNormalizedInput(inputPath)
+        if augmentFile:
+            augmentFile = GetNormalizedInput(augmentFile)
+    inputLength = len(numpy.load(inputPath, mmap_mode='r'))
 
-    x_test, y_test, x_train, y_train = SeparateTestTrain(inputPath, labelPath)
-
-    x_train = x_train.reshape(x_train.shape[0], x_train.shape[1], x_train.shape[2], 1)
-    x_test = x_test.reshape(x_test.shape[0], x_test.shape[1], x_test.shape[2], 1)
-
-    x_train = x_train.astype('float32')
-    x_test = x_test.astype('float32')
+    if stream:
+        testIndexes, y_test, trainIndexes, y_train = GetTestTrainIndexes(labelPath, formant)
+        input_shape = numpy.load(inputPath, mmap_mode='r').shape[1:] + (1,)
+        trainPaths = inputPath
+        if augmentFile:
+            augmentedIndexes, y_augmented = GetAugmentedIndexes(augmentFile, inputLength, trainIndexes, y_train)
+            trainIndexes = numpy.concatenate((trainIndexes, augmentedIndexes))
+            y_train = numpy.concatenate((y_train, y_augmented))
+            trainPaths = [inputPath, augmentFile]
+            print("Adding {} noisy train samples from '{}'.".format(len(augmentedIndexes), augmentFile))
+        trainSequence = InputSequence(trainPaths, trainIndexes, y_train, batch_size, num_classes, heads, shuffleBuffer,
+                                      normalized)
+        testSequence = InputSequence(inputPath, testIndexes, y_test, batch_size, num_classes, heads,
+                                     normalized=normalized)
+        print("Streaming {} train samples and {} test samples from '{}', with {} workers.".format(
+            len(trainIndexes), len(testIndexes), inputPath, workers))
+    else:
+        x_test, y_test, x_train, y_train = SeparateTestTrain(inputPath, labelPath, formant)
+        input_shape = x_train.shape[1:]
+        if augmentFile:
+            _, _, trainIndexes, _ = GetTestTrainIndexes(labelPath, formant)
+            augmentedIndexes, y_augmented = GetAugmentedIndexes(augmentFile, inputLength, trainIndexes, y_train)
+            x_train = numpy.concatenate((x_train, GatherInputs(numpy.load(augmentFile, mmap_mode='r'),
+                                                               augmentedIndexes - inputLength)))
+            y_train = numpy.concatenate((y_train, y_augmented))
+            print("Added {} noisy train samples from '{}'.".format(len(augmentedIndexes), augmentFile))
 
-    for i, matrix in enumerate(x_train):
-        x_train[i] = normalizeInput(matrix)
-    for i, matrix in enumerate(x_test):
-        x_test[i] = normalizeInput(matrix)
+        if not normalized:
+            for name, data in (('train', x_train), ('test', x_test)):
+                constant, nonPositive = normalizeInputBatch(data)
+                print("Normalized {} {} samples: {} constant, {} with non positive values (filled with 0).".format(
+                    len(data), name, constant, nonPositive))
 
-    print('Rising test:', len([sign for sign in y_test if sign == 1]))
-    print('Falling test:', len([sign for sign in y_test if sign == 0]))
-    print('Rising train:', len([sign for sign in y_train if sign == 1]))
-    print('Falling train:', len([sign for sign in y_train if sign == 0]))
+        print(x_train.shape, 'train samples')
+        print(x_test.shape, 'test samples')
 
-    print(x_train.shape, 'train samples')
-    print(x_test.shape, 'test samples')
+    for k, name in enumerate(heads or ['F{}'.format(formant)]):
+        signs_test = y_test[:, k] if heads else y_test
+        signs_train = y_train[:, k] if heads else y_train
+        print(name, 'Rising test:', numpy.count_nonzero(signs_test == 1))
+        print(name, 'Falling test:', numpy.count_nonzero(signs_test == 0))
+        print(name, 'Rising train:', numpy.count_nonzero(signs_train == 1))
+        print(name, 'Falling train:', numpy.count_nonzero(signs_train == 0))
+    samplesPerEpoch = len(y_train)
 
     # convert class vectors to binary class matrices
-    y_train = keras.utils.to_categorical(y_train, num_classes)
-    y_test = keras.utils.to_categorical(y_test, num_classes)
+    if not stream:
+        y_train, train_weights = LabelsToTargets(y_train, num_classes, heads)
+        y_test, test_weights = LabelsToTargets(y_test, num_classes, heads)
     print("Categories: [falling, rising]")
 
     # #### KERAS MODEL BUILDING
-    model = keras.models.Sequential()
-    model.add(keras.layers.Conv2D(32, (3, 3), padding='same',
-                                  input_shape=x_train.shape[1:]))
-    model.add(keras.layers.Activation('relu'))
-    model.add(keras.layers.Conv2D(32, (3, 3)))
-    model.add(keras.layers.Activation('relu'))
-    model.add(keras.layers.MaxPooling2D(pool_size=(2, 2)))
-    model.add(keras.layers.Dropout(0.25))
-
-    model.add(keras.layers.Conv2D(64, (3, 3), padding='same'))
-    model.add(keras.layers.Activation('relu'))
-    model.add(keras.layers.Conv2D(64, (3, 3)))
-    model.add(keras.layers.Activation('relu'))
-    model.add(keras.layers.MaxPooling2D(pool_size=(2, 2)))
-    model.add(keras.layers.Dropout(0.25))
-
-    model.add(keras.layers.Flatten())
-    model.add(keras.layers.Dense(516))
-    model.add(keras.layers.Activation('relu'))
-    model.add(keras.layers.Dropout(0.5))
-    model.add(keras.layers.Dense(num_classes))
-    model.add(keras.layers.Activation('softmax'))
+    initialEpoch = 0
+    if resume:
+        model, initialEpoch = LoadCheckpoint(CHECKPOINT_PATH, formant)
+    else:
+        model = CompileModel(BuildModel(input_shape, num_classes, heads, architecture=architecture))
+    os.makedirs(os.path.dirname(CHECKPOINT_PATH), exist_ok=True)
+    # Per epoch csv log of the metrics, samples/s, epoch wall time and peak RSS, continued when resuming
+    callbacks = [ThroughputCallback(samplesPerEpoch),
+                 CheckpointCallback(CHECKPOINT_PATH, checkpointPeriod, {'formant': formant}),
+                 keras.callbacks.CSVLogger(TRAINING_LOG, append=resume),
+                 GetStopCallback(heads)]
 
-    # initiate RMSprop optimizer
-    opt = keras.optimizers.rmsprop(lr=0.0001, decay=1e-6)
-
-    model.compile(loss=keras.losses.categorical_crossentropy,
-                  optimizer=opt,
-                  metrics=['accuracy'])
-
-    # STOP callback, used to stop training before the maximum number of epochs,
-    # if the network stops getting better for the value 'monitor',
-    # with less than 'min_delta' variation over 'patience' epochs
-    stopCallback = keras.callbacks.EarlyStopping(monitor='val_acc', min_delta=0.01, patience=5, verbose=1, mode='auto',
-                                                 baseline=None)
-
-    history = model.fit(x_train, y_train,
-                        batch_size=batch_size,
-                        epochs=epochs,
-                        callbacks=[stopCallback],
-                        verbose=1,
-                        validation_data=(x_test, y_test))
-
-    score = model.evaluate(x_test, y_test, verbose=1)
+    if stream:
+        history, score = FitOnSequences(model, trainSequence, testSequence, epochs, callbacks, workers, prefetch,
+                                        initialEpoch=initialEpoch)
+    else:
+        history = model.fit(x_train, y_train,
+                            batch_size=batch_size,
+                            epochs=epochs,
+                            initial_epoch=initialEpoch,
+                            callbacks=callbacks,
+                            verbose=1,
+                            sample_weight=train_weights,
+                            validation_data=(x_test, y_test) if heads is None else (x_test, y_test, test_weights))
+        score = model.evaluate(x_test, y_test, sample_weight=test_weights, verbose=1)
 
     print("Model saved as a keras file 'last_trained_model'.")
     model.save('last_trained_model')
+    print("Training log saved as '{}'.".format(TRAINING_LOG))
 
-    print('Test loss:', score[0])
-    print('Test accuracy:', score[1])
+    for name, value in zip(model.metrics_names, score):
+        print('Test {}:'.format(name), value)
     # Plotting of the training results, validation accuracy and validation loss accross epochs
-    fig = pyplot.figure(figsize=(32,16))
-    val_acc = fig.add_subplot(121)
-    val_loss = fig.add_subplot(122)
-    val_acc.plot(history.history['val_acc'], label='Validation Accuracy')
-    val_loss.plot(history.history['val_loss'], label='Validation Loss')
-    val_acc.set_xlabel("Epoch")
-    val_acc.set_ylabel("Validation Accuracy")
-    val_loss.set_ylabel("Validation Loss")
-    val_acc.legend()
-    val_loss.legend()
-    pyplot.show(fig)
-    print("Figure saved as 'last_trained_model_results.png'")
-    pyplot.savefig('last_trained_model_results.png')
+    if plot and history.history:
+        PlotTrainingLog(TRAINING_LOG)
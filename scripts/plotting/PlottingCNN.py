@@ -13,7 +13,11 @@ from scripts.plotting.PlottingProcessing import ReshapeEnvelopesForSpectrogram,
 
 
 def PlotEnvelopesAndCNNResultsWithPhonemes(envelopes, scores, accuracy, CENTER_FREQUENCIES, phonemes, Formants=None,
-                                           title=None, start=0, end=None):
+                                           title=None, start=0, end=None, show=True):
+    """
+    Plots the envelopes of a file with the results of the CNN, the formant and the phonemes
+    :param show: if True, shows the figure in a window, otherwise saves it in graphs/FallingOrRising without showing it
+    """
 
     # #### READING CONFIG FILE
     config = ConfigParser()
@@ -108,8 +112,12 @@ def PlotEnvelopesAndCNNResultsWithPhonemes(envelopes, scores, accuracy, CENTER_F
         axproba.text(0, mini - 0.05 * mini, "Accuracy: {}".format(accuracy))
 
     plt.title(title if title is not None else "")
-    figMgr = plt.get_current_fig_manager()
-    figMgr.resize(*figMgr.window.maxsize())
-    plt.show()
     filePath = os.path.join("graphs", "FallingOrRising", os.path.split(title)[1]) + '.png'
     os.makedirs(os.path.split(filePath)[0], exist_ok=True)
+    if show:
+        figMgr = plt.get_current_fig_manager()
+        figMgr.resize(*figMgr.window.maxsize())
+        plt.show()
+    else:
+        fig.savefig(filePath)
+        plt.close(fig)
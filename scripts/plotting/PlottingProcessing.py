@@ -92,7 +92,6 @@ def PlotEnvelopesAndFormantsFromFile(filename, start=0, end=None, formantToPlot=
     config = ConfigParser()
     config.read('configF2CNN.conf')
     LOW_FREQ = config.getint('FILTERBANK', 'LOW_FREQ')
-    sampPeriod = config.getint('CNN', 'SAMPLING_PERIOD')
 
     framerate, _ = GetArrayFromWAV(filename)
     ustos = 1.0 / 1000000
@@ -106,11 +105,9 @@ def PlotEnvelopesAndFormantsFromFile(filename, start=0, end=None, formantToPlot=
                                   end=end)
 
     fbPath = os.path.splitext(filename)[0] + '.FB'
-    formants, _ = ExtractFBFile(fbPath)
-    print(len(formants))
-    print(sampPeriod)
+    formants, sampPeriod = ExtractFBFile(fbPath)
 
-    # Plot the formants, if available
+    # Plot the formants, if available, at the sampling period of their file
     if formants is not None:
         Formants = [[], [], [], []]
         formants = formants[:, :4]  # The formants are the first 4 columns of the .FB file(which is a binary file)
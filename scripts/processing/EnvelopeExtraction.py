@@ -6,16 +6,17 @@ using Hillbert transform and low pass filtering.
 """
 from __future__ import division
 
-import glob
 import time
 from itertools import repeat
 from multiprocessing import cpu_count, Value
 from multiprocessing.pool import Pool
-from os.path import splitext, join, split
+from os.path import splitext, split
 
 import numpy
 from scipy.signal import hilbert, lfilter, butter
 
+from .Manifest import GetOrganisedFiles
+
 
 def paddedHilbert(signal):
     """
@@ -122,23 +123,23 @@ def InitProcesses(cn):
     counter = cn
 
 
-def ExtractAllEnvelopes(LPF=False, CUTOFF=100):
+def ExtractAllEnvelopes(LPF=False, CUTOFF=100, region=None, speakerCount=None):
     # # In case you need to print numpy outputs:
     # numpy.set_printoptions(threshold=numpy.inf, suppress=True)
     TotalTime = time.time()
 
     # Get all the GFB.npy files under resources/fcnn
-    gfbFiles = glob.glob(join("resources", "f2cnn", "*", "*.GFB.npy"))
+    gfbFiles = GetOrganisedFiles('GFB', region, speakerCount)
+    if not gfbFiles:
+        print("ERROR: NO .GFB.npy FILES FOUND, PLEASE GENERATE FILTERED OUTPUTS")
+        exit(-1)
+
     print("\n###############################\nExtracting Envelopes from files in '{}'.".format(split(gfbFiles[0])[0]))
     if LPF:
         print("Using Low Pass Filtering with a cutoff at {}Hz".format(CUTOFF))
     else:
         print("Not using Low Pass Filtering")
 
-    if not gfbFiles:
-        print("ERROR: NO .GFB.npy FILES FOUND, PLEASE GENERATE FILTERED OUTPUTS")
-        exit(-1)
-
     print(len(gfbFiles), ".GFB.npy files found")
 
     # Usage of multiprocessing, to reduce computing time
@@ -6,52 +6,133 @@ The .FB files should be organised like the output of the OrganiseFiles.py script
 inside ../f2cnn/TEST OR TRAIN/ with the names DRr.reader.sentence.FB, with r the regionm reader the ID of the reader
 and sentence the ID of the sentence read.
 The output is a numpy.ndarray of size 8*nb_frames, with bn_frames being one of the header parameters of the .FB file.
+All the organised .FB files can also be packed into a single store with PackAllFormants, for faster lookups.
 
 """
 
+import os
 import struct
+import time
+
 import numpy
 
+from .Manifest import GetOrganisedFiles
+from .PackedStore import SavePackedStore, GetFromPackedStore, GetUtteranceId
+
+FORMANT_STORE = os.path.join('resources', 'f2cnn', 'formants')  # Optional store of all the organised .FB files
+HEADER_SIZE = 12
+
+
+def ReadFBHeader(fbFile):
+    """
+    Reads the HTK-like header of an opened .FB file
+    :param fbFile: the .FB file, opened in binary mode at its beginning
+    :return: number of frames, sampling period, size of a frame in bytes, file type
+    """
+    return struct.unpack('>iihh', fbFile.read(HEADER_SIZE))
+
+
+def ReadFBFrames(fbFile, nFrame, sampSize):
+    """
+    Reads all the frames of an opened .FB file at once
+    :param fbFile: the .FB file, opened in binary mode right after its header
+    :param nFrame: number of frames, from the header
+    :param sampSize: size of a frame in bytes, from the header
+    :return: nFrame*(sampSize/4) matrix of the values in Hz
+    """
+    nComps = sampSize // 4
+    # Each frame is made of nComps floats(F1 F2 F3 F4 B1 B2 B3 B4) in big endian disposition
+    data = numpy.fromfile(fbFile, dtype='>f4', count=nFrame * nComps).reshape(nFrame, nComps)
+    # We want the values in Hz
+    return numpy.round(data.astype(numpy.float64) * 1000, 2)
+
+
+def ResampleFormants(matrix, sampPeriod, period):
+    """
+    Linearly interpolates the frames of a .FB file at another sampling period
+    :param matrix: nb_frames*8 matrix of the file, see ExtractFBFile
+    :param sampPeriod: sampling period of the frames, from the header of the file, in us
+    :param period: wanted sampling period, in us
+    :return: the matrix of the frames at times 0, period, 2*period... within the duration of the file
+    """
+    if sampPeriod == period or len(matrix) == 0:
+        return matrix
+    frames = numpy.arange((len(matrix) - 1) * sampPeriod // period + 1) * period / sampPeriod
+    return numpy.stack([numpy.interp(frames, numpy.arange(len(matrix)), column) for column in matrix.T], axis=1)
+
 
-def ExtractFBFile(fbFilename, verbose=False):
+def ExtractFBFile(fbFilename, verbose=False, period=None):
+    """
+    Reads the frames of a .FB file
+    :param fbFilename: path to the .FB file
+    :param verbose: if True, prints the header of the file
+    :param period: if given, the frames are resampled at this sampling period, in us(like the SAMPLING_PERIOD of the
+                   configuration), whatever the sampling period of the file
+    :return: nb_frames*8 matrix of the values in Hz and its sampling period in us, or None, 0 if there is no file
+    """
+    # Served from the consolidated formant store if it has been generated with PackAllFormants
+    formants, record = GetFromPackedStore(FORMANT_STORE, fbFilename)
+    if formants is not None:
+        sampPeriod = int(record['period'])
+        if period is not None:
+            return ResampleFormants(numpy.array(formants), sampPeriod, period), period
+        return numpy.array(formants), sampPeriod
     # The file to read from, in binary reading mode
     try:
-        with open(fbFilename, 'r+b') as fbFile:
+        with open(fbFilename, 'rb') as fbFile:
             # Reading the headers, with nb of frames and periods
-            dat = fbFile.read(4)
-            nFrame = struct.unpack('>i', dat)[0]
-            dat = fbFile.read(4)
-            sampPeriod = 10000  # struct.unpack('>i', dat)[0]
-            # TODO: one of the VTR database files has an unusual sampling period (100 000 not 10 000)
-            dat = fbFile.read(2)
-            sampSize = struct.unpack('>h', dat)[0]
-            nComps = sampSize / 4
-            dat = fbFile.read(2)
-            fileType = struct.unpack('>h', dat)[0]
+            nFrame, sampPeriod, sampSize, fileType = ReadFBHeader(fbFile)
             if verbose:
                 print('N_SAMPLES=', nFrame)
                 print('SAMP_PERIOD=', sampPeriod)
                 print('SAMP_SIZE=', sampSize)
-                print('NUM_COMPS=', nComps)
+                print('NUM_COMPS=', sampSize // 4)
                 print('FILE_TYPE=', fileType)
 
             # The output matrix containing the data of the .FB file without the headers
-            outputMatrix = numpy.zeros([nFrame, 8])
-
-            # Reading the values of the formants
-            for n in range(nFrame):
-                # Read 8 floats(F1 F2 F3 F4 B1 B2 B3 B4) in big endian disposition
-                line = fbFile.read(4 * 8)
-                data = struct.unpack('>ffffffff', line)
-                for i, d in enumerate(data):
-                    # We want the values in Hz
-                    outputMatrix[n][i] = round(d * 1000, 2)
+            outputMatrix = ReadFBFrames(fbFile, nFrame, sampSize)
+        if period is not None:
+            return ResampleFormants(outputMatrix, sampPeriod, period), period
         return outputMatrix, sampPeriod
     except FileNotFoundError:
         print("No .FB formant data file.")
         return None, 0
 
 
+def PackAllFormants():
+    """
+    Packs the formants of all the organised .FB files into the single store FORMANT_STORE,
+    which ExtractFBFile then uses instead of opening each file.
+    """
+    TotalTime = time.time()
+    fbFiles = GetOrganisedFiles('FB')
+    print("\n###############################\nPacking the formants of {} .FB files into '{}'.".format(len(fbFiles),
+                                                                                                FORMANT_STORE))
+    if not fbFiles:
+        print("NO .FB FILES FOUND, PLEASE ORGANIZE FILES")
+        exit(-1)
+
+    headers = []
+    for file in fbFiles:
+        with open(file, 'rb') as fbFile:
+            headers.append(ReadFBHeader(fbFile))
+    utterances = [GetUtteranceId(file) for file in fbFiles]
+
+    def loader(i):
+        # Reading the file itself, not a previous version of the store
+        with open(fbFiles[i], 'rb') as fbFile:
+            nFrame, _, sampSize, _ = ReadFBHeader(fbFile)
+            return ReadFBFrames(fbFile, nFrame, sampSize)
+
+    SavePackedStore(FORMANT_STORE, utterances, fbFiles, [header[0] for header in headers], loader,
+                    rowShape=(headers[0][2] // 4,),
+                    extraFields={'period': ('<i4', [header[1] for header in headers])})
+
+    print("Packed {} frames.".format(sum(header[0] for header in headers)))
+    print('                Total time:', time.time() - TotalTime)
+    print('')
+
+
 def GetFormantFrequencies(fbFilename, formant):
     """
     Extracts de formant F_formant's frequencies from data of VTR formants database
@@ -9,7 +9,6 @@ The files should be first processed with OrganiseFiles.py
 """
 
 import os
-import glob
 import time
 from configparser import ConfigParser
 from itertools import repeat
@@ -21,24 +20,148 @@ from scipy.io import wavfile as WavFileTool
 from sphfile import SPHFile
 
 from gammatone import filters
+from .Manifest import GetOrganisedFiles
+from .PackedStore import SavePackedStore, GetFromPackedStore, GetUtteranceId
 
+AUDIO_STORE = os.path.join('resources', 'f2cnn', 'audio')  # Optional store of all the organised .WAV files
 counter = None
 
 
+def ReadSPHHeader(sphFile):
+    """
+    Reads the header of a NIST SPHERE file, like the TIMIT .WAV files
+    :param sphFile: the file, opened in binary mode at its beginning
+    :return: size of the header in bytes, and dict of the header fields, with integer and real values converted
+    """
+    if sphFile.readline().strip() != b'NIST_1A':
+        raise ValueError("Not a NIST SPHERE file")
+    headerSize = int(sphFile.readline().strip())
+    fields = dict()
+    for line in sphFile.read(headerSize - sphFile.tell()).split(b'\n'):
+        line = line.strip().split(None, 2)  # name, type, value
+        if not line or line[0] == b'end_head':
+            break
+        if len(line) < 3:
+            continue
+        name, fieldType, value = line[0].decode(), line[1], line[2].decode()
+        if fieldType == b'-i':
+            value = int(value)
+        elif fieldType == b'-r':
+            value = float(value)
+        fields[name] = value
+    return headerSize, fields
+
+
+def ReadSPHFile(filename):
+    """
+    Reads the samples of an uncompressed 16 bits mono NIST SPHERE file, without copying them
+    :param filename: path to the SPHERE file
+    :return: framerate and memory mapped int16 samples, or None, None if the file is compressed (shorten...),
+             not 16 bits mono PCM or without sample rate
+    """
+    with open(filename, 'rb') as sphFile:
+        headerSize, fields = ReadSPHHeader(sphFile)
+    if fields.get('sample_coding', 'pcm') != 'pcm' or fields.get('sample_n_bytes', 2) != 2 \
+            or fields.get('channel_count', 1) != 1 or 'sample_rate' not in fields:
+        return None, None
+    # '01' for little endian samples, '10' for big endian samples
+    byteOrder = {'01': '<', '10': '>'}.get(fields.get('sample_byte_format', '01'))
+    if byteOrder is None:
+        return None, None
+    count = fields.get('sample_count', (os.path.getsize(filename) - headerSize) // 2)
+    if count <= 0:  # An empty file cannot be memory mapped
+        return fields['sample_rate'], numpy.zeros(0, numpy.int16)
+    wavArray = numpy.memmap(filename, dtype=byteOrder + 'i2', mode='r', offset=headerSize, shape=(count,))
+    if wavArray.dtype != numpy.int16:  # Non native byte order, needs a conversion
+        wavArray = wavArray.astype(numpy.int16)
+    return fields['sample_rate'], wavArray
+
+
 def GetArrayFromWAV(filename):
+    """
+    Reads the samples of a .WAV file, served from the packed audio store if it has been generated with PackAllAudio
+    and if the file has not changed since then(same size and modification time)
+    :param filename: path to a RIFF or NIST SPHERE .WAV file
+    :return: framerate and int16 samples of the file
+    """
+    wavArray, record = GetFromPackedStore(AUDIO_STORE, filename)
+    if wavArray is not None:
+        return int(record['rate']), wavArray
+    return ReadWAVFile(filename)
+
+
+def ReadWAVFile(filename):
+    """
+    Reads the samples of a .WAV file from the file itself
+    :param filename: path to a RIFF or NIST SPHERE .WAV file
+    :return: framerate and int16 samples of the file
+    """
     with open(filename, 'rb') as wavFile:
         header = wavFile.read(4)
     if header == b'RIFF':  # RIFF header, for WAVE files
         framerate, wavArray = WavFileTool.read(filename)
     else:  # NIST header, which uses SPHERE
-        file = SPHFile(filename)
-        framerate = file.format['sample_rate']
-        wavArray = numpy.zeros(len(file.time_range()), dtype=numpy.int16)
-        for i, value in enumerate(file.time_range()):
-            wavArray[i] = value
+        framerate, wavArray = ReadSPHFile(filename)
+        if wavArray is None:  # Compressed files are decoded by the sphfile library
+            framerate, wavArray = GetArrayFromSPHFile(filename)
+    return framerate, wavArray
+
+
+def ReadWAVInfo(filename):
+    """
+    Reads the framerate and the number of samples of a .WAV file from its header, without reading its samples
+    :param filename: path to a RIFF or NIST SPHERE .WAV file
+    :return: framerate and number of samples of the file
+    """
+    with open(filename, 'rb') as wavFile:
+        header = wavFile.read(4)
+        if header != b'RIFF':
+            wavFile.seek(0)
+            _, fields = ReadSPHHeader(wavFile)
+    if header == b'RIFF':
+        framerate, wavArray = WavFileTool.read(filename, mmap=True)
+        return framerate, len(wavArray)
+    if 'sample_count' in fields and 'sample_rate' in fields:
+        return fields['sample_rate'], fields['sample_count']
+    framerate, wavArray = ReadWAVFile(filename)
+    return framerate, len(wavArray)
+
+
+def GetArrayFromSPHFile(filename):
+    file = SPHFile(filename)
+    framerate = file.format['sample_rate']
+    wavArray = numpy.zeros(len(file.time_range()), dtype=numpy.int16)
+    for i, value in enumerate(file.time_range()):
+        wavArray[i] = value
     return framerate, wavArray
 
 
+def PackAllAudio():
+    """
+    Packs the samples of all the organised .WAV files into the single int16 store AUDIO_STORE,
+    which GetArrayFromWAV then uses instead of opening each file.
+    """
+    TotalTime = time.time()
+    wavFiles = GetOrganisedFiles('WAV')
+    print("\n###############################\nPacking {} WAV files into '{}'.".format(len(wavFiles), AUDIO_STORE))
+    if not wavFiles:
+        print("NO WAV FILES FOUND, PLEASE ORGANIZE FILES")
+        exit(-1)
+
+    utterances = [GetUtteranceId(file) for file in wavFiles]
+    # Only the headers are read here, the samples of each file are read once, when packing them
+    rates, lengths = zip(*[ReadWAVInfo(file) for file in wavFiles])
+
+    SavePackedStore(AUDIO_STORE, utterances, wavFiles, lengths, lambda i: ReadWAVFile(wavFiles[i])[1],
+                    dtype=numpy.int16,
+                    extraFields={'split': ('S5', [utterance.split('/')[0] for utterance in utterances]),
+                                 'rate': ('<i4', rates)})
+
+    print("Packed {} samples.".format(sum(lengths)))
+    print('                Total time:', time.time() - TotalTime)
+    print('')
+
+
 def GetFilteredOutputFromArray(array, FILTERBANK_COEFFICIENTS):
     # gammatone library needs a numpy array
     # Application of the filterbank to a vector
@@ -90,20 +213,24 @@ def InitProcesses(FBCOEFS, cn):
     FILTERBANK_COEFFICIENTS = FBCOEFS
 
 
-def FilterAllOrganisedFiles():
+def FilterAllOrganisedFiles(region=None, speakerCount=None):
+    """
+    Applies the filterbank to the organised WAV files
+    :param region: if given, only the files of this dialect region(DR1-8) are filtered
+    :param speakerCount: if given, only the files of this number of speakers are filtered
+    """
     TotalTime = time.time()
 
     # Get all the WAV files under resources
-    # wavFiles = glob.glob(join("resources", "f2cnn", "*", "*.WAV"))
-    wavFiles = glob.glob(os.path.join("resources", "f2cnn", "**", "*.WAV"))
-
-    print("\n###############################\nApplying FilterBank to files in '{}'.".format(
-        os.path.split(wavFiles[0])[0]))
+    wavFiles = GetOrganisedFiles('WAV', region, speakerCount)
 
     if not wavFiles:
         print("NO WAV FILES FOUND, PLEASE ORGANIZE FILES")
         exit(-1)
 
+    print("\n###############################\nApplying FilterBank to files in '{}'.".format(
+        os.path.split(wavFiles[0])[0]))
+
     print(len(wavFiles), "files found")
 
     # #### READING CONFIG FILE
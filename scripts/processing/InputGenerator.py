@@ -1,30 +1,72 @@
 import os
-import csv
 import time
 from configparser import ConfigParser
 
 import numpy
 
+from .LabelDataGenerator import LoadLabelIndex
+
 
 def GetListOfEnvelopeFilesAndTimepoints(labelFilename):
     """
-    Takes a label csv file, and generates a list of [['TEST' or 'TRAIN', filename], [timepoints]] arrays
+    Takes a label csv file, and generates a dict of {'TEST' or 'TRAIN'/filename: [timepoints]}
     :param labelFilename: csv label file
-    :return: the described array
+    :return: the described dict
     """
+    index = LoadLabelIndex(labelFilename)
     output = dict()
-    with open(labelFilename, 'r') as labelFile:
-        csvLabelReader = csv.reader(labelFile)
-        for i, (testOrTrain, region, speaker, sentence, phoneme, timepoint, slope, pvalue, sign) in enumerate(
-                csvLabelReader):
-            file = os.path.join(testOrTrain, '.'.join((region, speaker, sentence, 'ENV1.npy')))
-            if file not in output.keys():
-                output[file] = [int(timepoint)]
-            else:
-                output[file].append(int(timepoint))
+    if len(index) == 0:
+        return output
+    # The entries of a file are contiguous, files start where any of the identification columns changes
+    changes = numpy.zeros(len(index), dtype=bool)
+    changes[0] = True
+    for column in ('split', 'region', 'speaker', 'sentence'):
+        values = index[column]
+        changes[1:] |= values[1:] != values[:-1]
+    starts = numpy.flatnonzero(changes)
+    ends = numpy.append(starts[1:], len(index))
+    for start, end in zip(starts, ends):
+        entry = index[start]
+        file = os.path.join(entry['split'].decode(), '.'.join((entry['region'].decode(), entry['speaker'].decode(),
+                                                              entry['sentence'].decode(), 'ENV1.npy')))
+        timepoints = numpy.array(index['timepoint'][start:end])
+        output[file] = numpy.concatenate((output[file], timepoints)) if file in output else timepoints
     return output
 
 
+def GetInputEntries(envelopes, timepoints, RADIUS, STEP):
+    """
+    Extracts the input entries of a file: for each timepoint, the values of all the envelopes
+    at the 2*RADIUS+1 steps centered on it
+    :param envelopes: the (NCHANNELS * nbframes) matrix of envelopes of the file
+    :param timepoints: the frames the entries are centered on
+    :param RADIUS: number of steps on each side of the center
+    :param STEP: number of frames between two steps
+    :return: the len(timepoints) x (2*RADIUS+1) x NCHANNELS array of entries
+    """
+    indexes = numpy.asarray(timepoints)[:, None] + STEP * (numpy.arange(2 * RADIUS + 1) - RADIUS)
+    return envelopes[:, indexes].transpose(1, 2, 0)
+
+
+def GetStridedWindows(envelopes, RADIUS, STEP, hop):
+    """
+    Gives the input entries of a file centered every 'hop' frames, as a strided view of its envelopes(no copy)
+    :param envelopes: the (NCHANNELS * nbframes) matrix of envelopes of the file
+    :param RADIUS: number of steps on each side of the center of an entry
+    :param STEP: number of frames between two steps
+    :param hop: number of frames between the centers of two entries
+    :return: the centers of the entries, and the read-only len(centers) x (2*RADIUS+1) x NCHANNELS view
+    """
+    nchannels, frames = envelopes.shape
+    centers = numpy.arange(RADIUS * STEP, frames - RADIUS * STEP, hop)
+    channelStride, frameStride = envelopes.strides
+    # The entry w starts at the frame w*hop, its values being STEP frames apart
+    windows = numpy.lib.stride_tricks.as_strided(envelopes, shape=(len(centers), 2 * RADIUS + 1, nchannels),
+                                                 strides=(hop * frameStride, STEP * frameStride, channelStride),
+                                                 writeable=False)
+    return centers, windows
+
+
 def GenerateInputData(labelFile=None, inputFile=None, LPF=False, CUTOFF=100):
     TotalTime = time.time()
 
@@ -69,16 +111,8 @@ def GenerateInputData(labelFile=None, inputFile=None, LPF=False, CUTOFF=100):
         file = os.path.join('resources', 'f2cnn', file)
         print("Reading:\t{}".format(file))
         envelopes = numpy.load(file)
-        i = 0
-        for i, center in enumerate(timepoints):
-            entryMatrix = numpy.zeros((DOTSPERINPUT,
-                                       NCHANNELS))  # All the values for one entry(11 timepoints centered around center) : 11x128 matrix
-            for j, index in enumerate([center + STEP * (k - RADIUS) for k in range(DOTSPERINPUT)]):
-                valueArray = numpy.array(
-                    [channel[index] for channel in envelopes])  # All the values of env at the steps' timepoint
-                entryMatrix[j] = valueArray
-            inputData[currentEntry + i] = entryMatrix
-        currentEntry += i + 1
+        inputData[currentEntry:currentEntry + len(timepoints)] = GetInputEntries(envelopes, timepoints, RADIUS, STEP)
+        currentEntry += len(timepoints)
         print("\t\t{:<50} done !  {}/{} Files".format(file, currentFileIndex + 1, len(filesAndTimepointsDict.keys())))
     inputData = numpy.array(inputData, dtype=numpy.float32)
     print('Generated Input Matrix of shape {}.'.format(inputData.shape))
@@ -1,12 +1,13 @@
 """
 
 This file generates labelling data for the CNN, as a .CSV file of columns:
-TESTorTRAIN,Region(DR1-8),SpeakerID,SentenceID,framepoint,slope,p-valueOfSlope,slopeSign(+-1)
+TESTorTRAIN,Region(DR1-8),SpeakerID,SentenceID,Phoneme,framepoint,
+followed by slope,p-valueOfSlope,slopeSign for each of the VTR formants F1 to F4.
+The slopeSign is 1 for rising, 0 for falling, and -1 if the slope of that formant is not clear enough (p-value >= RISK).
 Requires a prior execution of the OrganiseFiles.py, GammatoneFiltering.py, EnvelopeExtraction.py scripts' main functions
 
 """
 import csv
-import glob
 import os
 import time
 from configparser import ConfigParser
@@ -15,24 +16,46 @@ import numpy
 from scipy.stats import pearsonr
 
 from scripts.processing.GammatoneFiltering import GetArrayFromWAV
-from .FBFileReader import GetFromantFrequenciesAround, GetFormantFrequencies
+from .Manifest import GetOrganisedFiles
+from .FBFileReader import GetFromantFrequenciesAround, ExtractFBFile
 from .PHNFileReader import ExtractPhonemes, SILENTS, GetPhonemeFromArrayAt
 
+NFORMANTS = 4  # Number of formants in the VTR .FB files (F1, F2, F3, F4)
+NINFOCOLUMNS = 6  # TESTorTRAIN, region, speaker, sentence, phoneme, framepoint
+UNKNOWN_SIGN = -1  # Sign of a formant whose slope is not significant
+
+
+# Binary columnar equivalent of the label csv file, one record per csv line
+LABEL_INDEX_DTYPE = numpy.dtype([('split', 'S5'), ('region', 'S3'), ('speaker', 'S8'), ('sentence', 'S8'),
+                                 ('phoneme', 'S4'), ('timepoint', '<i4'), ('slope', '<f4', (NFORMANTS,)),
+                                 ('pvalue', '<f4', (NFORMANTS,)), ('sign', 'i1', (NFORMANTS,))])
+
+
+def GetFormantColumns(formant):
+    """
+    Gives the indexes of the columns of a label entry related to one formant
+    :param formant: index of the formant(1-4)
+    :return: indexes of the slope, p-value and sign columns of the formant
+    """
+    slopeColumn = NINFOCOLUMNS + 3 * (formant - 1)
+    return slopeColumn, slopeColumn + 1, slopeColumn + 2
+
 
 def ExtractLabel(wavFile, config):
     fileBase = os.path.splitext(wavFile)[0]
     # #### READING CONFIG FILE
     RADIUS = config.getint('CNN', 'RADIUS')
     RISK = config.getfloat('CNN', 'RISK')
-    FORMANT = config.getint('CNN', 'FORMANT')
     SAMPPERIOD = config.getint('CNN', 'SAMPLING_PERIOD')
     DOTSPERINPUT = RADIUS * 2 + 1
     USTOS = 1.0 / 1000000
 
-    # Load the F2 values of the file
-    FormantArray, _ = GetFormantFrequencies(fileBase + '.FB', FORMANT)
+    # Load the values of all the formants of the file, one column per formant, one frame per label period
+    # whatever the sampling period of the .FB file
+    FormantArray, _ = ExtractFBFile(fileBase + '.FB', period=SAMPPERIOD)
     if FormantArray is None:
         return None
+    FormantArray = FormantArray[:, :NFORMANTS]
     phonemes = ExtractPhonemes(fileBase + '.PHN')
     # Get number of points
     framerate, wavList = GetArrayFromWAV(wavFile)
@@ -60,42 +83,96 @@ def ExtractLabel(wavFile, config):
         entry = [testOrTrain, region, speaker, sentence, phoneme, step]
         FormantValues = numpy.array(GetFromantFrequenciesAround(FormantArray, step, RADIUS, wavToFormant))
 
-        # Least Squares Method for linear regression of the F2 values
+        # Least Squares Method for linear regression of the values of every formant at once
         x = numpy.array([step + (k - RADIUS) * STEP for k in range(DOTSPERINPUT)])
         A = numpy.vstack([x, numpy.ones(len(x))]).T
-        [a, b], _, _, _ = numpy.linalg.lstsq(A, FormantValues, rcond=None)
-        # Pearson Correlation Coefficient r and p-value p using scipy.stats.pearsonr
-        r, p = pearsonr(FormantValues, a * x + b)
-        # We round them up at 5 digits after the comma
-        entry.append(round(a, 5))
-        entry.append(round(p, 5))
-        # The line to be added to the CSV file, only if the direction of the formant is clear enough (% risk)
-
-        if p < RISK:
-            entry.append(1 if a > 0 else 0)
+        [slopes, intercepts], _, _, _ = numpy.linalg.lstsq(A, FormantValues, rcond=None)
+        significant = False
+        for k in range(NFORMANTS):
+            a, b = slopes[k], intercepts[k]
+            # Pearson Correlation Coefficient r and p-value p using scipy.stats.pearsonr
+            r, p = pearsonr(FormantValues[:, k], a * x + b)
+            # We round them up at 5 digits after the comma
+            entry.append(round(a, 5))
+            entry.append(round(p, 5))
+            # The direction of the formant is only given if it is clear enough (% risk)
+            if p < RISK:
+                entry.append(1 if a > 0 else 0)
+                significant = True
+            else:
+                entry.append(UNKNOWN_SIGN)
+
+        # The line to be added to the CSV file, only if at least one formant has a clear direction
+        if significant:
             output.append(entry)
     return output if len(output) > 0 else None
 
 
-def GenerateLabelData():
+def LabelEntriesToIndex(entries):
+    """
+    Converts label entries (lines of the label csv file) into a structured array of dtype LABEL_INDEX_DTYPE
+    :param entries: list of label entries, as generated by ExtractLabel or read from the label csv file
+    :return: the structured array, one record per entry
+    """
+    index = numpy.zeros(len(entries), dtype=LABEL_INDEX_DTYPE)
+    if not entries:
+        return index
+    for column, name in enumerate(('split', 'region', 'speaker', 'sentence', 'phoneme', 'timepoint')):
+        index[name] = [entry[column] for entry in entries]
+    for name, offset in (('slope', 0), ('pvalue', 1), ('sign', 2)):
+        columns = [GetFormantColumns(k + 1)[offset] for k in range(NFORMANTS)]
+        index[name] = [[float(entry[column]) for column in columns] for entry in entries]
+    return index
+
+
+def GetLabelIndexPath(labelFilename):
+    """
+    Gives the path of the binary label index associated to a label csv file
+    :param labelFilename: path to the label csv file
+    :return: path to the .npy label index
+    """
+    return os.path.splitext(labelFilename)[0] + '.npy'
+
+
+def LoadLabelIndex(labelFilename):
+    """
+    Loads the label data as a memory mapped structured array of dtype LABEL_INDEX_DTYPE.
+    Uses the binary index written next to the csv file by GenerateLabelData if it is up to date,
+    otherwise parses the csv file.
+    :param labelFilename: path to the label csv file, or directly to a .npy label index
+    :return: the structured array, one record per label entry
+    """
+    indexPath = GetLabelIndexPath(labelFilename)
+    if os.path.isfile(indexPath) and (indexPath == labelFilename or not os.path.isfile(labelFilename) or
+                                      os.path.getmtime(indexPath) >= os.path.getmtime(labelFilename)):
+        return numpy.load(indexPath, mmap_mode='r')
+    print("No up to date label index for '{}', parsing the csv file.".format(labelFilename))
+    with open(labelFilename, 'r') as labelFile:
+        return LabelEntriesToIndex(list(csv.reader(labelFile)))
+
+
+def GenerateLabelData(region=None, speakerCount=None):
+    """
+    Generates the label data of the organised files
+    :param region: if given, only the files of this dialect region(DR1-8) are used
+    :param speakerCount: if given, only the files of this number of speakers are used
+    """
     TotalTime = time.time()
 
     # #### READING CONFIG FILE
     config = ConfigParser()
     config.read('configF2CNN.conf')
 
-    # Get all the files under resources
-    filenames = glob.glob(os.path.join("resources", "f2cnn", "*", "*.WAV"))
-    print("\n###############################\nGenerating Label Data from files in '{}' into 2 classes.".format(
-        os.path.split(os.path.split(filenames[0])[0])[0]))
-
-    # Alphanumeric order
-    filenames = sorted(filenames)
+    # Get all the files under resources, in alphanumeric order
+    filenames = GetOrganisedFiles('WAV', region, speakerCount)
 
     if not filenames:
         print("NO FILES FOUND")
         exit(-1)
 
+    print("\n###############################\nGenerating Label Data from files in '{}' into 2 classes.".format(
+        os.path.split(os.path.split(filenames[0])[0])[0]))
+
     nfiles = len(filenames)
     print(nfiles, "files found")
 
@@ -118,5 +195,8 @@ def GenerateLabelData():
         for line in csvLines:
             writer.writerow(line)
     print("Generated Label Data CSV of", len(csvLines), "lines.")
+    indexPath = GetLabelIndexPath(filePath)
+    print("Saving binary label index in '{}'.".format(indexPath))
+    numpy.save(indexPath, LabelEntriesToIndex(csvLines))
     print('                Total time:', time.time() - TotalTime)
     print('')
@@ -0,0 +1,108 @@
+"""
+
+This file handles the manifest of the organised corpus, resources/f2cnn/manifest.csv, written by OrganiseFiles.py.
+It has one line per utterance with its split, region, speaker, sentence, number of samples, framerate,
+and the paths of all its files(.WAV, .PHN, .WRD, .FB, and the .GFB.npy and .ENV1.npy generated later).
+The stages read their files from it instead of scanning the directories, and can select a subset of the corpus.
+
+"""
+
+import csv
+import glob
+import os
+import time
+
+MANIFEST_PATH = os.path.join('resources', 'f2cnn', 'manifest.csv')
+# Files of an utterance, as {name of the column: extension}
+ARTIFACTS = {'WAV': '.WAV', 'PHN': '.PHN', 'WRD': '.WRD', 'FB': '.FB', 'GFB': '.GFB.npy', 'ENV1': '.ENV1.npy'}
+COLUMNS = ['utterance', 'split', 'region', 'speaker', 'sentence', 'samples', 'rate'] + list(ARTIFACTS.keys())
+
+# Manifest already loaded by this process, as (mtime, {region: [rows]})
+_loadedManifest = None
+
+
+def WriteManifest(wavFiles):
+    """
+    Writes the manifest of the given organised .WAV files
+    :param wavFiles: paths to the organised .WAV files, like resources/f2cnn/TEST/DR1.FELC0.SX216.WAV
+    """
+    from .GammatoneFiltering import ReadWAVFile  # Imported here, GammatoneFiltering.py uses this file
+
+    rows = []
+    for wavFile in sorted(wavFiles):
+        base = os.path.splitext(wavFile)[0]
+        split = os.path.basename(os.path.dirname(base))
+        region, speaker, sentence = os.path.basename(base).split('.')
+        framerate, wavArray = ReadWAVFile(wavFile)
+        row = {'utterance': '/'.join((split, os.path.basename(base))), 'split': split, 'region': region,
+               'speaker': speaker, 'sentence': sentence, 'samples': len(wavArray), 'rate': framerate}
+        del wavArray
+        for column, extension in ARTIFACTS.items():
+            row[column] = base + extension
+        rows.append(row)
+
+    with open(MANIFEST_PATH, 'w') as manifestFile:
+        writer = csv.DictWriter(manifestFile, COLUMNS, lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(rows)
+    print("Manifest of {} utterances saved as '{}'.".format(len(rows), MANIFEST_PATH))
+
+
+def GenerateManifest():
+    """
+    Writes the manifest of the files already organised in resources/f2cnn
+    """
+    TotalTime = time.time()
+    wavFiles = glob.glob(os.path.join('resources', 'f2cnn', '*', '*.WAV'))
+    if not wavFiles:
+        print("NO WAV FILES FOUND, PLEASE ORGANIZE FILES")
+        exit(-1)
+    WriteManifest(wavFiles)
+    print('                Total time:', time.time() - TotalTime)
+    print('')
+
+
+def LoadManifest():
+    """
+    Loads the manifest, only once per process unless it changes
+    :return: dict of {region: [rows]}, each row being a dict of the manifest columns, or None if there is no manifest
+    """
+    global _loadedManifest
+    try:
+        mtime = os.path.getmtime(MANIFEST_PATH)
+    except OSError:
+        return None
+    if _loadedManifest is None or _loadedManifest[0] != mtime:
+        regions = dict()
+        with open(MANIFEST_PATH, 'r') as manifestFile:
+            for row in csv.DictReader(manifestFile):
+                regions.setdefault(row['region'], []).append(row)
+        _loadedManifest = (mtime, regions)
+    return _loadedManifest[1]
+
+
+def GetOrganisedFiles(artifact='WAV', region=None, speakerCount=None):
+    """
+    Gives the paths of the existing organised files of one kind, using the manifest, or scanning the directories
+    if there is none
+    :param artifact: the kind of file, one of the keys of ARTIFACTS
+    :param region: if given, only the files of this dialect region(DR1-8) are given
+    :param speakerCount: if given, only the files of this number of speakers are given(first speakers in order)
+    :return: sorted list of paths
+    """
+    regions = LoadManifest()
+    if regions is None:
+        print("No manifest found, scanning the organised directories.")
+        files = sorted(glob.glob(os.path.join('resources', 'f2cnn', '*', '*' + ARTIFACTS[artifact])))
+        if region is not None:
+            files = [file for file in files if os.path.basename(file).split('.')[0] == region]
+        if speakerCount is not None:
+            speakers = sorted(set(os.path.basename(file).split('.')[1] for file in files))[:speakerCount]
+            files = [file for file in files if os.path.basename(file).split('.')[1] in speakers]
+        return files
+
+    rows = regions.get(region, []) if region is not None else [row for rows in regions.values() for row in rows]
+    if speakerCount is not None:
+        speakers = set(sorted(set(row['speaker'] for row in rows))[:speakerCount])
+        rows = [row for row in rows if row['speaker'] in speakers]
+    return sorted(row[artifact] for row in rows if os.path.isfile(row[artifact]))
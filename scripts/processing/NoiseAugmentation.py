@@ -0,0 +1,202 @@
+"""
+
+This file generates noisy versions of the input data, for training, without filtering noisy signals again.
+The gammatone filterbank is linear: filterbank(signal + a*noise) = filterbank(signal) + a*filterbank(noise).
+A bank of gaussian noise segments is filtered once, then its outputs are scaled and added to the .GFB.npy outputs
+of the clean files, before extracting the envelopes and the input entries the same way InputGenerator.py does.
+
+The augmented input file holds COPIES noisy versions of the input data, one after the other:
+its entry c*N + i is a noisy version of the entry i of the label data(N entries).
+
+"""
+
+import json
+import os
+import time
+from configparser import ConfigParser
+from itertools import repeat
+from multiprocessing import cpu_count
+from multiprocessing.pool import Pool
+
+import numpy
+
+from gammatone import filters
+from .EnvelopeExtraction import ExtractEnvelopeFromMatrix
+from .GammatoneFiltering import GetArrayFromWAV, GetFilteredOutputFromArray
+from .InputGenerator import GetListOfEnvelopeFilesAndTimepoints, GetInputEntries
+
+NOISE_DIR = os.path.join('trainingData', 'noise')
+# Number of filtered noise samples dropped at the start of each segment, while the filters settle
+WARMUP = 4096
+
+
+def SNRdbToSNRlinear(SNRdb):
+    return 10 ** (SNRdb / 10.0)
+
+
+def RMS(signal):
+    """
+    Computes the Root Mean Square of a signal
+    :param signal: the signal, integer samples being converted to float to avoid overflows
+    :return: the RMS value
+    """
+    return numpy.sqrt(numpy.mean(numpy.square(numpy.asarray(signal, dtype=numpy.float64))))
+
+
+def GetNoiseBank(FILTERBANK_COEFFICIENTS, segments, length, seed=0, noiseDir=NOISE_DIR):
+    """
+    Gives the filterbank outputs of a bank of unit variance gaussian noise segments,
+    computing them only if they do not already exist with the same parameters
+    :param FILTERBANK_COEFFICIENTS: coefficients of the gammatone filterbank
+    :param segments: number of noise segments
+    :param length: number of samples of each segment
+    :param seed: seed of the noise
+    :param noiseDir: directory of the noise bank
+    :return: path to the segments x NCHANNELS x length float32 .npy file, which can be memory mapped
+    """
+    bankPath = os.path.join(noiseDir, 'noise_bank.GFB.npy')
+    infoPath = os.path.join(noiseDir, 'noise_bank.json')
+    info = {'segments': segments, 'length': length, 'seed': seed,
+            'coefficients': numpy.asarray(FILTERBANK_COEFFICIENTS).tolist()}
+    if os.path.isfile(bankPath) and os.path.isfile(infoPath):
+        with open(infoPath, 'r') as infoFile:
+            if json.load(infoFile) == info:
+                print("Using the noise bank '{}'.".format(bankPath))
+                return bankPath
+
+    print("Filtering {} noise segments of {} samples into '{}'...".format(segments, length, bankPath))
+    os.makedirs(noiseDir, exist_ok=True)
+    random = numpy.random.RandomState(seed)
+    bank = numpy.lib.format.open_memmap(bankPath, mode='w+', dtype=numpy.float32,
+                                        shape=(segments, len(FILTERBANK_COEFFICIENTS), length))
+    for segment in range(segments):
+        noise = random.normal(size=length + WARMUP)
+        bank[segment] = GetFilteredOutputFromArray(noise, FILTERBANK_COEFFICIENTS)[:, WARMUP:]
+    bank.flush()
+    del bank
+    with open(infoPath, 'w') as infoFile:
+        json.dump(info, infoFile)
+    return bankPath
+
+
+def AugmentFile(file, timepoints, rows, outputPath, bankPath, snrs, LPF, CUTOFF, seed):
+    """
+    Writes the noisy versions of the input entries of one file into the augmented input file
+    :param file: path to the .GFB.npy file of the clean file
+    :param timepoints: the frames of the file's entries
+    :param rows: for each noisy version, index of the first entry of the file in the augmented input file
+    :param outputPath: path to the augmented input file
+    :param bankPath: path to the filtered noise bank, see GetNoiseBank
+    :param snrs: SNRs in dB among which the SNR of each noisy version is drawn
+    :param LPF: boolean for whether or not using low pass filtering
+    :param CUTOFF: cutoff frequency of the LPF
+    :param seed: seed of the random choices of the file
+    :return: the SNRs used for the file
+    """
+    config = ConfigParser()
+    config.read('configF2CNN.conf')
+    RADIUS = config.getint('CNN', 'RADIUS')
+    SAMPPERIOD = config.getint('CNN', 'SAMPLING_PERIOD')
+    FRAMERATE = config.getint('FILTERBANK', 'FRAMERATE')
+    STEP = int(FRAMERATE * SAMPPERIOD / 1000000)
+
+    clean = numpy.load(file)
+    _, wavArray = GetArrayFromWAV(file.replace('.GFB.npy', '.WAV'))
+    signalRMS = RMS(wavArray)
+    del wavArray
+    bank = numpy.load(bankPath, mmap_mode='r')
+    output = numpy.load(outputPath, mmap_mode='r+')
+    random = numpy.random.RandomState(seed)
+    used = []
+    for row in rows:
+        SNRdB = snrs[random.randint(len(snrs))]
+        segment = random.randint(len(bank))
+        offset = random.randint(bank.shape[2] - clean.shape[1] + 1)
+        # Same noise level as EvaluateWithNoise, the noise of the bank having a unit variance
+        noisy = clean + signalRMS / SNRdbToSNRlinear(SNRdB) * bank[segment, :, offset:offset + clean.shape[1]]
+        envelopes = ExtractEnvelopeFromMatrix(noisy, LPF, CUTOFF)
+        output[row:row + len(timepoints)] = GetInputEntries(envelopes, timepoints, RADIUS, STEP)
+        used.append(SNRdB)
+    output.flush()
+    print("\t\t{:<50} done ! SNRs: {}".format(file, used))
+    return used
+
+
+def GenerateAugmentedInputData(labelFile=None, inputFile=None, LPF=False, CUTOFF=100, snrs=(0., 5., 10.), copies=1,
+                               segments=4, seed=0):
+    """
+    Generates noisy versions of the input data, from the .GFB.npy files of the labelled files
+    :param labelFile: path to a .csv label file generated by LabelDataGenerator.py
+    :param inputFile: path of the augmented input file, by default trainingData/input_data_NOISE_LPFX.npy
+                      or trainingData/input_data_NOISE_NOLPF.npy
+    :param LPF: boolean for whether or not using low pass filtering, should be the same as for the clean input data
+    :param CUTOFF: cutoff frequency of the LPF
+    :param snrs: SNRs in dB among which the SNR of each noisy version of a file is drawn
+    :param copies: number of noisy versions of each entry
+    :param segments: number of noise segments of the noise bank
+    :param seed: seed of the noise and of the random choices
+    """
+    TotalTime = time.time()
+    csvFilename = labelFile or os.path.join("trainingData", "label_data.csv")
+    if not os.path.isfile(csvFilename):
+        print("LABEL GENERATION SHOULD BE DONE PRIOR TO AUGMENTATION...")
+        exit(-1)
+    filesAndTimepointsDict = GetListOfEnvelopeFilesAndTimepoints(csvFilename)
+    files = sorted(filesAndTimepointsDict.keys())
+    gfbFiles = [os.path.join('resources', 'f2cnn', file.replace('.ENV1.npy', '.GFB.npy')) for file in files]
+    missing = [file for file in gfbFiles if not os.path.isfile(file)]
+    if missing:
+        print("{} .GFB.npy FILES NOT FOUND, PLEASE GENERATE FILTERED OUTPUTS".format(len(missing)))
+        exit(-1)
+
+    print("\n###############################\nGenerating {} noisy versions of the input data of '{}', SNRs: {}dB.".format(
+        copies, csvFilename, ', '.join(str(snr) for snr in snrs)))
+    if LPF:
+        print("Using Low Pass Filtering with a cutoff at {}Hz".format(CUTOFF))
+    else:
+        print("Not using Low Pass Filtering")
+
+    # #### READING CONFIG FILE
+    config = ConfigParser()
+    config.read('configF2CNN.conf')
+    RADIUS = config.getint('CNN', 'RADIUS')
+    FRAMERATE = config.getint('FILTERBANK', 'FRAMERATE')
+    NCHANNELS = config.getint('FILTERBANK', 'NCHANNELS')
+    LOW_FREQ = config.getint('FILTERBANK', 'LOW_FREQ')
+    DOTSPERINPUT = RADIUS * 2 + 1
+    CENTER_FREQUENCIES = filters.centre_freqs(FRAMERATE, NCHANNELS, LOW_FREQ)
+    FILTERBANK_COEFFICIENTS = filters.make_erb_filters(FRAMERATE, CENTER_FREQUENCIES)
+
+    # The segments are as long as the longest file, each file uses a random part of a random segment
+    length = max(numpy.load(file, mmap_mode='r').shape[1] for file in gfbFiles)
+    bankPath = GetNoiseBank(FILTERBANK_COEFFICIENTS, segments, length, seed)
+
+    # Entries in the same order as the input data generated by InputGenerator.py
+    counts = numpy.array([len(filesAndTimepointsDict[file]) for file in files])
+    starts = numpy.concatenate(([0], numpy.cumsum(counts)[:-1]))
+    totalTimePoints = int(counts.sum())
+    savePath = inputFile or os.path.join('trainingData', 'input_data_NOISE_LPF{}.npy'.format(CUTOFF) if LPF
+                                         else 'input_data_NOISE_NOLPF.npy')
+    os.makedirs(os.path.split(savePath)[0] or '.', exist_ok=True)
+    temporaryPath = savePath + '.tmp.npy'
+    output = numpy.lib.format.open_memmap(temporaryPath, mode='w+', dtype=numpy.float32,
+                                          shape=(copies * totalTimePoints, DOTSPERINPUT, NCHANNELS))
+    print("Output shape:", output.shape)
+    del output
+
+    # Usage of multiprocessing, each process writing the entries of its files in the output file
+    arguments = zip(gfbFiles, [filesAndTimepointsDict[file] for file in files],
+                    [[copy * totalTimePoints + start for copy in range(copies)] for start in starts],
+                    repeat(temporaryPath), repeat(bankPath), repeat(list(snrs)), repeat(LPF), repeat(CUTOFF),
+                    [seed + 1 + i for i in range(len(files))])
+    multiproc_pool = Pool(processes=cpu_count())
+    used = multiproc_pool.starmap(AugmentFile, arguments)
+    multiproc_pool.close()
+    multiproc_pool.join()
+    os.replace(temporaryPath, savePath)
+
+    used = numpy.concatenate([numpy.repeat(snrsOfFile, count) for snrsOfFile, count in zip(used, counts)])
+    print("Generated {} noisy entries, mean SNR {:.1f}dB.".format(copies * totalTimePoints, numpy.mean(used)))
+    print("Saved as {}.".format(savePath))
+    print('                Total time:', time.time() - TotalTime)
+    print('')
@@ -4,8 +4,12 @@
 import glob
 import os
 import time
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 from shutil import copyfile
 
+from .Manifest import WriteManifest
+
 
 def completeSplit(filename):
     """
@@ -30,70 +34,86 @@ def completeSplit(filename):
     return splitted
 
 
-def moveFilesToPosition(vtrFileNames, timitFileNames):
+def placeFile(src, dst, link='copy'):
+    """
+    Places a file at its destination, by copy, hard link or symbolic link
+    :param src: path to the source file
+    :param dst: path to the destination file, replaced if it already exists
+    :param link: 'copy', 'hard' for a hard link (copies if not possible), or 'sym' for a symbolic link
+    :return: True if the file was placed, False if the source file was not found
+    """
+    if not os.path.isfile(src):
+        return False
+    # Never write through a link made by a previous organisation, that would modify the databases
+    if os.path.lexists(dst):
+        os.remove(dst)
+    if link == 'sym':
+        os.symlink(os.path.abspath(src), dst)
+    elif link == 'hard':
+        try:
+            os.link(src, dst)
+        except OSError:  # Different file systems for instance
+            copyfile(src, dst)
+    else:
+        copyfile(src, dst)
+    return True
+
+
+def moveFilesToPosition(vtrFileNames, timitFileNames, link='copy'):
     """
     Moves all files to their correct position in ./resources/f2cnn
     :param vtrFileNames: paths to all vtr .FB files
     :param timitFileNames: paths to all Timit .WAV files
+    :param link: 'copy', 'hard' or 'sym', see placeFile
+    :return: paths of the organised .WAV files
     """
-    # Get the WAV files from timit
+    # VTR files indexed by (speaker, sentence)
+    vtrFiles = {(vtrFile[-2].upper(), vtrFile[-1].upper()): vtrFile for vtrFile in vtrFileNames}
+
+    # List of (kind of file, source, destination) for all the files to place
+    placements = []
+    for timitFile in timitFileNames:
+        vtrFile = vtrFiles.get((timitFile[-2].upper(), timitFile[-1].upper()))
+        if vtrFile is None:
+            continue
+        src = os.path.join('resources', 'TIMIT', timitFile[-4], timitFile[-3], timitFile[-2], timitFile[-1])
+        dst = os.path.join('resources', 'f2cnn', timitFile[-4].upper(),
+                           ".".join([timitFile[-3].upper(), timitFile[-2].upper(), timitFile[-1].upper()]))
+        print("ENTRY:\t", src)
+        for extension in ('WAV', 'PHN', 'WRD'):
+            placements.append((extension, src + '.' + extension, dst + '.' + extension))
+        fbsrc = os.path.join('resources', 'VTR', vtrFile[-4], vtrFile[-3], vtrFile[-2], vtrFile[-1])
+        placements.append(('FB', fbsrc + ".fb", dst + ".FB"))
+
+    # The files are placed in parallel threads, mostly waiting for the disk
+    pool = ThreadPool(processes=min(32, cpu_count() * 4))
+    placed = pool.starmap(placeFile, [(src, dst, link) for _, src, dst in placements])
+    pool.close()
+    pool.join()
+
     count = 0
     notfound = 0
-    for timitFile in timitFileNames:
-        for vtrFile in vtrFileNames:
-            if timitFile[-2].upper() == vtrFile[-2].upper() and timitFile[-1].upper() == vtrFile[-1].upper():
-                src = os.path.join('resources', 'TIMIT', timitFile[-4], timitFile[-3], timitFile[-2], timitFile[-1])
-                dst = os.path.join('resources', 'f2cnn', timitFile[-4].upper(),
-                                   ".".join([timitFile[-3].upper(), timitFile[-2].upper(), timitFile[-1].upper()]))
-
-                print("ENTRY:\t", src)
-                try:
-                    copyfile(src + ".WAV", dst + ".WAV")
-                    count += 1
-                except FileNotFoundError:
-                    print('ERROR: FILENOTFOUND DURING')
-                    print("\t Copying WAV file")
-                    print("FROM\t", src + ".WAV")
-                    print("TO\t", dst + ".WAV")
-                    notfound += 1
-
-                try:
-                    copyfile(src + ".PHN", dst + ".PHN")
-                    count += 1
-                except FileNotFoundError:
-                    print('ERROR: FILENOTFOUND DURING')
-                    print("\t Copying PHN file")
-                    print("FROM\t", src + ".PHN")
-                    print("TO\t", dst + ".PHN")
-                    notfound += 1
-
-                try:
-                    copyfile(src + ".WRD", dst + ".WRD")
-                    count += 1
-                except FileNotFoundError:
-                    print('ERROR: FILENOTFOUND DURING')
-                    print("\t Copying WRD file")
-                    print("FROM\t", src + ".WRD")
-                    print("TO\t", dst + ".WRD")
-                    notfound += 1
-
-                fbsrc = os.path.join('resources', 'VTR', vtrFile[-4], vtrFile[-3], vtrFile[-2], vtrFile[-1])
-                try:
-                    copyfile(fbsrc + ".fb", dst + ".FB")
-                    count += 1
-                except FileNotFoundError:
-                    print('ERROR: FILENOTFOUND DURING')
-                    print("\t Copying FB file")
-                    print("FROM\t", fbsrc + ".fb")
-                    print("TO\t", dst + ".FB\n")
-                    notfound += 1
+    for (kind, src, dst), done in zip(placements, placed):
+        if done:
+            count += 1
+        else:
+            print('ERROR: FILENOTFOUND DURING')
+            print("\t Copying {} file".format(kind))
+            print("FROM\t", src)
+            print("TO\t", dst)
+            notfound += 1
 
     print(count, "files reorganized.")
     if notfound > 0:
         print(notfound, "files not found.")
+    return [dst for (kind, _, dst), done in zip(placements, placed) if kind == 'WAV' and done]
 
 
-def OrganiseAllFiles():
+def OrganiseAllFiles(link='copy'):
+    """
+    Organises the TIMIT files having VTR formants in ./resources/f2cnn
+    :param link: 'copy' to copy the files, 'hard' to use hard links, 'sym' to use symbolic links
+    """
     print(
         "\n###############################\nReorganising files, like explained in the OrganiseFiles.py file's documentation.")
     TotalTime = time.time()
@@ -117,10 +137,11 @@ def OrganiseAllFiles():
     print("FOUND", len(timitFileNames), "TIMIT WAV FILES.")
     TEST_DIR = os.path.join('resources', 'f2cnn', 'TEST')
     TRAIN_DIR = os.path.join('resources', 'f2cnn', 'TRAIN')
-    os.makedirs(os.path.split(TEST_DIR)[0], exist_ok=True)
-    os.makedirs(os.path.split(TRAIN_DIR)[0], exist_ok=True)
+    os.makedirs(TEST_DIR, exist_ok=True)
+    os.makedirs(TRAIN_DIR, exist_ok=True)
 
-    moveFilesToPosition(vtrFileNames, timitFileNames)
+    wavFiles = moveFilesToPosition(vtrFileNames, timitFileNames, link)
+    WriteManifest(wavFiles)
 
     print("Done reorganizing files.")
     print('                Total time:', time.time() - TotalTime)
@@ -0,0 +1,143 @@
+"""
+
+This file allows packing arrays of the organised files (one per utterance, like the formants of the .FB files)
+into a single memory mappable .npy file, along with an index giving the offset and length of each utterance's rows.
+Looking up an utterance is then O(1), without opening and parsing its own file.
+
+A store named NAME is made of NAME.npy (all the rows, concatenated) and NAME.index.npy (a structured array).
+The index also records the size and modification time of each utterance's source file: an utterance whose file has
+changed since the packing is not served from the store, but read from its file again.
+
+"""
+
+import os
+
+import numpy
+
+ORGANISED_DIR = os.path.join('resources', 'f2cnn')
+
+# Fields of the index records describing the source file of each utterance
+SOURCE_FIELDS = {'size': '<i8', 'mtime': '<i8'}
+
+# Stores already loaded by this process, as {basePath: (index mtime, data, {utterance: index record})}
+_loadedStores = dict()
+
+
+def GetUtteranceId(filename):
+    """
+    Gives the identifier of an organised file's utterance, like 'TEST/DR1.FELC0.SX216' for
+    resources/f2cnn/TEST/DR1.FELC0.SX216.WAV (or .FB, .GFB.npy...)
+    :param filename: path to a file organised by OrganiseFiles.py
+    :return: the utterance identifier, or None if the file is not inside the organised directory
+    """
+    directory, name = os.path.split(os.path.abspath(filename))
+    if os.path.dirname(directory) != os.path.abspath(ORGANISED_DIR):
+        return None
+    return '/'.join((os.path.basename(directory), '.'.join(name.split('.')[:3])))
+
+
+def GetSourceSignature(filename):
+    """
+    :param filename: path to a source file of a store
+    :return: size and modification time(in ns) of the file, or None if it does not exist
+    """
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+def GetStorePaths(basePath):
+    """
+    :param basePath: path of the store, without extension
+    :return: paths of the data file and of the index file of the store
+    """
+    return basePath + '.npy', basePath + '.index.npy'
+
+
+def SavePackedStore(basePath, utterances, sources, lengths, loader, rowShape=(), dtype=numpy.float64,
+                    extraFields=None):
+    """
+    Packs the arrays of many utterances into one store, writing them one after the other without keeping them in memory
+    :param basePath: path of the store, without extension
+    :param utterances: identifiers of the utterances, see GetUtteranceId
+    :param sources: paths to the source files of the utterances, whose sizes and modification times are recorded
+    :param lengths: number of rows of each utterance's array
+    :param loader: function called with the position of an utterance in 'utterances', returning its array
+    :param rowShape: shape of one row of the arrays, () for 1D arrays
+    :param dtype: dtype of the packed data
+    :param extraFields: dict of {name: (dtype, values)} of additional per-utterance columns of the index
+    """
+    extraFields = dict(extraFields or dict())
+    # Recorded before loading the arrays, so that a file changed while packing is not served from the store
+    signatures = [GetSourceSignature(source) or (-1, -1) for source in sources]
+    for k, (name, fieldType) in enumerate(SOURCE_FIELDS.items()):
+        extraFields[name] = (fieldType, [signature[k] for signature in signatures])
+    dataPath, indexPath = GetStorePaths(basePath)
+    os.makedirs(os.path.split(dataPath)[0] or '.', exist_ok=True)
+
+    index = numpy.zeros(len(utterances), dtype=[('utterance', 'S32'), ('offset', '<i8'), ('length', '<i8')] +
+                                               [(name, fieldType) for name, (fieldType, _) in extraFields.items()])
+    index['utterance'] = utterances
+    index['length'] = lengths
+    index['offset'][1:] = numpy.cumsum(index['length'])[:-1]
+    for name, (_, values) in extraFields.items():
+        index[name] = values
+
+    data = numpy.lib.format.open_memmap(dataPath, mode='w+', dtype=dtype,
+                                        shape=(int(index['length'].sum()),) + tuple(rowShape))
+    for i, (offset, length) in enumerate(zip(index['offset'], index['length'])):
+        array = loader(i)
+        if len(array) != length:
+            raise ValueError("{} has {} rows instead of {}".format(utterances[i], len(array), length))
+        data[offset:offset + length] = array
+    data.flush()
+    del data
+    # The index is written last, a store without index is ignored
+    numpy.save(indexPath, index)
+
+
+def LoadPackedStore(basePath):
+    """
+    Loads a store, memory mapping its data. Stores are only loaded once per process, unless their index changes.
+    :param basePath: path of the store, without extension
+    :return: the memory mapped data and a dict of {utterance: index record}, or None, None if there is no store
+    """
+    dataPath, indexPath = GetStorePaths(basePath)
+    try:
+        mtime = os.path.getmtime(indexPath)
+    except OSError:
+        _loadedStores.pop(basePath, None)
+        return None, None
+    if basePath not in _loadedStores or _loadedStores[basePath][0] != mtime:
+        index = numpy.load(indexPath)
+        if not set(SOURCE_FIELDS) <= set(index.dtype.names):
+            print("The store '{}' does not record its source files and is ignored, please pack it again."
+                  .format(basePath))
+            _loadedStores[basePath] = (mtime, None, None)
+        else:
+            records = {record['utterance'].decode(): record for record in index}
+            _loadedStores[basePath] = (mtime, numpy.load(dataPath, mmap_mode='r'), records)
+    _, data, records = _loadedStores[basePath]
+    return data, records
+
+
+def GetFromPackedStore(basePath, filename):
+    """
+    Looks up the rows of an organised file's utterance in a store
+    :param basePath: path of the store, without extension
+    :param filename: path to a file organised by OrganiseFiles.py
+    :return: the memory mapped rows of the utterance and its index record, or None, None if not in the store
+             or if the file has changed since the packing
+    """
+    utterance = GetUtteranceId(filename)
+    if utterance is None:
+        return None, None
+    data, records = LoadPackedStore(basePath)
+    if data is None or utterance not in records:
+        return None, None
+    record = records[utterance]
+    if GetSourceSignature(filename) != tuple(int(record[name]) for name in SOURCE_FIELDS):
+        return None, None
+    return data[record['offset']:record['offset'] + record['length']], record
@@ -0,0 +1,167 @@
+"""
+
+This file includes chunk by chunk versions of the gammatone filterbank and of the envelope extraction,
+for live audio: their states are kept from one chunk to the next, so that filtering a signal chunk by chunk
+gives the same output as GammatoneFiltering.GetFilteredOutputFromArray on the whole signal.
+The envelope uses a causal FIR Hilbert transformer instead of the whole signal paddedHilbert, which delays it by
+half the length of the FIR.
+
+"""
+
+import numpy
+from scipy import fft
+from scipy.signal import butter, fftconvolve, get_window, lfilter
+
+# Number of taps of the FIR Hilbert transformer, odd, for a delay of (HILBERT_TAPS - 1) / 2 samples
+HILBERT_TAPS = 513
+
+
+def GetHilbertFIR(taps=HILBERT_TAPS):
+    """
+    Designs a Hamming windowed Hilbert transformer
+    :param taps: odd number of taps
+    :return: the taps
+    """
+    if taps % 2 == 0:
+        raise ValueError("The Hilbert transformer needs an odd number of taps")
+    n = numpy.arange(taps) - (taps - 1) // 2
+    fir = numpy.zeros(taps)
+    odd = n % 2 == 1
+    fir[odd] = 2 / (numpy.pi * n[odd])
+    return fir * get_window('hamming', taps)
+
+
+class StreamingFilterbank:
+    """
+    Gammatone filterbank keeping the states of its filters between chunks, see gammatone.filters.erb_filterbank.
+    All the channels filtering the same samples, chunks of blockSize samples are filtered with a few products
+    of precomputed matrices instead of 4 filters per channel: the outputs of a chunk are the outputs of the states
+    of the filters(without input) plus the outputs of the samples(from null states), and so are their next states.
+    """
+
+    def __init__(self, FILTERBANK_COEFFICIENTS, blockSize=None):
+        """
+        :param FILTERBANK_COEFFICIENTS: coefficients of the gammatone filterbank
+        :param blockSize: number of samples of the chunks filtered with matrices, if given
+        """
+        coefs = numpy.asarray(FILTERBANK_COEFFICIENTS)
+        self.gain = coefs[:, 9]
+        # A0, A1k, A2 of the 4 cascaded filters, sharing B0, B1, B2
+        self.As = [coefs[:, (0, k, 5)] for k in range(1, 5)]
+        self.Bs = coefs[:, 6:9]
+        # States of the 4 filters of each channel, as 4 x 2 lfilter states
+        self.zi = numpy.zeros((len(coefs), 8))
+        self.blockSize = blockSize
+        if blockSize:
+            self.precomputeBlock(blockSize)
+
+    def filterChannel(self, idx, signal, zi):
+        """
+        :return: outputs of the 4 filters of a channel for the signal, and their final states
+        """
+        zf = numpy.empty(8)
+        outputs = []
+        for stage in range(4):
+            signal, zf[2 * stage:2 * stage + 2] = lfilter(self.As[stage][idx], self.Bs[idx], signal,
+                                                          zi=zi[2 * stage:2 * stage + 2])
+            outputs.append(signal)
+        return outputs, zf
+
+    def precomputeBlock(self, N):
+        nchannels = len(self.gain)
+        # Outputs and final states of each unit state, without input
+        self.stateOutputs = numpy.empty((nchannels, N, 8))
+        self.stateTransitions = numpy.empty((nchannels, 8, 8))
+        # Impulse responses, and states after each sample of an impulse
+        self.impulseResponses = numpy.empty((nchannels, N))
+        self.impulseStates = numpy.empty((nchannels, 8, N))
+        impulse = numpy.zeros(N)
+        impulse[0] = 1
+        for idx in range(nchannels):
+            for j, unit in enumerate(numpy.eye(8)):
+                outputs, self.stateTransitions[idx, :, j] = self.filterChannel(idx, numpy.zeros(N), unit)
+                self.stateOutputs[idx, :, j] = outputs[-1] / self.gain[idx]
+            outputs, _ = self.filterChannel(idx, impulse, numpy.zeros(8))
+            self.impulseResponses[idx] = outputs[-1] / self.gain[idx]
+            # States of the transposed direct form II: z2 = b2*x - a2*y, z1 = b1*x - a1*y + previous z2
+            inputs = [impulse] + outputs[:3]
+            for stage in range(4):
+                b, a = self.As[stage][idx] / self.Bs[idx][0], self.Bs[idx] / self.Bs[idx][0]
+                x, y = inputs[stage], outputs[stage]
+                z2 = b[2] * x - a[2] * y
+                self.impulseStates[idx, 2 * stage] = b[1] * x - a[1] * y + numpy.concatenate(([0], z2[:-1]))
+                self.impulseStates[idx, 2 * stage + 1] = z2
+        # The sample k of a block leaves the state of an impulse after N - 1 - k samples
+        self.inputTransitions = self.impulseStates[:, :, ::-1]
+
+    def process(self, chunk):
+        """
+        :param chunk: the next samples of the signal
+        :return: NCHANNELS x len(chunk) array of the outputs of the filterbank for these samples
+        """
+        chunk = numpy.asarray(chunk, dtype=numpy.float64)
+        if len(chunk) == self.blockSize:
+            output = numpy.einsum('cnj,cj->cn', self.stateOutputs, self.zi)
+            output += fftconvolve(self.impulseResponses, chunk[None, :], axes=1)[:, :len(chunk)]
+            self.zi = numpy.einsum('cij,cj->ci', self.stateTransitions, self.zi) + self.inputTransitions @ chunk
+            return output
+        output = numpy.zeros((len(self.gain), len(chunk)))
+        for idx in range(len(self.gain)):
+            outputs, self.zi[idx] = self.filterChannel(idx, chunk, self.zi[idx])
+            output[idx] = outputs[-1] / self.gain[idx]
+        return output
+
+
+class StreamingEnvelope:
+    """
+    Envelope extraction keeping the last samples of each channel between chunks: the envelope is the modulus of the
+    analytic signal made of the delayed channel and of its FIR Hilbert transform, optionally low pass filtered
+    like EnvelopeExtraction.lowPassFilter does
+    """
+
+    def __init__(self, nchannels, LPF=False, CUTOFF=100, framerate=16000, taps=HILBERT_TAPS):
+        """
+        :param nchannels: number of channels
+        :param LPF: boolean for whether or not using low pass filtering
+        :param CUTOFF: cutoff frequency of the LPF
+        :param framerate: framerate of the signal
+        :param taps: odd number of taps of the Hilbert transformer
+        """
+        self.fir = GetHilbertFIR(taps)
+        self.delay = (taps - 1) // 2
+        self.history = numpy.zeros((nchannels, taps - 1))
+        # The first outputs of the FIR are those of the samples before the start of the signal
+        self.skip = self.delay
+        # Spectrums of the Hilbert transformer, by FFT length
+        self.spectrums = dict()
+        self.LPF = LPF
+        if LPF:
+            self.B, self.A = butter(1, CUTOFF / (framerate / 2), 'low')
+            self.zi = numpy.zeros((nchannels, 1))
+
+    def process(self, chunk):
+        """
+        :param chunk: NCHANNELS x N outputs of the filterbank
+        :return: NCHANNELS x M envelopes, M being N at most: the envelope of a sample is given 'delay' samples later
+        """
+        signal = numpy.concatenate((self.history, chunk), axis=1)
+        self.history = signal[:, chunk.shape[1]:]
+        length = fft.next_fast_len(signal.shape[1])
+        if length not in self.spectrums:
+            self.spectrums[length] = fft.rfft(self.fir, length)
+        # Only the outputs of the FIR that do not wrap around are kept
+        imaginary = fft.irfft(fft.rfft(signal, length, axis=1) * self.spectrums[length], length,
+                              axis=1)[:, len(self.fir) - 1:signal.shape[1]]
+        envelopes = numpy.hypot(signal[:, self.delay:self.delay + chunk.shape[1]], imaginary)
+        if self.skip:
+            skipped = min(self.skip, envelopes.shape[1])
+            envelopes, self.skip = envelopes[:, skipped:], self.skip - skipped
+        if self.LPF and envelopes.shape[1]:
+            envelopes, self.zi = lfilter(self.B, self.A, envelopes, axis=1, zi=self.zi)
+        return envelopes
+
+    def flush(self):
+        """
+        :return: the envelopes of the last 'delay' samples, the signal being followed by silence
+        """
+        return self.process(numpy.zeros((self.history.shape[0], self.delay)))